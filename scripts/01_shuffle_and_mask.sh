@@ -1,5 +1,5 @@
 #!/bin/bash
-#SBATCH -t 1:00:00 --mem=4G
+#SBATCH -t 1:00:00 --mem=4G -c8
 #SBATCH -J mask_and_shuffle
 #SBATCH -e /gpfs/data/cbc/aguang/hiv_wide/logs/mask_and_shuffle-%A-%a.err
 #SBATCH -o /gpfs/data/cbc/aguang/hiv_wide/logs/mask_and_shuffle-%A-%a.out
@@ -13,4 +13,4 @@ SINGULARITY_IMG=${WORKDIR}/metadata/rkantor_hiv.simg
 ALIGNMENTS=${WORKDIR}/results/alignments
 
 fa=HIV1_FLT_2018_genome_DNA_subtypeB.fa
-python shuffle_and_mask.py ${ALIGNMENTS}/${fa} ${ALIGNMENTS}
\ No newline at end of file
+python shuffle_and_mask.py ${ALIGNMENTS}/${fa} ${ALIGNMENTS} --workers ${SLURM_CPUS_PER_TASK:-1}
\ No newline at end of file
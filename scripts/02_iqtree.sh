@@ -13,13 +13,29 @@ WORKDIR=/gpfs/data/cbc/aguang/hiv_wide
 SINGULARITY_IMG=${WORKDIR}/metadata/rkantor_hiv.simg
 ALIGNMENTS=${WORKDIR}/results/alignments
 
+# written by shuffle_and_mask.py --manifest; if present, alignments are materialized on node-local scratch
+MANIFEST=${ALIGNMENTS}/HIV1_FLT_2018_genome_DNA_subtypeB_masks.json
+
 cd $ALIGNMENTS
-seeds=(*/)
-seed=${seeds[$(( $SLURM_ARRAY_TASK_ID % 100 ))]%/} # values 0-99 for indexing
+if [ -f ${MANIFEST} ]; then
+    seeds=( $(python ${WORKDIR}/scripts/mask_manifest.py ${MANIFEST} --seeds) )
+else
+    seeds=(*/)
+fi
+# task = 10 * seed index + mask index, as in 03_iqtree_fixedparams.sh, so the 1000 tasks cover every (seed, mask) once
+seed=${seeds[$(( $SLURM_ARRAY_TASK_ID / 10 ))]%/} # values 0-99 for indexing
 masks=( 010 020 030 040 050 060 070 080 090 100 )
 mask=${masks[$(( $SLURM_ARRAY_TASK_ID % 10 ))]} # values 0-9 for indexing
 
 fa=HIV1_FLT_2018_genome_DNA_subtypeB_${seed}_mask${mask}.fa
 
+if [ -f ${MANIFEST} ]; then
+    aln=${TMPDIR:-/tmp}/${fa}
+    python ${WORKDIR}/scripts/mask_manifest.py ${MANIFEST} ${seed} ${mask} -o ${aln}
+    trap "rm -f ${aln}" EXIT
+else
+    aln=${ALIGNMENTS}/${seed}/${fa}
+fi
+
 mkdir -p ${WORKDIR}/results/trees/${seed}
-singularity exec ${SINGULARITY_IMG} iqtree -nt 8 -mem 16G  -s ${ALIGNMENTS}/${seed}/${fa} -m GTR+F+I+G4 -alrt 1000 -bb 1000 -wbt -wbtl -pre ${WORKDIR}/results/trees/${seed}/${fa}
+singularity exec ${SINGULARITY_IMG} iqtree -nt 8 -mem 16G  -s ${aln} -m GTR+F+I+G4 -alrt 1000 -bb 1000 -wbt -wbtl -pre ${WORKDIR}/results/trees/${seed}/${fa}
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import numpy as np
+
+from fastaio import FastaWriter, read_input
+
+GAP = ord("-")
+
+
+class AlignmentMatrix:
+    """
+    An alignment held in memory as a uint8 matrix (rows = sequences, columns = sites).
+    Titles are kept as the raw header bytes so records are written back exactly as read.
+    """
+
+    def __init__(self, titles, seqs):
+        self.titles = titles
+        self.ids = [t.split(None, 1)[0].decode() for t in titles]
+        self.seqs = seqs
+
+    @classmethod
+    def from_rows(cls, titles, rows):
+        if len(set(len(r) for r in rows)) > 1:
+            raise ValueError("Sequences are not aligned (rows have different lengths)")
+        seqs = np.frombuffer(b"".join(rows), dtype=np.uint8).reshape(len(rows), -1)
+        return cls(titles, seqs)
+
+    @classmethod
+    def from_bytes(cls, data):
+        titles = []
+        rows = []
+        for record in data.split(b"\n>"):
+            title, _, seq = record.lstrip(b">").partition(b"\n")
+            titles.append(title.rstrip(b"\r"))
+            # same clean-up as Bio.SeqIO's fasta parser
+            rows.append(seq.replace(b"\n", b"").replace(b"\r", b"").replace(b" ", b""))
+        return cls.from_rows(titles, rows)
+
+    @classmethod
+    def from_records(cls, records):
+        """
+        Builds the matrix from Bio.SeqIO records of any format, titled by record name.
+        """
+        titles = []
+        rows = []
+        for record in records:
+            titles.append(record.name.encode())
+            rows.append(bytes(record.seq))
+        return cls.from_rows(titles, rows)
+
+    @classmethod
+    def from_fasta(cls, path, member=None):
+        """
+        Reads a plain or compressed fasta, or member of a tarball (see fastaio.open_input).
+        """
+        return cls.from_bytes(read_input(path, member))
+
+    @property
+    def shape(self):
+        return self.seqs.shape
+
+    def __len__(self):
+        return self.seqs.shape[0]
+
+    def index(self, seqid):
+        return self.ids.index(seqid)
+
+    def row(self, i):
+        return self.seqs[i].tobytes().decode()
+
+    def masked(self, row_mask, col_mask, mask_char="-"):
+        """
+        Returns a copy of the matrix with the columns *outside* col_mask replaced
+        by mask_char in every row selected by row_mask.
+        """
+        out = self.seqs.copy()
+        out[np.ix_(row_mask, ~col_mask)] = ord(mask_char)
+        return out
+
+    def to_fasta(self, seqs=None, order=None):
+        """
+        Serializes rows as fasta-2line in one buffer. order gives the row order to write.
+        """
+        if seqs is None:
+            seqs = self.seqs
+        if order is None:
+            order = range(len(self.titles))
+        n_cols = seqs.shape[1]
+        # append a newline column so each row serializes with a single tobytes()
+        body = np.empty((seqs.shape[0], n_cols + 1), dtype=np.uint8)
+        body[:, :n_cols] = seqs
+        body[:, n_cols] = ord("\n")
+        chunks = []
+        for i in order:
+            chunks.append(b">" + self.titles[i] + b"\n")
+            chunks.append(body[i].tobytes())
+        return b"".join(chunks)
+
+    def write_fasta(self, handle, seqs=None, order=None):
+        handle.write(self.to_fasta(seqs, order))
+
+    def records(self, seqs=None, order=None):
+        if seqs is None:
+            seqs = self.seqs
+        if order is None:
+            order = range(len(self.titles))
+        for i in order:
+            yield self.titles[i], seqs[i].tobytes()
+
+    def save_fasta(self, file_path, seqs=None, order=None):
+        """
+        Writes rows to file_path, as indexed BGZF if it ends in .gz (see fastaio.FastaWriter).
+        """
+        if not file_path.endswith(".gz"):
+            with open(file_path, "wb") as f:
+                self.write_fasta(f, seqs, order)
+            return
+        with FastaWriter(file_path) as writer:
+            writer.write_records(self.records(seqs, order))
+
+
+def column_mask(n_cols, start, stop):
+    cols = np.zeros(n_cols, dtype=bool)
+    cols[start:stop] = True
+    return cols
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+import argparse
+import multiprocessing
+import os
+import re
+from glob import glob
+
+import numpy as np
+import pandas as pd
+
+from bootstrap_support import get_support_symbol, outgroup, quadrants
+from splits import SplitIndex, compare_splits, taxon_order
+from tables import write_table
+from tbe import TransferIndex, ufboot_file
+from treecache import load_tree
+from ufboot_splits import read_newicks
+
+# python batch_support.py ../results/trees/HIV1_FLT_2018_genome_DNA_subtypeB.fa.treefile ../results/trees -o ../results/support.csv --workers 8
+
+tree_regex = re.compile(r"_(\d+)_mask(\d+)\.fa\.treefile$")
+columns = ["param_set", "seed", "mask", "split", "shared", "ref_SHaLRT", "ref_bootstrap", "SHaLRT", "bootstrap",
+           "quadrant", "ref_TBE", "TBE"]
+
+# set in the parent before the pool forks so workers share them copy-on-write
+_ref_tree = None
+_ref_splits = None
+# TransferIndex of the reference and the reference's own TBE per node, with --tbe
+_transfer_index = None
+_ref_tbe = None
+
+
+def find_trees(tree_dir):
+    """
+    (param set, seed, mask, path) for every tree written by 02_iqtree.sh to <tree_dir>/<seed>/
+    and by 03_iqtree_fixedparams.sh to <tree_dir>/fixedparams/<seed>/
+    """
+    trees = []
+    for param_set, seed_dirs in (("free", "*"), ("fixed", os.path.join("fixedparams", "*"))):
+        for tree_file in sorted(glob(os.path.join(tree_dir, seed_dirs, "*.treefile"))):
+            match = tree_regex.search(tree_file)
+            if match is not None:
+                seed, mask = match.groups()
+                trees.append((param_set, int(seed), int(mask), tree_file))
+    return trees
+
+
+def node_tbe(tree_file):
+    """
+    TBE of every reference node in the bootstrap trees written with tree_file, NaN without them.
+    TBE is defined for any split, so reference splits the tree lacks get a value too.
+    """
+    values = np.full(len(_ref_tree), np.nan)
+    if _transfer_index is not None and os.path.exists(ufboot_file(tree_file)):
+        values[_transfer_index.nodes] = _transfer_index.tbe(read_newicks(ufboot_file(tree_file)))
+    return values
+
+
+def support_rows(job):
+    """
+    One row per reference split (identified by its node index in the reference tree):
+    its support in the reference and, if the tree shares it, in the tree.
+    """
+    param_set, seed, mask, tree_file = job
+    tree = load_tree(tree_file)
+    comparison = compare_splits(_ref_splits, SplitIndex.from_flat(tree, _ref_splits.taxa, outgroup))
+    shared = [ref_node for ref_node, _ in comparison["common"]] + comparison["ref_only"]
+    ref_nodes = np.array(shared, dtype=np.int64)
+    nodes = np.array([node for _, node in comparison["common"]], dtype=np.int64)
+    n_only = len(comparison["ref_only"])
+    bootstrap = np.concatenate([tree.ufboot[nodes], np.full(n_only, np.nan)])
+    shalrt = np.concatenate([tree.shalrt[nodes], np.full(n_only, np.nan)])
+    ref_bootstrap = _ref_tree.ufboot[ref_nodes]
+    quadrant = [
+        None if np.isnan(r) or np.isnan(c) else quadrants[get_support_symbol(r, c)]
+        for r, c in zip(ref_bootstrap.tolist(), bootstrap.tolist())
+    ]
+    rows = {
+        "param_set": param_set,
+        "seed": seed,
+        "mask": mask,
+        "split": ref_nodes,
+        "shared": np.arange(len(ref_nodes)) < len(nodes),
+        "ref_SHaLRT": _ref_tree.shalrt[ref_nodes],
+        "ref_bootstrap": ref_bootstrap,
+        "SHaLRT": shalrt,
+        "bootstrap": bootstrap,
+        "quadrant": quadrant,
+        "ref_TBE": _ref_tbe[ref_nodes],
+        "TBE": node_tbe(tree_file)[ref_nodes],
+    }
+    summary = "{} seed {} mask {:0>3}: {}/{} common/total edges, normRF {:0.2f}".format(
+        param_set, seed, mask, len(comparison["common"]), comparison["ref_edges"], comparison["norm_rf"])
+    return rows, summary
+
+
+def main():
+    global _ref_tree, _ref_splits, _transfer_index, _ref_tbe
+    parser = argparse.ArgumentParser(
+        description="Compares every seed/mask/parameter-set tree against a reference tree"
+    )
+    parser.add_argument("ref_tree", help="reference (whole alignment) treefile")
+    parser.add_argument("tree_dir", help="directory with <seed>/ and fixedparams/<seed>/ tree directories")
+    parser.add_argument("-o", "--output", default="support.csv",
+                        help="per-split support table, .csv or .parquet (default: support.csv)")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="number of worker processes (default: 1)")
+    parser.add_argument("--tbe", action="store_true",
+                        help="add transfer bootstrap expectation from the .ufboot files written next to the treefiles")
+    args = parser.parse_args()
+
+    jobs = find_trees(args.tree_dir)
+    print("Comparing {} trees to {}...".format(len(jobs), args.ref_tree))
+    _ref_tree = load_tree(args.ref_tree)
+    _ref_splits = SplitIndex.from_flat(_ref_tree, taxon_order(_ref_tree.leaf_names()), outgroup)
+    if args.tbe:
+        _transfer_index = TransferIndex(_ref_tree)
+    _ref_tbe = node_tbe(args.ref_tree)
+
+    tables = []
+    if args.workers > 1:
+        ctx = multiprocessing.get_context("fork")
+        with ctx.Pool(args.workers) as pool:
+            for rows, summary in pool.imap_unordered(support_rows, jobs):
+                print(summary)
+                tables.append(pd.DataFrame(rows, columns=columns))
+    else:
+        for job in jobs:
+            rows, summary = support_rows(job)
+            print(summary)
+            tables.append(pd.DataFrame(rows, columns=columns))
+
+    df = pd.concat(tables, ignore_index=True) if tables else pd.DataFrame(columns=columns)
+    df = df.sort_values(["param_set", "seed", "mask", "split"], ignore_index=True)
+    write_table(df, args.output)
+    print("Done.")
+
+
+if __name__ == "__main__":
+    main()
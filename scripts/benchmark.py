@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import argparse
+import atexit
+import datetime
+import json
+import os
+import platform
+import re
+import resource
+import runpy
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+
+from instrument import peak_rss_kb
+
+# python benchmark.py --sizes 1000 10000 100000 --length 10000 -o ../results/benchmark.json
+# python benchmark.py --sizes 1000 3000 --stages shuffle_and_mask bootstrap_support --compare ../results/benchmark.json
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+stages = ["shuffle_and_mask", "mask_gp120", "fast_site_remover", "bootstrap_support"]
+# exit code of a stage that cannot run here (a missing dependency), as in automake's test harness
+SKIPPED = 77
+peak_re = re.compile(r"^peak_rss_kb (\d+)$", re.M)
+
+hxb2_id = "B.FR.83.HXB2_LAI_IIIB_BRU.K03455"
+outgroup_id = "K.CD.87.P3844.MH705156"
+synthetic_subtypes = ["A", "B", "C", "D", "F1", "F2", "G", "H", "J", "K"]
+hxb2_length = 9719
+# PRRT is HXB2 2253-3554; shuffle_and_mask.py checks that it translates to PQVTL...QGQG
+prrt_start, prrt_stop = 2252, 3554
+bases = np.frombuffer(b"ACGT", dtype=np.uint8)
+sense_codons = [a + b + c for a in "ACGT" for b in "ACGT" for c in "ACGT"
+                if a + b + c not in ("TAA", "TAG", "TGA")]
+
+
+def hxb2_like_row(n_cols, rng):
+    """
+    A gapped reference row whose ungapped sequence has HXB2's length (or n_cols, if shorter) and
+    a PRRT that translates like HXB2's, so the HXB2 coordinate lookups of the masking scripts work.
+    """
+    if n_cols < prrt_stop:
+        raise ValueError("alignments need at least {} columns to hold PRRT".format(prrt_stop))
+    n_bases = min(n_cols, hxb2_length)
+    seq = rng.choice(bases, n_bases)
+    n_codons = (prrt_stop - prrt_start) // 3
+    codons = ["CCT", "CAG", "GTC", "ACT", "CTT"]
+    codons += [sense_codons[i] for i in rng.integers(len(sense_codons), size=n_codons - 9)]
+    codons += ["CAG", "GGA", "CAG", "GGA"]
+    seq[prrt_start:prrt_stop] = np.frombuffer("".join(codons).encode(), dtype=np.uint8)
+    row = np.full(n_cols, ord("-"), dtype=np.uint8)
+    row[np.sort(rng.choice(n_cols, n_bases, replace=False))] = seq
+    return row
+
+
+def synthetic_ids(n_seqs, rng):
+    subtypes = rng.choice(synthetic_subtypes, n_seqs)
+    years = rng.integers(80, 118, size=n_seqs) % 100
+    ids = ["{}.US.{:02d}.S{}.SYN{:07d}".format(s, y, i, i) for i, (s, y) in enumerate(zip(subtypes, years))]
+    ids[0] = hxb2_id
+    ids[1] = outgroup_id
+    return ids
+
+
+def write_alignment(file_path, ids, n_cols, rng, block_rows=1024, substitution=0.08, gap=0.02, insertion=0.1):
+    """
+    Writes a fasta-2line alignment of rows derived from an HXB2-like reference by random substitutions,
+    gaps and insertions, a block of rows at a time so any size fits in memory.
+    """
+    ref = hxb2_like_row(n_cols, rng)
+    ref_gaps = ref == ord("-")
+    with open(file_path, "wb") as f:
+        for start in range(0, len(ids), block_rows):
+            n_rows = min(block_rows, len(ids) - start)
+            block = np.tile(ref, (n_rows, 1))
+            draw = rng.random(block.shape)
+            random_bases = rng.choice(bases, block.shape)
+            changed = np.where(ref_gaps, draw < insertion, draw < substitution)
+            block[changed] = random_bases[changed]
+            block[~ref_gaps & (draw > 1 - gap)] = ord("-")
+            if start == 0:
+                block[0] = ref
+            lines = np.empty((n_rows, n_cols + 1), dtype=np.uint8)
+            lines[:, :n_cols] = block
+            lines[:, n_cols] = ord("\n")
+            f.write(b"".join(b">" + ids[start + i].encode() + b"\n" + lines[i].tobytes() for i in range(n_rows)))
+
+
+def random_newick(names, seed):
+    """
+    A random unrooted binary tree in IQ-TREE's treefile format (SH-aLRT/UFBoot labels). The topology
+    depends only on seed and len(names), so the same seed with permuted names gives a tree that shares
+    every split the permutation leaves intact.
+    """
+    rng = np.random.default_rng(seed)
+    n = len(names)
+    items = list(names)
+    # pairs to join, drawn up front: the i-th join picks two of the n - i remaining subtrees
+    picks = rng.random((max(n - 3, 0), 2))
+    lengths = np.round(rng.exponential(0.02, size=2 * n), 5)
+    shalrt = np.round(rng.uniform(0, 100, size=n), 1)
+    ufboot = np.minimum(100, np.round(100 - rng.exponential(10, size=n))).astype(int)
+    for k in range(n - 3):
+        remaining = len(items)
+        i = int(picks[k, 0] * remaining)
+        j = int(picks[k, 1] * (remaining - 1))
+        j += j >= i
+        a, b = items[i], items[j]
+        for index in sorted((i, j), reverse=True):
+            items[index] = items[-1]
+            items.pop()
+        items.append("({}:{},{}:{}){}/{}".format(a, lengths[2 * k], b, lengths[2 * k + 1], shalrt[k], ufboot[k]))
+    return "(" + ",".join("{}:{}".format(item, lengths[-1 - i]) for i, item in enumerate(items)) + ");\n"
+
+
+def generate(work_dir, n_seqs, n_cols, perturb=0.1):
+    """
+    Synthetic alignment and reference/comparison trees for one size, reused if already generated.
+    """
+    prefix = os.path.join(work_dir, "synthetic_{}x{}".format(n_seqs, n_cols))
+    files = {"alignment": prefix + ".fa", "ref_tree": prefix + ".treefile", "tree": prefix + "_mask100.fa.treefile"}
+    if all(os.path.exists(f) for f in files.values()):
+        return files
+    rng = np.random.default_rng(n_seqs * 100003 + n_cols)
+    ids = synthetic_ids(n_seqs, rng)
+    write_alignment(files["alignment"], ids, n_cols, rng)
+    with open(files["ref_tree"], "w") as f:
+        f.write(random_newick(ids, n_seqs))
+    # the comparison tree moves a fraction of the tips, so some splits are shared and some are not
+    moved = rng.choice(n_seqs, int(perturb * n_seqs), replace=False)
+    permuted = list(ids)
+    for i, j in zip(moved, rng.permutation(moved)):
+        permuted[i] = ids[j]
+    with open(files["tree"], "w") as f:
+        f.write(random_newick(permuted, n_seqs))
+    return files
+
+
+def stage_command(stage, files, out_dir, args):
+    """
+    Every stage runs in its own process through --run-stage, which reports the process's peak memory.
+    """
+    if stage == "shuffle_and_mask":
+        stage_args = [files["alignment"], out_dir, "--n-seeds", str(args.seeds), "--masks", "10", "50", "100",
+                      "--workers", str(args.workers)]
+    elif stage == "mask_gp120":
+        stage_args = [files["alignment"], out_dir]
+    else:
+        stage_args = [files["alignment"], files["ref_tree"], files["tree"], out_dir]
+    return [sys.executable, os.path.abspath(__file__), "--run-stage", stage] + stage_args
+
+
+def report_peak_rss():
+    """
+    Prints the peak RSS of this process or of its largest worker.
+    """
+    peak = peak_rss_kb()
+    peak = max(peak, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    print("peak_rss_kb {}".format(peak), flush=True)
+
+
+def run_fast_site_remover(alignment, out_dir):
+    """
+    The site-removal steps of fast_site_remover.py on a random rate order (dist_est is not run).
+    """
+    try:
+        from fast_site_remover import write_fasta_step
+    except ImportError as e:
+        print("skipped: {}".format(e))
+        sys.exit(SKIPPED)
+    from alignment_matrix import AlignmentMatrix
+
+    matrix = AlignmentMatrix.from_fasta(alignment)
+    n_cols = matrix.shape[1]
+    ranked = matrix.seqs[:, np.random.default_rng(0).permutation(n_cols)]
+    step_size = max(1, n_cols // 10)
+    step_file = os.path.join(out_dir, "step.fas")
+    for step in range(step_size, n_cols, step_size):
+        with open(step_file, "wb") as res:
+            write_fasta_step(res, matrix.titles, ranked[:, step:])
+    os.remove(step_file)
+
+
+def run_bootstrap_support(ref_tree_file, tree_file):
+    """
+    The comparison part of bootstrap_support.py (tree parsing, split matching, clade annotation), without
+    rendering.
+    """
+    try:
+        import bootstrap_support
+    except ImportError as e:
+        print("skipped: {}".format(e))
+        sys.exit(SKIPPED)
+    from splits import SplitIndex, taxon_order
+
+    ref_tree = bootstrap_support.get_tree(ref_tree_file)
+    ref_splits = SplitIndex.from_tree(ref_tree, taxon_order(ref_tree.get_leaf_names()))
+    bootstrap_support.compare_to_ref(ref_tree_file, ref_splits, tree_file, 100, "Reference Bootstrap", "Bootstrap")
+    bootstrap_support.annotate_clades(ref_tree)
+
+
+def run_stage(stage, stage_args):
+    atexit.register(report_peak_rss)
+    if stage == "fast_site_remover":
+        alignment, _, _, out_dir = stage_args
+        run_fast_site_remover(alignment, out_dir)
+    elif stage == "bootstrap_support":
+        _, ref_tree_file, tree_file, _ = stage_args
+        run_bootstrap_support(ref_tree_file, tree_file)
+    else:
+        # the script itself, as if run from the command line
+        script = os.path.join(script_dir, stage + ".py")
+        sys.argv = [script] + stage_args
+        runpy.run_path(script, run_name="__main__")
+
+
+def measure(command, log_file, timeout):
+    """
+    Runs command, returning its status, wall time and peak RSS (MB) as the stage reported it.
+    """
+    start = time.time()
+    with open(log_file, "wb") as log:
+        process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, cwd=script_dir)
+    timer = threading.Timer(timeout, process.kill)
+    timer.start()
+    _, status, _ = os.wait4(process.pid, 0)
+    timer.cancel()
+    seconds = time.time() - start
+    # the pid has been reaped by wait4, so Popen must not wait for it again
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode == -signal.SIGKILL and seconds >= timeout:
+        result = "timeout"
+    elif process.returncode == SKIPPED:
+        result = "skipped"
+    elif process.returncode != 0:
+        result = "failed ({})".format(process.returncode)
+    else:
+        result = "ok"
+    with open(log_file) as log:
+        peaks = peak_re.findall(log.read())
+    return result, seconds, int(peaks[-1]) / 1024 if peaks else float("nan")
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=script_dir, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(results, previous_file):
+    """
+    Prints time and peak memory of each result relative to the same stage and size in a previous run.
+    """
+    with open(previous_file) as f:
+        previous = json.load(f)
+    old = {(r["stage"], r["n_seqs"], r["n_cols"]): r for r in previous["results"] if r["status"] == "ok"}
+    print("Relative to {} ({}):".format(previous_file, previous.get("commit")))
+    for r in results:
+        o = old.get((r["stage"], r["n_seqs"], r["n_cols"]))
+        if o is None or r["status"] != "ok":
+            continue
+        print("  {:<18} {:>7} x {:<6} time x{:.2f}  peak RSS x{:.2f}".format(
+            r["stage"], r["n_seqs"], r["n_cols"], r["seconds"] / o["seconds"], r["max_rss_mb"] / o["max_rss_mb"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Times the masking, site-removal and support-comparison stages on synthetic alignments "
+                    "and trees of growing size, recording wall time and peak memory as JSON"
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000], metavar="N_SEQS",
+                        help="numbers of sequences (and tree tips) (default: 1000 10000 100000)")
+    parser.add_argument("--length", type=int, nargs="+", default=[10000], metavar="N_COLS",
+                        help="alignment lengths (default: 10000)")
+    parser.add_argument("--stages", nargs="+", choices=stages, default=stages, help="stages to time (default: all)")
+    parser.add_argument("--seeds", type=int, default=2, help="shuffle_and_mask.py seeds per run (default: 2)")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="shuffle_and_mask.py workers (default: 1)")
+    parser.add_argument("--timeout", type=float, default=3600, help="seconds before a stage is stopped (default: 3600)")
+    parser.add_argument("--work-dir", default="benchmark_data",
+                        help="synthetic data, outputs and logs; data is reused between runs (default: benchmark_data)")
+    parser.add_argument("-o", "--output", default="benchmark.json", help="results (default: benchmark.json)")
+    parser.add_argument("--compare", help="earlier results to print relative times and memory against")
+    parser.add_argument("--run-stage", nargs=argparse.REMAINDER, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_stage:
+        run_stage(args.run_stage[0], args.run_stage[1:])
+        return
+
+    os.makedirs(args.work_dir, exist_ok=True)
+    work_dir = os.path.abspath(args.work_dir)
+    results = []
+    for n_cols in args.length:
+        for n_seqs in args.sizes:
+            print("Generating {} sequences x {} columns...".format(n_seqs, n_cols))
+            start = time.time()
+            files = generate(work_dir, n_seqs, n_cols)
+            print("  ({:.1f}s)".format(time.time() - start))
+            for stage in args.stages:
+                out_dir = os.path.join(work_dir, "{}_{}x{}".format(stage, n_seqs, n_cols))
+                os.makedirs(out_dir, exist_ok=True)
+                status, seconds, max_rss_mb = measure(stage_command(stage, files, out_dir, args),
+                                                      out_dir + ".log", args.timeout)
+                print("  {:<18} {:<10} {:9.2f}s {:9.1f} MB".format(stage, status, seconds, max_rss_mb))
+                results.append({"stage": stage, "n_seqs": n_seqs, "n_cols": n_cols, "status": status,
+                                "seconds": round(seconds, 3), "max_rss_mb": round(max_rss_mb, 1)})
+
+    with open(args.output, "w") as f:
+        json.dump({
+            "commit": git_commit(),
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "results": results,
+        }, f, indent=1)
+    if args.compare:
+        compare_results(results, args.compare)
+    print("Done.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import argparse
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+from batch_support import find_trees
+from splits import taxon_order
+from tables import write_table
+from treecache import load_tree
+
+# python bootstrap_clusters.py ../results/trees/HIV1_FLT_2018_genome_DNA_subtypeB.fa.treefile ../results/trees -o ../results/cluster_accuracy.csv --workers 8
+
+thresholds = (70, 80, 85, 90, 95, 99)
+columns = ["param_set", "seed", "mask", "bootstrap", "clusters", "tp", "fp", "fn", "tn", "precision", "recall"]
+
+# set in the parent before the pool forks so workers share them copy-on-write
+_ref_clusters = None
+_taxa = None
+_thresholds = None
+
+
+def bootstrap_clusters(tree, taxa, thresholds=thresholds):
+    """
+    Clusters of a treecache.FlatTree as R/cluster.R defines them: maximal clades whose internal
+    nodes all have UFBoot >= threshold. Returns {threshold: {tip bitset: node index}}.
+
+    A node is a cluster for every threshold above the lowest support in its parent's subtree
+    and at most the lowest support in its own, so one postorder pass covers all thresholds.
+    """
+    parent = tree.parent.tolist()
+    tip = tree.tip.tolist()
+    tip_bits = [1 << taxa[name] if name in taxa else 0 for name in tree.tip_names]
+    # nodes without support never qualify, tips never constrain their parent
+    lowest = np.where(tree.is_leaf, np.inf, np.nan_to_num(tree.ufboot, nan=-np.inf)).tolist()
+    bits = [0] * len(parent)
+    # nodes are in preorder, so walking indexes backwards visits children before parents
+    for i in range(len(parent) - 1, -1, -1):
+        if tip[i] >= 0:
+            bits[i] = tip_bits[tip[i]]
+        p = parent[i]
+        if p >= 0:
+            bits[p] |= bits[i]
+            if lowest[i] < lowest[p]:
+                lowest[p] = lowest[i]
+
+    clusters = {threshold: {} for threshold in thresholds}
+    for i in range(len(parent)):
+        if tip[i] >= 0:
+            continue
+        above = lowest[parent[i]] if parent[i] >= 0 else -np.inf
+        for threshold in thresholds:
+            if above < threshold <= lowest[i]:
+                clusters[threshold][bits[i]] = i
+    return clusters
+
+
+def cluster_accuracy(clusters, ref_clusters, n_tips):
+    """
+    TP/FP/FN/TN of a tree's clusters against the reference tree's clusters, per threshold,
+    as in R/cluster_accuracy.R (every internal node of an unrooted binary tree is a possible cluster).
+    """
+    rows = []
+    for threshold, tree_clusters in clusters.items():
+        ref = ref_clusters[threshold]
+        tp = len(tree_clusters.keys() & ref.keys())
+        fp = len(tree_clusters) - tp
+        fn = len(ref) - tp
+        rows.append({
+            "bootstrap": threshold,
+            "clusters": len(tree_clusters),
+            "tp": tp,
+            "fp": fp,
+            "fn": fn,
+            "tn": n_tips - 2 - fn,
+            "precision": tp / (tp + fp) if tp + fp else np.nan,
+            "recall": tp / (tp + fn) if tp + fn else np.nan,
+        })
+    return rows
+
+
+def accuracy_rows(job):
+    param_set, seed, mask, tree_file = job
+    clusters = bootstrap_clusters(load_tree(tree_file), _taxa, _thresholds)
+    rows = cluster_accuracy(clusters, _ref_clusters, len(_taxa))
+    for row in rows:
+        row.update(param_set=param_set, seed=seed, mask=mask)
+    return rows
+
+
+def main():
+    global _ref_clusters, _taxa, _thresholds
+    parser = argparse.ArgumentParser(
+        description="Bootstrap-threshold clusters of every seed/mask/parameter-set tree and their "
+                    "accuracy against the clusters of a reference tree"
+    )
+    parser.add_argument("ref_tree", help="reference (whole genome) treefile")
+    parser.add_argument("tree_dir", help="directory with <seed>/ and fixedparams/<seed>/ tree directories")
+    parser.add_argument("-o", "--output", default="cluster_accuracy.csv",
+                        help="accuracy table, .csv or .parquet (default: cluster_accuracy.csv)")
+    parser.add_argument("-t", "--thresholds", nargs="+", type=float, default=list(thresholds), metavar="UFBOOT",
+                        help="UFBoot thresholds (default: {})".format(" ".join(str(t) for t in thresholds)))
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="number of worker processes (default: 1)")
+    args = parser.parse_args()
+
+    jobs = find_trees(args.tree_dir)
+    print("Clustering {} trees against {}...".format(len(jobs), args.ref_tree))
+    ref_tree = load_tree(args.ref_tree)
+    _taxa = taxon_order(ref_tree.leaf_names())
+    _thresholds = args.thresholds
+    _ref_clusters = bootstrap_clusters(ref_tree, _taxa, _thresholds)
+    for threshold in _thresholds:
+        print("{} reference clusters at UFBoot >= {:g}".format(len(_ref_clusters[threshold]), threshold))
+
+    rows = []
+    if args.workers > 1:
+        ctx = multiprocessing.get_context("fork")
+        with ctx.Pool(args.workers) as pool:
+            for tree_rows in pool.imap_unordered(accuracy_rows, jobs, chunksize=16):
+                rows.extend(tree_rows)
+    else:
+        for job in jobs:
+            rows.extend(accuracy_rows(job))
+
+    df = pd.DataFrame(rows, columns=columns)
+    df = df.sort_values(["param_set", "seed", "mask", "bootstrap"], ignore_index=True)
+    write_table(df, args.output)
+    print("Done.")
+
+
+if __name__ == "__main__":
+    main()
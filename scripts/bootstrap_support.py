@@ -1,20 +1,73 @@
 #!/usr/bin/env python
+import argparse
+import functools
+import hashlib
+import inspect
+import json
+import multiprocessing
 import os
 import re
 import sys
 from collections import defaultdict
 from glob import glob
 
-import pandas as pd
-import matplotlib as mpl
-import matplotlib.pyplot as plt
 import numpy as np
-from ete3 import BarChartFace, NodeStyle, RectFace, TextFace, Tree, TreeStyle
-from ete3.treeview.faces import add_face_to_node
+
+from instrument import stage
+from splits import SplitIndex, compare_splits, taxon_order
+from treecache import file_sha256
+from treecache import load_tree as load_flat_tree
+
+# ete3 (which loads Qt), matplotlib and pandas are imported by the functions that draw or read
+# bootstrap trees, so --stats-only and modules importing this one never load them
 
 os.environ["QT_QPA_PLATFORM"] = "offscreen"
 outgroup = "K.CD.87.P3844.MH705156"
 bootstrap_cutoff = 95
+# transfer bootstrap is usually read at a lower threshold than UFBoot
+tbe_cutoff = 70
+mask_regex = r"mask(\d+)"
+
+# Make some colors
+subtypes = ["A", "B", "C", "D", "F1", "F2", "G", "H", "J", "K"]
+# matplotlib's tab10
+tab10_colors = ["#1f77b4", "#ff7f0e", "#2ca02c", "#d62728", "#9467bd", "#8c564b", "#e377c2", "#7f7f7f", "#bcbd22", "#17becf"]
+subtype_color_dict = dict(zip(subtypes, tab10_colors))
+quadrants = {"↗": "top-right", "↘": "bottom-right", "↖": "top-left", "↙": "bottom-left"}
+stats_columns = ["comparison", "ref_tree", "tree", "pct_mask", "common_edges", "ref_edges", "norm_rf", "shared_supported"] + \
+                ["pct_" + quadrant.replace("-", "_") for quadrant in quadrants.values()]
+
+# Every comparison gen_plots.sh makes; the name is the plot prefix
+comparisons = {
+    "whole_v_masked": {
+        "ref_tree_file": "trees/HIV1_FLT_2018_genome_DNA.fa.treefile",
+        "tree_files": ["trees/HIV1_FLT_2018_genome_DNA_mask100.fa.treefile"],
+        "ref_bs_label": "Whole Alignment Bootstrap",
+        "tree_bs_label": "Masked Alignment Bootstrap",
+        "tree_orientation": 0,
+        "pct_masks": [0],
+    },
+    "whole_v_allmasks": {
+        "ref_tree_file": "trees/HIV1_FLT_2018_genome_DNA.fa.treefile",
+        "tree_files": ["trees/HIV1_FLT_2018_genome_DNA_mask*.fa.treefile"],
+        "ref_bs_label": "Whole Alignment Bootstrap",
+        "tree_bs_label": "Masked Alignment Bootstrap",
+        "tree_orientation": 0,
+        "pct_masks": [0],
+    },
+    "masked_v_whole": {
+        "ref_tree_file": "trees/HIV1_FLT_2018_genome_DNA_mask100.fa.treefile",
+        "tree_files": ["trees/HIV1_FLT_2018_genome_DNA.fa.treefile"],
+        "ref_bs_label": "Masked Alignment Bootstrap",
+        "tree_bs_label": "Whole Alignment Bootstrap",
+        "tree_orientation": 1,
+        "pct_masks": [100],
+    },
+}
+fingerprint_file = "plots/.fingerprints.json"
+
+# set in the parent before the render pool forks so workers share them copy-on-write
+_render_jobs = []
 
 
 def add_support_and_subtypes(tree):
@@ -46,54 +99,105 @@ def get_support_symbol(ref_aln_bstrap, comp_aln_bstrap):
         return "↙"
 
 
-ref_tree_file = "trees/HIV1_FLT_2018_genome_DNA.fa.treefile"
-plot_prefix = "whole_v_masked"
-ref_bs_label = "Whole Alignment Bootstrap"
-tree_bs_label = "Masked Alignment Bootstrap"
-tree_file_list = ["trees/HIV1_FLT_2018_genome_DNA_mask100.fa.treefile"]
-tree_orientation = 0
-pct_masks = [0]
+def set_outgroup(tree, outgroup_name):
+    """
+    Roots tree on the outgroup's edge, keeping each support label on the edge IQ-TREE put it on.
+    ete3's set_outgroup reverses the edges from the root to the outgroup but leaves each label (the
+    node name) on its node, so each of those nodes takes the label of its old child on the path.
+    """
+    path = (tree & outgroup_name).get_ancestors()[:-1]
+    labels = [node.name for node in path]
+    root_children = {id(child) for child in tree.children}
+    path_children = {id(child) for child in path[-1].children} if path else set()
+    tree.set_outgroup(outgroup_name)
+    if not path:
+        return
+    # the outgroup's old parent now sits on the outgroup's own edge, which has no support
+    for node, label in zip(path, [""] + labels[:-1]):
+        node.name = label
+    # set_outgroup groups the other children of a multifurcating root under a new node on the edge
+    # that was above the path's top node
+    for child in path[-1].children:
+        if id(child) not in path_children and id(child) not in root_children:
+            child.name = labels[-1]
+
+
+def load_tree(tree_file):
+    from ete3 import Tree
 
-if "--all" in sys.argv:
-    tree_file_list = [
-        t for t in glob("trees/HIV1_FLT_2018_genome_DNA_mask*.fa.treefile")
-    ]
-    plot_prefix = "whole_v_allmasks"
-if "--mask-as-ref" in sys.argv:
-    tree_file_list = [ref_tree_file]
-    ref_tree_file = "trees/HIV1_FLT_2018_genome_DNA_mask100.fa.treefile"
-    plot_prefix = "masked_v_whole"
-    ref_bs_label = "Masked Alignment Bootstrap"
-    tree_bs_label = "Whole Alignment Bootstrap"
-    pct_masks = [100]
-    tree_orientation = 1
+    tree = Tree(tree_file, format=1)
+    set_outgroup(tree, outgroup)
+    add_support_and_subtypes(tree)
+    return tree
 
 
-ref_tree = Tree(ref_tree_file, format=1)
-ref_tree.set_outgroup(outgroup)
-add_support_and_subtypes(ref_tree)
+@functools.lru_cache(maxsize=None)
+def get_tree(tree_file):
+    """
+    Each treefile is parsed once per run, however many comparisons use it.
+    """
+    return load_tree(tree_file)
+
+
+def reset_support(tree):
+    """
+    Clears the comparison annotations compare_to_ref leaves on a reference tree.
+    """
+    for node in tree.traverse():
+        if hasattr(node, "bootstrap"):
+            node.barchart_values = defaultdict(lambda: 0)
+            node.suport_symbol = ""
 
-mask_regex = r"mask(\d+)"
 
-shared_edge_support_values = []
-ref_only_edge_support_values = []
-for tree_file in tree_file_list:
-    pct_mask_match = re.search(r"mask(\d+)", tree_file)
+def get_pct_mask(tree_file):
+    pct_mask_match = re.search(mask_regex, tree_file)
     if pct_mask_match is not None:
-        pct_mask = int(pct_mask_match.groups()[0])
-    else:
-        pct_mask = 0
+        return int(pct_mask_match.groups()[0])
+    return 0
+
+
+def tbe_label(bs_label):
+    return bs_label.replace("Bootstrap", "TBE")
+
+
+def reference_tbe(ref_tree_file, ref_splits, replicate_tree_files):
+    """
+    TBE (in percent) of every reference tree node in the bootstrap trees of each of replicate_tree_files,
+    as {tree file: {reference node: TBE}}, or None unless every tree has its .ufboot file.
+    """
+    from tbe import TransferIndex, ufboot_file
+    from ufboot_splits import read_newicks
+
+    if not all(os.path.exists(ufboot_file(f)) for f in replicate_tree_files):
+        return None
+    flat_ref = load_flat_tree(ref_tree_file)
+    flat_splits = SplitIndex.from_flat(flat_ref, ref_splits.taxa, outgroup)
+    # the same clades, keyed the same way, in both representations of the reference
+    flat_nodes = {node: flat_splits[b] for b, node in ref_splits.clades.items() if b in flat_splits}
+    index = TransferIndex(flat_ref)
+    tbe = {}
+    for tree_file in replicate_tree_files:
+        print("Computing TBE from {}...".format(ufboot_file(tree_file)))
+        values = np.full(len(flat_ref), np.nan)
+        values[index.nodes] = 100 * index.tbe(read_newicks(ufboot_file(tree_file)))
+        tbe[tree_file] = {node: values[i] for node, i in flat_nodes.items()}
+    return tbe
+
+
+def compare_to_ref(ref_tree_file, ref_splits, tree_file, pct_mask, ref_bs_label, tree_bs_label, ref_tbe=None, tree_tbe=None):
+    """
+    Adds bootstrap values from tree_file onto the reference tree's nodes, returning the support
+    values of shared edges and of edges only found in the reference.
+    With ref_tbe and tree_tbe ({reference node: TBE}) shared edges carry their TBE too.
+    """
+    shared_edge_support_values = []
+    ref_only_edge_support_values = []
     print("Adding {} bootstrap values to tree from {}...".format(tree_file, ref_tree_file))
-    pct_masks.append(pct_mask)
-    tree = Tree(tree_file, format=1)
-    add_support_and_subtypes(tree)
-    tree.set_outgroup(outgroup)
-    comparison = ref_tree.compare(tree)
-    print("{}/{} common/total edges, normRF {:0.2f} for {} vs {}".format(len(comparison["common_edges"]), len(comparison["source_edges"]), comparison["norm_rf"], tree_file, ref_tree_file ))
-    for common_edge in comparison["common_edges"]:
-        tree_node = tree.get_common_ancestor(common_edge)
+    tree = get_tree(tree_file)
+    comparison = compare_splits(ref_splits, SplitIndex.from_tree(tree, ref_splits.taxa))
+    print("{}/{} common/total edges, normRF {:0.2f} for {} vs {}".format(len(comparison["common"]), comparison["ref_edges"], comparison["norm_rf"], tree_file, ref_tree_file ))
+    for ref_tree_node, tree_node in comparison["common"]:
         if hasattr(tree_node, "bootstrap"):
-            ref_tree_node = ref_tree.get_common_ancestor(common_edge)
             ref_tree_node.barchart_values[pct_mask] = tree_node.bootstrap
             ref_tree_node.barchart_values[0] = ref_tree_node.bootstrap
             ref_tree_node.suport_symbol = get_support_symbol(
@@ -106,29 +210,38 @@ for tree_file in tree_file_list:
                     "Percent Mask": pct_mask,
                 }
             )
-    for ref_only_edge in comparison["ref_edges"] - comparison["common_edges"]:
-        node = ref_tree.get_common_ancestor(ref_only_edge)
+            if ref_tbe is not None:
+                shared_edge_support_values[-1][tbe_label(ref_bs_label)] = ref_tbe.get(ref_tree_node, np.nan)
+                shared_edge_support_values[-1][tbe_label(tree_bs_label)] = tree_tbe.get(ref_tree_node, np.nan)
+    for node in comparison["ref_only"]:
         if hasattr(node, "bootstrap"):
             ref_only_edge_support_values.append(node.bootstrap)
 
     print("Done.")
+    return shared_edge_support_values, ref_only_edge_support_values
 
 
-# Make some colors
-
-subtypes = ["A", "B", "C", "D", "F1", "F2", "G", "H", "J", "K"]
-tab10_cmap = mpl.cm.get_cmap("tab10")
-subtype_color_dict = dict(zip(subtypes, [mpl.colors.to_hex(x) for x in tab10_cmap(np.linspace(0,1,10))] ))
+def annotate_clades(tree):
+    """
+    One postorder pass setting each node's clade_subtype (the subtype of all its leaves, None if
+    they are mixed) and n_leaves, so layout functions never walk a node's leaves.
+    """
+    for node in tree.traverse("postorder"):
+        if node.is_leaf():
+            node.add_features(clade_subtype=node.subtype, n_leaves=1)
+        else:
+            clade_subtypes = set(child.clade_subtype for child in node.children)
+            node.add_features(
+                clade_subtype=clade_subtypes.pop() if len(clade_subtypes) == 1 else None,
+                n_leaves=sum(child.n_leaves for child in node.children),
+            )
 
-color_map = mpl.cm.get_cmap("cividis")
-plot_colors = color_map([x / 100 for x in reversed(sorted(pct_masks))])
-tree_colors = [mpl.colors.to_hex(x) for x in plot_colors]
-scatter_colors = plot_colors
 
 # plot trees
 # color monophyletic subtypes
-print("Plotting trees...")
 def color_subtypes(node):
+    from ete3 import NodeStyle
+
     node_style = NodeStyle()
     node_style["hz_line_width"] = 2
     node_style["vt_line_width"] = 2
@@ -140,25 +253,21 @@ def color_subtypes(node):
             node_style["fgcolor"] = "grey"
     else:
         node_style["fgcolor"] = "black"
-    
+
     if hasattr(node, "subtype") and node.subtype in subtype_color_dict:
         node_style["hz_line_color"] = subtype_color_dict[node.subtype]
-    else:
-        # check for subtype monophyly and color if true
-        subtypes = set()
-        for leaf in node.get_leaves():
-            subtypes.add(leaf.subtype)
-            if len(subtypes) > 1:
-                break
-        subtype = subtypes.pop()
-        if len(subtypes) == 0 and subtype in subtype_color_dict:
-            node_style["vt_line_color"] = subtype_color_dict[subtype]
-            node_style["hz_line_color"] = subtype_color_dict[subtype]
+    elif node.clade_subtype in subtype_color_dict:
+        # subtype is monophyletic below this node
+        node_style["vt_line_color"] = subtype_color_dict[node.clade_subtype]
+        node_style["hz_line_color"] = subtype_color_dict[node.clade_subtype]
     return node_style
 
-# add an arrow symbol pointing to the quadrant 
+# add an arrow symbol pointing to the quadrant
 # this bootstrap comparison belongs in in scatter below
 def botstrap_symbols(node):
+    from ete3 import TextFace
+    from ete3.treeview.faces import add_face_to_node
+
     node_style = color_subtypes(node)
     if hasattr(node, "suport_symbol"):
         add_face_to_node(
@@ -169,7 +278,7 @@ def botstrap_symbols(node):
     node.set_style(node_style)
 
 # call larger attention to lower right quadrant from scatter
-# 
+#
 def botstrap_lower_right(node):
     node_style = color_subtypes(node)
     if hasattr(node, "suport_symbol"):
@@ -180,7 +289,19 @@ def botstrap_lower_right(node):
     node.set_style(node_style)
 
 
-for output_string, mode, layout_fn in zip(["tree_symbols", "tree_symbols", "tree_arrows",], ["c", "r", "r"], [botstrap_lower_right, botstrap_lower_right, botstrap_symbols]):
+# (output name, mode, layout function) of every tree figure
+tree_figures = [
+    ("tree_symbols", "c", botstrap_lower_right),
+    ("tree_symbols", "r", botstrap_lower_right),
+    ("tree_arrows", "r", botstrap_symbols),
+]
+
+
+def render_tree(ref_tree, file_name, tree_orientation, mode, layout_fn):
+    from ete3 import RectFace, TextFace, TreeStyle
+
+    if not hasattr(ref_tree, "clade_subtype"):
+        annotate_clades(ref_tree)
     stars_style = TreeStyle()
     stars_style.layout_fn = layout_fn
     stars_style.orientation = tree_orientation
@@ -189,92 +310,337 @@ for output_string, mode, layout_fn in zip(["tree_symbols", "tree_symbols", "tree
         stars_style.legend.add_face(RectFace(10,10, subtype_color_dict[subtype], subtype_color_dict[subtype]),column=0)
         stars_style.legend.add_face(TextFace(subtype, fgcolor=subtype_color_dict[subtype], bold=True),column=1)
     stars_style.legend_position = 2
-    ref_tree.render(
-        file_name="plots/{}_{}_{}.pdf".format(plot_prefix, output_string, mode), tree_style=stars_style
+    ref_tree.render(file_name=file_name, tree_style=stars_style)
+
+
+def plot_scatter(shared_edge_df, plot_prefix, ref_bs_label, tree_bs_label, scatter_colors, cutoff=bootstrap_cutoff, kind="bootstrap"):
+    import matplotlib.pyplot as plt
+
+    # "top-right" of scatter plot
+    high_support_df = shared_edge_df[
+        (shared_edge_df[ref_bs_label] >= cutoff)
+        & (shared_edge_df[tree_bs_label] >= cutoff)
+    ]
+    # "bottom-right" of scatter plot
+    ref_aln_support_df = shared_edge_df[
+        (shared_edge_df[ref_bs_label] >= cutoff)
+        & (shared_edge_df[tree_bs_label] < cutoff)
+    ]
+    # "top-left" of scatter plot
+    other_aln_support_df = shared_edge_df[
+        (shared_edge_df[ref_bs_label] < cutoff)
+        & (shared_edge_df[tree_bs_label] >= cutoff)
+    ]
+    # "bottom-left" of scatter plot
+    low_support_df = shared_edge_df[
+        (shared_edge_df[ref_bs_label] < cutoff)
+        & (shared_edge_df[tree_bs_label] < cutoff)
+    ]
+
+    # scatter plot
+    print("Plotting scatter...")
+    fig, ax = plt.subplots(dpi=300)
+    ax.set_facecolor("gainsboro")
+    xlabel = ref_bs_label
+    ylabel = tree_bs_label
+    scatter_pcts = shared_edge_df["Percent Mask"].unique()
+    scatter_pcts.sort()
+    for pct, color in zip(reversed(scatter_pcts), reversed(scatter_colors)):
+        pct_df = shared_edge_df[shared_edge_df["Percent Mask"] == pct]
+        ax.scatter(
+            pct_df[xlabel],
+            pct_df[ylabel],
+            color=color,
+            label="{}% masked".format(pct),
+            alpha=0.4,
+            edgecolors="none",
+        )
+    line_styles = {"color": "black", "linestyle": "--"}
+    ax.axvline(cutoff, **line_styles)
+    ax.axhline(cutoff, **line_styles)
+
+    top_right_pct_nodes = high_support_df.shape[0] / shared_edge_df.shape[0] * 100
+    bottom_right_pct_nodes = ref_aln_support_df.shape[0] / shared_edge_df.shape[0] * 100
+    top_left_pct_nodes = other_aln_support_df.shape[0] / shared_edge_df.shape[0] * 100
+    bottom_left_pct_nodes = low_support_df.shape[0] / shared_edge_df.shape[0] * 100
+    ax.text(
+        101, cutoff + 2, "{:.1f}%".format(top_right_pct_nodes)
     )
-print("Done.")
-
-# dataframe for bootstrap values plotting
-shared_edge_df = pd.DataFrame(shared_edge_support_values)
-# "top-right" of scatter plot
-high_support_df = shared_edge_df[
-    (shared_edge_df[ref_bs_label] >= bootstrap_cutoff)
-    & (shared_edge_df[tree_bs_label] >= bootstrap_cutoff)
-]
-# "bottom-right" of scatter plot
-ref_aln_support_df = shared_edge_df[
-    (shared_edge_df[ref_bs_label] >= bootstrap_cutoff)
-    & (shared_edge_df[tree_bs_label] < bootstrap_cutoff)
-]
-# "top-left" of scatter plot
-other_aln_support_df = shared_edge_df[
-    (shared_edge_df[ref_bs_label] < bootstrap_cutoff)
-    & (shared_edge_df[tree_bs_label] >= bootstrap_cutoff)
-]
-# "bottom-left" of scatter plot
-low_support_df = shared_edge_df[
-    (shared_edge_df[ref_bs_label] < bootstrap_cutoff)
-    & (shared_edge_df[tree_bs_label] < bootstrap_cutoff)
-]
+    ax.text(cutoff + 2, 2, "{:.1f}%".format(bottom_right_pct_nodes))
+    ax.text(2, cutoff + 2, "{:.1f}%".format(top_left_pct_nodes))
+    ax.text(2, 2, "{:.1f}%".format(bottom_left_pct_nodes))
+
+    ax.set_xlim([0, 102])
+    ax.set_xlabel(xlabel)
+    ax.set_ylim([0, 102])
+    ax.set_ylabel(ylabel)
+    if len(scatter_pcts) >1:
+        plt.legend(bbox_to_anchor=(1.05, 1), loc="upper left", borderaxespad=0.0)
+    plt.tight_layout()
+    plt.savefig("plots/{}_{}_scatter.png".format(plot_prefix, kind))
+    plt.close()
+    print("Done.")
 
-# scatter plot
-print("Plotting scatter...")
-fig, ax = plt.subplots(dpi=300)
-ax.set_facecolor("gainsboro")
-xlabel = ref_bs_label
-ylabel = tree_bs_label
-scatter_pcts = shared_edge_df["Percent Mask"].unique()
-scatter_pcts.sort()
-for pct, color in zip(reversed(scatter_pcts), reversed(scatter_colors)):
-    pct_df = shared_edge_df[shared_edge_df["Percent Mask"] == pct]
-    ax.scatter(
-        pct_df[xlabel],
-        pct_df[ylabel],
-        color=color,
-        label="{}% masked".format(pct),
-        alpha=0.4,
-        edgecolors="none",
+
+def plot_hist(ref_only_edge_support_values, plot_prefix, xlabel):
+    import matplotlib.pyplot as plt
+
+    print("Plotting histogram...")
+    fig, ax = plt.subplots(dpi=300)
+    ax.hist(ref_only_edge_support_values, bins=np.arange(10,105,5))
+    ax.set_xlabel("{}".format(xlabel))
+    plt.tight_layout()
+    plt.savefig("plots/{}_bootstrap_hist.png".format(plot_prefix))
+    print("Done.")
+
+
+def run_comparison(name, with_tbe=False):
+    """
+    Compares the trees of one entry of comparisons to its reference tree, annotating the reference
+    tree's nodes with support symbols. Returns the shared and reference-only support values,
+    with TBE added to the shared values if with_tbe and every tree has its bootstrap trees.
+    """
+    spec = comparisons[name]
+    ref_tree = get_tree(spec["ref_tree_file"])
+    reset_support(ref_tree)
+    ref_splits = SplitIndex.from_tree(ref_tree, taxon_order(ref_tree.get_leaf_names()))
+
+    shared_edge_support_values = []
+    ref_only_edge_support_values = []
+    pct_masks = list(spec["pct_masks"])
+    tree_files = comparison_tree_files(spec)
+    tbe = reference_tbe(spec["ref_tree_file"], ref_splits, [spec["ref_tree_file"]] + tree_files) if with_tbe else None
+    for tree_file in tree_files:
+        pct_mask = get_pct_mask(tree_file)
+        pct_masks.append(pct_mask)
+        with stage("compare_tree", comparison=name, mask=pct_mask) as record:
+            shared, ref_only = compare_to_ref(spec["ref_tree_file"], ref_splits, tree_file, pct_mask,
+                                              spec["ref_bs_label"], spec["tree_bs_label"],
+                                              tbe and tbe[spec["ref_tree_file"]], tbe and tbe[tree_file])
+            record["items"] = len(shared) + len(ref_only)
+        shared_edge_support_values.extend(shared)
+        ref_only_edge_support_values.extend(ref_only)
+    return shared_edge_support_values, ref_only_edge_support_values, pct_masks
+
+
+def comparison_tree_files(spec):
+    return [t for pattern in spec["tree_files"] for t in sorted(glob(pattern))]
+
+
+def comparison_stats(name):
+    """
+    The numbers run_comparison prints and plot_scatter draws (common/total edges, normRF and the percent
+    of shared supported edges in each quadrant), one row per tree of a comparison, from the flat tree
+    cache and without ete3 or any plotting.
+    """
+    spec = comparisons[name]
+    ref_tree = load_flat_tree(spec["ref_tree_file"])
+    ref_splits = SplitIndex.from_flat(ref_tree, taxon_order(ref_tree.leaf_names()), outgroup)
+    rows = []
+    for tree_file in comparison_tree_files(spec):
+        with stage("compare_tree", comparison=name, mask=get_pct_mask(tree_file)) as record:
+            tree = load_flat_tree(tree_file)
+            comparison = compare_splits(ref_splits, SplitIndex.from_flat(tree, ref_splits.taxa, outgroup))
+            counts = dict.fromkeys(quadrants.values(), 0)
+            for ref_node, node in comparison["common"]:
+                ref_bootstrap, bootstrap = float(ref_tree.ufboot[ref_node]), float(tree.ufboot[node])
+                if not np.isnan(ref_bootstrap) and not np.isnan(bootstrap):
+                    counts[quadrants[get_support_symbol(ref_bootstrap, bootstrap)]] += 1
+            n_shared = sum(counts.values())
+            row = [name, spec["ref_tree_file"], tree_file, get_pct_mask(tree_file), len(comparison["common"]),
+                   comparison["ref_edges"], comparison["norm_rf"], n_shared]
+            rows.append(row + [100 * n / n_shared if n_shared else np.nan for n in counts.values()])
+            record["items"] = len(comparison["common"]) + len(comparison["ref_only"])
+        print("{}/{} common/total edges, normRF {:0.2f} for {} vs {}".format(
+            len(comparison["common"]), comparison["ref_edges"], comparison["norm_rf"], tree_file, spec["ref_tree_file"]))
+    return rows
+
+
+@functools.lru_cache(maxsize=None)
+def tree_sha256(tree_file):
+    return file_sha256(tree_file)
+
+
+def figure_fingerprint(name, figure, draw_fns, with_tbe=False):
+    """
+    Hash of everything a figure is drawn from: the comparison's trees (and bootstrap trees for
+    TBE figures) and settings, the plotting constants, the source of the code that computes the
+    plotted values and the source of the functions that draw it.
+    """
+    import splits
+    import tbe
+
+    spec = comparisons[name]
+    tree_files = [spec["ref_tree_file"]] + comparison_tree_files(spec)
+    if with_tbe:
+        tree_files += [tbe.ufboot_file(f) for f in tree_files]
+    settings = [name, figure, spec, outgroup, bootstrap_cutoff, tbe_cutoff, subtype_color_dict]
+    digest = hashlib.sha256(json.dumps(settings, sort_keys=True).encode())
+    for tree_file in tree_files:
+        digest.update("{} {}".format(tree_file, tree_sha256(tree_file)).encode())
+    value_code = [set_outgroup, load_tree, add_support_and_subtypes, get_support_symbol, run_comparison, compare_to_ref,
+                  annotate_clades, splits] + ([tbe] if with_tbe else [])
+    for code in value_code + list(draw_fns):
+        digest.update(inspect.getsource(code).encode())
+    return digest.hexdigest()
+
+
+def read_fingerprints():
+    try:
+        with open(fingerprint_file) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def write_fingerprints(fingerprints):
+    tmp = "{}.{}.tmp".format(fingerprint_file, os.getpid())
+    with open(tmp, "w") as f:
+        json.dump(fingerprints, f, indent=1, sort_keys=True)
+    os.replace(tmp, fingerprint_file)
+
+
+def plan_renders(name, with_tbe=False):
+    """
+    (file name, fingerprint, figure) of every figure of a comparison.
+    """
+    plans = []
+    for output_string, mode, layout_fn in tree_figures:
+        file_name = "plots/{}_{}_{}.pdf".format(name, output_string, mode)
+        draw_fns = [render_tree, layout_fn, color_subtypes, annotate_clades]
+        plans.append((file_name, figure_fingerprint(name, file_name, draw_fns), ("tree", mode, layout_fn)))
+    for kind, draw_fn in (("scatter", plot_scatter), ("hist", plot_hist)):
+        file_name = "plots/{}_bootstrap_{}.png".format(name, kind)
+        plans.append((file_name, figure_fingerprint(name, file_name, [draw_fn]), (kind,)))
+    if with_tbe:
+        file_name = "plots/{}_tbe_scatter.png".format(name)
+        plans.append((file_name, figure_fingerprint(name, file_name, [plot_scatter, reference_tbe], True), ("tbe",)))
+    return plans
+
+
+def render_job(i):
+    """
+    Draws one figure of _render_jobs; runs in a pool worker or in the parent.
+    """
+    import matplotlib as mpl
+    import matplotlib.pyplot as plt
+    import pandas as pd
+
+    name, file_name, fingerprint, figure, symbols, shared, ref_only, pct_masks = _render_jobs[i]
+    spec = comparisons[name]
+    with stage("render", comparison=name, figure=file_name):
+        if figure[0] == "tree":
+            ref_tree = get_tree(spec["ref_tree_file"])
+            # the reference tree may have been annotated by a later comparison since
+            for node, symbol in symbols.items():
+                node.suport_symbol = symbol
+            _, mode, layout_fn = figure
+            render_tree(ref_tree, file_name, spec["tree_orientation"], mode, layout_fn)
+        elif figure[0] == "scatter":
+            color_map = mpl.cm.get_cmap("cividis")
+            scatter_colors = color_map([x / 100 for x in reversed(sorted(pct_masks))])
+            plot_scatter(pd.DataFrame(shared), name, spec["ref_bs_label"], spec["tree_bs_label"], scatter_colors)
+        elif figure[0] == "tbe":
+            color_map = mpl.cm.get_cmap("cividis")
+            scatter_colors = color_map([x / 100 for x in reversed(sorted(pct_masks))])
+            plot_scatter(pd.DataFrame(shared), name, tbe_label(spec["ref_bs_label"]), tbe_label(spec["tree_bs_label"]),
+                         scatter_colors, cutoff=tbe_cutoff, kind="tbe")
+        else:
+            plot_hist(ref_only, name, spec["ref_bs_label"])
+            plt.close()
+    return file_name, fingerprint
+
+
+def main(argv):
+    global _render_jobs
+    parser = argparse.ArgumentParser(
+        description="Compares bootstrap support between the whole and masked alignment trees in trees/ "
+                    "and plots each comparison to plots/ (run from the repository root)"
     )
-line_styles = {"color": "black", "linestyle": "--"}
-ax.axvline(bootstrap_cutoff, **line_styles)
-ax.axhline(bootstrap_cutoff, **line_styles)
-
-top_right_pct_nodes = high_support_df.shape[0] / shared_edge_df.shape[0] * 100
-bottom_right_pct_nodes = ref_aln_support_df.shape[0] / shared_edge_df.shape[0] * 100
-top_left_pct_nodes = other_aln_support_df.shape[0] / shared_edge_df.shape[0] * 100
-bottom_left_pct_nodes = low_support_df.shape[0] / shared_edge_df.shape[0] * 100
-ax.text(
-    101, bootstrap_cutoff + 2, "{:.1f}%".format(top_right_pct_nodes)
-)
-ax.text(bootstrap_cutoff + 2, 2, "{:.1f}%".format(bottom_right_pct_nodes))
-ax.text(2, bootstrap_cutoff + 2, "{:.1f}%".format(top_left_pct_nodes))
-ax.text(2, 2, "{:.1f}%".format(bottom_left_pct_nodes))
-
-ax.set_xlim([0, 102])
-ax.set_xlabel(xlabel)
-ax.set_ylim([0, 102])
-ax.set_ylabel(ylabel)
-if len(scatter_pcts) >1:
-    plt.legend(bbox_to_anchor=(1.05, 1), loc="upper left", borderaxespad=0.0)
-plt.tight_layout()
-plt.savefig("plots/{}_bootstrap_scatter.png".format(plot_prefix))
-plt.close()
-print("Done.")
+    parser.add_argument("--all", action="store_true",
+                        help="compare the whole alignment tree to every mask level (whole_v_allmasks)")
+    parser.add_argument("--mask-as-ref", action="store_true",
+                        help="use the 100%% masked tree as the reference (masked_v_whole)")
+    parser.add_argument("-c", "--comparisons", nargs="+", choices=list(comparisons), metavar="NAME",
+                        help="run several comparisons from one set of parsed trees: {}".format(", ".join(comparisons)))
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="number of processes rendering figures (default: 1)")
+    parser.add_argument("-f", "--force", action="store_true",
+                        help="re-render figures whose trees, settings and plotting code are unchanged")
+    parser.add_argument("--tbe", action="store_true",
+                        help="add transfer bootstrap expectation from the .ufboot files next to the treefiles "
+                             "and plot it (<comparison>_tbe_scatter.png)")
+    parser.add_argument("--stats-only", action="store_true",
+                        help="only print the comparison numbers (and write them with -o), without ete3 or "
+                             "plotting libraries and without rendering")
+    parser.add_argument("-o", "--output", help="with --stats-only, write one row per compared tree to this .csv/.parquet")
+    args = parser.parse_args(argv)
+    if args.output and not args.stats_only:
+        parser.error("-o/--output needs --stats-only")
+    if args.tbe and args.stats_only:
+        parser.error("--tbe draws figures and cannot be combined with --stats-only")
+
+    if args.comparisons:
+        names = args.comparisons
+    elif args.mask_as_ref:
+        names = ["masked_v_whole"]
+    elif args.all:
+        names = ["whole_v_allmasks"]
+    else:
+        names = ["whole_v_masked"]
+
+    if args.stats_only:
+        rows = [row for name in names for row in comparison_stats(name)]
+        if args.output:
+            import pandas as pd
+            from tables import write_table
+
+            write_table(pd.DataFrame(rows, columns=stats_columns), args.output)
+        return rows
+
+    fingerprints = read_fingerprints()
+    results = {}
+    _render_jobs = []
+    for name in names:
+        shared, ref_only, pct_masks = run_comparison(name, args.tbe)
+        results[name] = (shared, ref_only)
+        with_tbe = bool(shared) and tbe_label(comparisons[name]["ref_bs_label"]) in shared[0]
+        ref_tree = get_tree(comparisons[name]["ref_tree_file"])
+        annotate_clades(ref_tree)
+        symbols = {node: node.suport_symbol for node in ref_tree.traverse() if hasattr(node, "bootstrap")}
+        for file_name, fingerprint, figure in plan_renders(name, with_tbe):
+            if not args.force and fingerprints.get(file_name) == fingerprint and os.path.exists(file_name):
+                print("{} is up to date.".format(file_name))
+                continue
+            _render_jobs.append((name, file_name, fingerprint, figure, symbols, shared, ref_only, pct_masks))
+
+    print("Rendering {} figures...".format(len(_render_jobs)))
+    try:
+        if args.workers > 1 and len(_render_jobs) > 1:
+            ctx = multiprocessing.get_context("fork")
+            with ctx.Pool(min(args.workers, len(_render_jobs))) as pool:
+                for file_name, fingerprint in pool.imap_unordered(render_job, range(len(_render_jobs))):
+                    print("Wrote {}.".format(file_name))
+                    fingerprints[file_name] = fingerprint
+        else:
+            for i in range(len(_render_jobs)):
+                file_name, fingerprint = render_job(i)
+                fingerprints[file_name] = fingerprint
+    finally:
+        # figures that were written are recorded even if a later render fails
+        write_fingerprints(fingerprints)
+    return results
 
-print("Plotting histogram...")
-fig, ax = plt.subplots(dpi=300)
-ax.hist(ref_only_edge_support_values, bins=np.arange(10,105,5))
-ax.set_xlabel("{}".format(xlabel))
-plt.tight_layout()
-plt.savefig("plots/{}_bootstrap_hist.png".format(plot_prefix))
-print("Done.")
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
 
 """
 # quick whole/pol hist
-%run ./scripts/bootstrap_support.py
-whole_aln = ref_only_edge_support_values
-%run ./scripts/bootstrap_support.py --mask-as-ref
-masked_aln = ref_only_edge_support_values
+from bootstrap_support import main
+results = main(["-c", "whole_v_masked", "masked_v_whole"])
+_, whole_aln = results["whole_v_masked"]
+_, masked_aln = results["masked_v_whole"]
 plt.close()
 
 fig, ax = plt.subplots(dpi=300)
@@ -283,4 +649,4 @@ ax.set_xlabel("Bootstrap")
 plt.legend()
 plt.tight_layout()
 plt.savefig("plots/wholevpol_hist.png")
-"""
\ No newline at end of file
+"""
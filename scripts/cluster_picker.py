@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import argparse
+import sys
+from os import path
+
+import numpy as np
+import pandas as pd
+
+from alignment_matrix import AlignmentMatrix
+from distance_cache import DistanceCache
+from distances import distance_matrices, gap_modes, models, pack_planes
+from fastaio import base_name
+from instrument import stage
+from iqtree_jobs import alignment_regex
+from tables import write_table
+from treecache import load_tree
+
+# python cluster_picker.py ../results/alignments/HIV1_FLT_2018_genome_DNA_subtypeB_mask100.fa ../results/trees/HIV1_FLT_2018_genome_DNA_subtypeB_mask100.fa.treefile --initial-support 90 --support 99 --distance 0.015 -o ../results/clusterpicker --workers 8
+# python cluster_picker.py ../results/alignments/HIV1_FLT_2018_genome_DNA_subtypeB_14942603_mask010.fa ../results/trees/HIV1_FLT_2018_genome_DNA_subtypeB_14942603_mask010.fa.treefile --cache ../results/distance_cache -o ../results/clusterpicker
+
+table_columns = ["cluster", "size", "support", "max_distance"]
+
+
+def clade_ranges(tree):
+    """
+    Preorder layout of a treecache.FlatTree: every clade is the nodes [i, i + n_nodes[i]) and the
+    tips [first_tip[i], first_tip[i] + n_tips[i]) in preorder, and children[i] are in preorder too.
+    """
+    parent = tree.parent.tolist()
+    is_leaf = tree.is_leaf
+    first_tip = (np.cumsum(is_leaf) - is_leaf).tolist()
+    n_tips = is_leaf.astype(int).tolist()
+    n_nodes = [1] * len(parent)
+    children = [[] for _ in parent]
+    for i in range(len(parent) - 1, 0, -1):
+        n_tips[parent[i]] += n_tips[i]
+        n_nodes[parent[i]] += n_nodes[i]
+    for i in range(1, len(parent)):
+        children[parent[i]].append(i)
+    return first_tip, n_tips, n_nodes, children
+
+
+def search_roots(support, n_nodes, min_support):
+    """
+    The largest clades with support >= min_support; every clade that can be a cluster lies in one.
+    """
+    roots = []
+    i = 0
+    while i < len(support):
+        if support[i] >= min_support:
+            roots.append(i)
+            i += n_nodes[i]
+        else:
+            i += 1
+    return roots
+
+
+def clade_max_distances(root, ranges, is_leaf, distances):
+    """
+    Largest pairwise distance within every internal clade below root, from the distance matrix of
+    root's tips in preorder. Each pair of tips is read once, where its two lineages meet: a node
+    takes the maximum of its children's clades and of each child's block against its later siblings.
+    """
+    first_tip, n_tips, n_nodes, children = ranges
+    offset = first_tip[root]
+    max_distance = {}
+    for i in range(root + n_nodes[root] - 1, root - 1, -1):
+        if is_leaf[i]:
+            continue
+        end = first_tip[i] + n_tips[i] - offset
+        largest = 0.0
+        for child in children[i]:
+            if not is_leaf[child]:
+                largest = max(largest, max_distance[child])
+            start, child_end = first_tip[child] - offset, first_tip[child] + n_tips[child] - offset
+            if child_end < end:
+                largest = max(largest, distances[start:child_end, child_end:end].max())
+        max_distance[i] = largest
+    return max_distance
+
+
+def pick_clusters(tree, support, group_distances, tip_rows, min_support, max_distance, initial_support=None):
+    """
+    ClusterPicker's clusters: the largest clades with support >= min_support whose sequences are all
+    within max_distance of each other. Distances are only computed within the largest clades with
+    support >= initial_support (at most min_support), which hold every candidate: group_distances
+    maps a list of row index arrays to their distance matrices, and tip_rows maps tree tips to those
+    rows. Returns (node, support, max distance) per cluster in preorder.
+    """
+    initial_support = min_support if initial_support is None else initial_support
+    if initial_support > min_support:
+        raise ValueError("the initial support threshold cannot be above the cluster support threshold")
+    ranges = clade_ranges(tree)
+    first_tip, n_tips, n_nodes, _ = ranges
+    is_leaf = tree.is_leaf.tolist()
+    support = np.nan_to_num(support, nan=-np.inf).tolist()
+    for i, leaf in enumerate(is_leaf):
+        if leaf:
+            support[i] = -np.inf
+    roots = search_roots(support, n_nodes, initial_support)
+    preorder_rows = tip_rows[tree.tip[tree.is_leaf]]
+    groups = [preorder_rows[first_tip[root]:first_tip[root] + n_tips[root]] for root in roots]
+    matrices = group_distances(groups)
+
+    clusters = []
+    for root, distances in zip(roots, matrices):
+        # pairs without comparable sites can never be within the threshold
+        distances[np.isnan(distances)] = np.inf
+        clade_distances = clade_max_distances(root, ranges, is_leaf, distances)
+        i = root
+        while i < root + n_nodes[root]:
+            if not is_leaf[i] and support[i] >= min_support and clade_distances[i] <= max_distance:
+                clusters.append((i, support[i], clade_distances[i]))
+                i += n_nodes[i]
+            else:
+                i += 1
+    return clusters
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="ClusterPicker clusters (well supported clades whose sequences are all within a genetic "
+                    "distance of each other) of an alignment and its tree"
+    )
+    parser.add_argument("alignment", help="path to alignment (plain, compressed or in a tarball)")
+    parser.add_argument("tree", help="IQ-TREE treefile of the alignment")
+    parser.add_argument("--initial-support", type=float, default=90,
+                        help="only clades within clades of at least this support are searched (default: 90)")
+    parser.add_argument("--support", type=float, default=99, help="cluster support threshold (default: 99)")
+    parser.add_argument("--distance", type=float, default=0.015,
+                        help="largest genetic distance within a cluster (default: 0.015)")
+    parser.add_argument("--support-values", choices=["ufboot", "shalrt"], default="ufboot",
+                        help="node support to threshold (default: ufboot)")
+    parser.add_argument("--model", choices=models, default="p", help="genetic distance (default: p)")
+    parser.add_argument("--gaps", choices=gap_modes,
+                        help="count a gap against a base as a difference, as ClusterPicker's default gap method "
+                             "(p-distance only), or leave out sites with a gap in either sequence (default: count "
+                             "for p, ignore for tn93)")
+    parser.add_argument("--cache", metavar="DIR",
+                        help="distance_cache.py cache of the alignment this one was masked from; distances are "
+                             "assembled from it for the seed and mask in the alignment's name, which is not read")
+    parser.add_argument("-o", "--out-dir", help="directory of <alignment>_clusterPicks_list.txt (default: the alignment's)")
+    parser.add_argument("--table", help="also write one row per cluster (size, support, max distance) to this .csv/.parquet")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="number of worker processes (default: 1)")
+    args = parser.parse_args()
+    if args.gaps is None:
+        args.gaps = "ignore" if args.model == "tn93" else "count"
+
+    if args.cache:
+        match = alignment_regex.match(path.basename(args.alignment))
+        if match is None:
+            sys.exit("--cache needs an alignment named <base>_<seed>_mask<pct>.fa, not {}".format(args.alignment))
+        cache = DistanceCache(args.cache)
+        masked = cache.masked_rows(int(match["seed"]), int(match["mask"]))
+        ids = cache.ids
+
+        def group_distances(groups):
+            return [cache.distances(masked, group, args.model, args.gaps) for group in groups]
+    else:
+        with stage("parse_alignment") as record:
+            matrix = AlignmentMatrix.from_fasta(args.alignment)
+            planes = pack_planes(matrix.seqs)
+            record["items"] = len(matrix)
+        ids = matrix.ids
+
+        def group_distances(groups):
+            return distance_matrices(planes, groups, args.model, args.gaps, args.workers)
+    tree = load_tree(args.tree)
+    rows = {seqid: i for i, seqid in enumerate(ids)}
+    missing = [name for name in tree.tip_names if name not in rows]
+    if missing:
+        sys.exit("{} tree tips are not in the alignment, e.g. {}".format(len(missing), missing[0]))
+    tip_rows = np.array([rows[name] for name in tree.tip_names], dtype=np.int64)
+    support = tree.ufboot if args.support_values == "ufboot" else tree.shalrt
+
+    with stage("pick_clusters", items=len(ids)):
+        clusters = pick_clusters(tree, support, group_distances, tip_rows, args.support, args.distance,
+                                 args.initial_support)
+    print("{} clusters at support >= {:g} and {} distance <= {:g}".format(
+        len(clusters), args.support, args.model, args.distance))
+
+    first_tip, n_tips, _, _ = clade_ranges(tree)
+    preorder_names = tree.tip_names[tree.tip[tree.is_leaf]]
+    cluster_numbers = np.full(len(ids), -1)
+    table = []
+    for number, (node, node_support, node_distance) in enumerate(clusters, 1):
+        for name in preorder_names[first_tip[node]:first_tip[node] + n_tips[node]]:
+            cluster_numbers[rows[name]] = number
+        table.append([number, n_tips[node], node_support, node_distance])
+
+    out_dir = args.out_dir or path.dirname(path.abspath(args.alignment))
+    out_file = path.join(out_dir, base_name(args.alignment) + "_clusterPicks_list.txt")
+    # the columns ClusterPicker writes, -1 for sequences in no cluster
+    pd.DataFrame({"SequenceName": ids, "ClusterNumber": cluster_numbers}).to_csv(out_file, sep="\t", index=False)
+    if args.table:
+        write_table(pd.DataFrame(table, columns=table_columns), args.table)
+    print("Done.")
+
+
+if __name__ == "__main__":
+    main()
@@ -16,6 +16,12 @@ masks=( 000 010 020 030 040 050 060 070 080 090 100 )
 fa=HIV1_FLT_2018_genome_DNA_subtypeB_mask${masks[$SLURM_ARRAY_TASK_ID]}.fa
 tree=HIV1_FLT_2018_genome_DNA_subtypeB_mask${masks[$SLURM_ARRAY_TASK_ID]}.treefile
 
-java –jar /home/rstudio/ClusterPicker_1.2.jar $fa $tree 90 99 0.015 10
+# same thresholds and gap distance as ClusterPicker_1.2.jar $fa $tree 90 99 0.015 10, without a JVM:
+# a gap against a base is a difference, so masked rows (all gaps outside PRRT) stay as distant as there;
+# unlike the jar, sites with an ambiguity code in either sequence are left out
+# writes ${fa%.fa}_clusterPicks_list.txt to results/clusterpicker
+mkdir -p ${WORKDIR}/results/clusterpicker
+python ${WORKDIR}/scripts/cluster_picker.py ${ALIGNMENTS}/$fa ${TREES}/$tree --initial-support 90 --support 99 --distance 0.015 --gaps count \
+    -o ${WORKDIR}/results/clusterpicker --workers ${SLURM_CPUS_PER_TASK:-1}
 
 
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import argparse
+import json
+import os
+from os import path
+
+import numpy as np
+
+from alignment_matrix import AlignmentMatrix, column_mask
+from distances import check_model, count_distances, count_matrices, gap_modes, models, pack_planes, row_bases
+from hxb2 import HXB2Index
+from mask_manifest import file_sha256, load_alignment, masked_rows, read_manifest, shuffled_rows
+from shuffle_and_mask import get_HXB2_pol_coords
+
+# python distance_cache.py ../results/alignments/HIV1_FLT_2018_genome_DNA_subtypeB.fa ../results/distance_cache --workers 8
+# python distance_cache.py ../results/alignments/HIV1_FLT_2018_genome_DNA_subtypeB_masks.json ../results/distance_cache --seed 14942603 --mask 10 -o mask010.npz
+
+# the kept (PRRT) columns and all other columns; a masked row keeps only the first
+regions = ["keep", "rest"]
+# tile_counts, stacked in this order
+kinds = ["sites", "transversions", "transitions", "purine_transitions", "gap_differences"]
+meta_file = "meta.json"
+
+
+def region_file(cache_dir, region):
+    return path.join(cache_dir, region + ".npy")
+
+
+def bases_file(cache_dir):
+    return path.join(cache_dir, "bases.npy")
+
+
+def build_cache(cache_dir, orig_matrix, keep_start, keep_stop, source, workers=1):
+    """
+    Pair counts (see distances.tile_counts) of every pair of rows within the kept columns and within
+    the rest, as (5, rows, rows) memory-mapped .npy files, and the base counts of each row per region.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    keep_cols = column_mask(orig_matrix.shape[1], keep_start, keep_stop)
+    n_rows = len(orig_matrix)
+    bases = []
+    for region, cols in zip(regions, (keep_cols, ~keep_cols)):
+        planes = pack_planes(orig_matrix.seqs[:, cols])
+        # counts never exceed the region's width
+        dtype = np.uint16 if cols.sum() < 1 << 16 else np.uint32
+        tmp = region_file(cache_dir, region) + ".tmp.npy"
+        out = np.lib.format.open_memmap(tmp, mode="w+", dtype=dtype, shape=(len(kinds), n_rows, n_rows))
+        count_matrices(planes, out, workers)
+        out.flush()
+        del out
+        os.replace(tmp, region_file(cache_dir, region))
+        bases.append(row_bases(planes))
+    np.save(bases_file(cache_dir), np.stack(bases).astype(np.int32))
+    meta = {
+        "source": path.abspath(source),
+        "sha256": file_sha256(source),
+        "keep": [keep_start, keep_stop],
+        "n_rows": n_rows,
+        "ids": orig_matrix.ids,
+    }
+    # written last, so a cache with a meta file is complete
+    with open(path.join(cache_dir, meta_file), "w") as f:
+        json.dump(meta, f, indent=1)
+    return DistanceCache(cache_dir)
+
+
+def read_meta(cache_dir):
+    try:
+        with open(path.join(cache_dir, meta_file)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+class DistanceCache:
+    """
+    Pair counts of an alignment split into the columns every masked alignment keeps and the columns
+    masking replaces with gaps. A pair's counts in any masked alignment are its kept-column counts,
+    plus its other-column counts if neither sequence is masked; with gaps counted, a masked sequence's
+    gaps also differ from every base of an unmasked partner outside the kept columns.
+    """
+
+    def __init__(self, cache_dir):
+        self.meta = read_meta(cache_dir)
+        if self.meta is None:
+            raise FileNotFoundError("no distance cache in {}".format(cache_dir))
+        self.ids = self.meta["ids"]
+        self.counts_by_region = {region: np.load(region_file(cache_dir, region), mmap_mode="r") for region in regions}
+        self.bases = np.load(bases_file(cache_dir))
+
+    def __len__(self):
+        return self.meta["n_rows"]
+
+    def masked_rows(self, seed, pct_to_mask):
+        """
+        The rows shuffle_and_mask.py masks for a seed and mask level.
+        """
+        return masked_rows(shuffled_rows(seed, len(self)), pct_to_mask)
+
+    def base_frequencies(self, masked):
+        counts = self.bases[0].sum(axis=0) + self.bases[1][~masked].sum(axis=0)
+        return counts / counts.sum()
+
+    def counts(self, masked, rows=None, which=kinds):
+        """
+        Pair counts (see distances.tile_counts) among rows (default: all) of the alignment with the
+        masked rows masked, selected from the cached counts; kinds not in which are None.
+        """
+        pairs = (slice(None), slice(None)) if rows is None else np.ix_(rows, rows)
+        rows = np.arange(len(self)) if rows is None else np.asarray(rows)
+        keep = self.counts_by_region["keep"]
+        rest = self.counts_by_region["rest"]
+        unmasked = ~masked[rows]
+        both_unmasked = unmasked[:, None] & unmasked[None]
+        counts = []
+        for k, kind in enumerate(kinds):
+            if kind not in which:
+                counts.append(None)
+                continue
+            counts.append(keep[k][pairs] + np.where(both_unmasked, rest[k][pairs], 0).astype(np.int64))
+        if "gap_differences" in which:
+            # gaps of a masked row against the bases of an unmasked row outside the kept columns
+            rest_bases = np.where(unmasked, self.bases[1][rows].sum(axis=1), 0)
+            counts[-1] += (~unmasked[:, None] & unmasked[None]) * rest_bases[None]
+            counts[-1] += (unmasked[:, None] & ~unmasked[None]) * rest_bases[:, None]
+        return counts
+
+    def distances(self, masked, rows=None, model="p", gaps="ignore"):
+        """
+        Distance matrix among rows (default: all) of the alignment with the masked rows masked, equal to
+        distances.pairwise_distances of that masked alignment.
+        """
+        check_model(model, gaps)
+        which = kinds[:3] + (["purine_transitions"] if model == "tn93" else []) + \
+            (["gap_differences"] if gaps == "count" else [])
+        freqs = self.base_frequencies(masked) if model == "tn93" else None
+        matrix = count_distances(*self.counts(masked, rows, which), model=model, gaps=gaps, freqs=freqs)
+        np.fill_diagonal(matrix, 0)
+        return matrix
+
+
+def open_cache(cache_dir, source, member=None, workers=1):
+    """
+    The cache of an alignment or a shuffle_and_mask.py manifest, built first if it is missing or
+    was built from another file or region.
+    """
+    if source.endswith(".json"):
+        manifest = read_manifest(source)
+        alignment_file, keep = manifest["alignment"], manifest["keep"]
+    else:
+        alignment_file, keep = source, None
+    meta = read_meta(cache_dir)
+    if meta is not None and meta["sha256"] == file_sha256(alignment_file) and (keep is None or meta["keep"] == keep):
+        return DistanceCache(cache_dir)
+    if source.endswith(".json"):
+        orig_matrix = load_alignment(manifest)
+    else:
+        orig_matrix = AlignmentMatrix.from_fasta(alignment_file, member)
+        keep = get_HXB2_pol_coords(HXB2Index.from_matrix(orig_matrix))
+    print("Counting pairs of {} sequences in {}...".format(len(orig_matrix), cache_dir))
+    return build_cache(cache_dir, orig_matrix, keep[0], keep[1], alignment_file, workers)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Caches pair counts of an alignment within and outside the PRRT columns, from which the "
+                    "distance matrix of any of its shuffle_and_mask.py masked alignments is assembled"
+    )
+    parser.add_argument("source", help="alignment given to shuffle_and_mask.py, or a manifest it wrote (.json)")
+    parser.add_argument("cache_dir", help="cache directory; built if missing or out of date")
+    parser.add_argument("--member", help="tarball member to read (default: its only fasta file)")
+    parser.add_argument("--seed", type=int, help="with --mask and -o, write the distances of this masked alignment")
+    parser.add_argument("--mask", type=int, metavar="PCT", help="mask level of --seed")
+    parser.add_argument("-o", "--output", help="output .npz with ids and the float32 distance matrix")
+    parser.add_argument("--model", choices=models, default="p", help="distance (default: p)")
+    parser.add_argument("--gaps", choices=gap_modes, default="ignore",
+                        help="leave out sites with a gap in either sequence, or count a gap against a base as "
+                             "a difference (p-distance only) (default: ignore)")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="number of worker processes building the cache (default: 1)")
+    args = parser.parse_args()
+    if (args.seed is None) != (args.mask is None) or (args.seed is None) != (args.output is None):
+        parser.error("--seed, --mask and -o go together")
+
+    cache = open_cache(args.cache_dir, args.source, args.member, args.workers)
+    if args.output:
+        distances = cache.distances(cache.masked_rows(args.seed, args.mask), model=args.model, gaps=args.gaps)
+        np.savez(args.output, ids=np.array(cache.ids), distances=distances.astype(np.float32))
+    print("Done.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import argparse
+import multiprocessing
+
+import numpy as np
+
+from alignment_matrix import AlignmentMatrix
+
+# python distances.py ../results/alignments/HIV1_FLT_2018_genome_DNA_subtypeB_mask100.fa -o ../results/distances/mask100.npz --model tn93 --workers 8
+
+models = ["p", "tn93"]
+gap_modes = ["ignore", "count"]
+# planes of the packed alignment: a base is two bits (A 00, C 01, G 10, T 11) so transitions
+# flip only the high bit and transversions flip the low bit; gaps and ambiguity codes are not valid
+LOW, HIGH, VALID, GAP = range(4)
+# bytes of one (tile x tile x words) intermediate, small enough to stay in cache
+tile_bytes = 1 << 19
+
+if hasattr(np, "bitwise_count"):
+    def count_bits(words):
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int64)
+else:
+    _byte_bits = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+    def count_bits(words):
+        return _byte_bits[words.view(np.uint8)].sum(axis=-1, dtype=np.int64)
+
+# set in the parent before the pool forks so workers share them copy-on-write
+_planes = None
+_groups = None
+_model = None
+_gaps = None
+_freqs = None
+
+
+def pack_planes(seqs):
+    """
+    (4, rows, words) uint64 bitplanes of a uint8 alignment matrix, 64 columns per word: the two
+    bits of each base, whether it is an unambiguous base, and whether it is a gap.
+    """
+    codes = np.zeros((4, 256), dtype=bool)
+    for code, base in enumerate("ACGT"):
+        for b in (base, base.lower()):
+            codes[LOW, ord(b)] = code & 1
+            codes[HIGH, ord(b)] = code >> 1
+            codes[VALID, ord(b)] = True
+    codes[GAP, ord("-")] = codes[GAP, ord(".")] = True
+    n_rows, n_cols = seqs.shape
+    n_words = -(-n_cols // 64)
+    planes = np.zeros((4, n_rows, n_words * 8), dtype=np.uint8)
+    for plane in range(4):
+        planes[plane, :, :-(-n_cols // 8)] = np.packbits(codes[plane][seqs], axis=1)
+    return planes.view(np.uint64)
+
+
+def row_bases(planes):
+    """
+    (rows, 4) counts of A, C, G, T in every row of a packed alignment.
+    """
+    valid = planes[VALID]
+    high = planes[HIGH] & valid
+    low = planes[LOW] & valid
+    return np.stack([count_bits(valid & ~high & ~low), count_bits(valid & ~high & low),
+                     count_bits(high & ~low), count_bits(high & low)], axis=1)
+
+
+def base_frequencies(planes):
+    """
+    A, C, G, T frequencies over every unambiguous base of the alignment, as TN93 uses them.
+    """
+    counts = row_bases(planes).sum(axis=0)
+    return counts / counts.sum()
+
+
+def tile_counts(a, b, tn93=False, count_gaps=False):
+    """
+    Sites compared (both unambiguous bases), transversions, transitions, A<->G transitions and sites
+    with a gap against a base, of every pair of rows of two packed tiles, each (tile_a x tile_b).
+    The last two are None unless asked for.
+    """
+    va, vb = a[VALID][:, None], b[VALID][None]
+    valid = va & vb
+    low_diff = a[LOW][:, None] ^ b[LOW][None]
+    high_diff = a[HIGH][:, None] ^ b[HIGH][None]
+    transitions = valid & high_diff & ~low_diff
+    n_sites = count_bits(valid)
+    transversion_count = count_bits(valid & low_diff)
+    transition_count = count_bits(transitions)
+    purine_count = count_bits(transitions & ~a[LOW][:, None]) if tn93 else None
+    gap_count = count_bits((a[GAP][:, None] & vb) | (va & b[GAP][None])) if count_gaps else None
+    return n_sites, transversion_count, transition_count, purine_count, gap_count
+
+
+def p_distance(n_sites, transversions, transitions):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(n_sites > 0, (transversions + transitions) / n_sites, np.nan)
+
+
+def tn93_distance(n_sites, transversions, transitions, purine_transitions, freqs):
+    """
+    Tamura-Nei (1993) distance from pair counts and the alignment's base frequencies (A, C, G, T),
+    as ape's dist.dna(model="TN93"); saturated pairs are inf.
+    """
+    a, c, g, t = freqs
+    r, y = a + g, c + t
+    k1 = 2 * a * g / r
+    k2 = 2 * c * t / y
+    k3 = 2 * (r * y - a * g * y / r - c * t * r / y)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        p1 = purine_transitions / n_sites
+        p2 = (transitions - purine_transitions) / n_sites
+        q = transversions / n_sites
+        w1 = 1 - p1 / k1 - q / (2 * r)
+        w2 = 1 - p2 / k2 - q / (2 * y)
+        w3 = 1 - q / (2 * r * y)
+        d = -k1 * np.log(w1) - k2 * np.log(w2) - k3 * np.log(w3)
+    saturated = (w1 <= 0) | (w2 <= 0) | (w3 <= 0)
+    return np.where(n_sites > 0, np.where(saturated, np.inf, d), np.nan)
+
+
+def count_distances(n_sites, transversions, transitions, purines=None, gap_diffs=None, model="p", gaps="ignore",
+                    freqs=None):
+    """
+    Distances from pair counts (see tile_counts). Sites where either sequence has a gap or an ambiguity
+    code are left out; with gaps="count" a gap against a base is compared and counted as a difference.
+    """
+    if gaps == "count":
+        n_sites = n_sites + gap_diffs
+        transversions = transversions + gap_diffs
+    if model == "tn93":
+        return tn93_distance(n_sites, transversions, transitions, purines, freqs)
+    return p_distance(n_sites, transversions, transitions)
+
+
+def tile_distances(a, b, model="p", gaps="ignore", freqs=None):
+    counts = tile_counts(a, b, model == "tn93", gaps == "count")
+    return count_distances(*counts, model=model, gaps=gaps, freqs=freqs)
+
+
+def tile_size(planes):
+    return max(8, int((tile_bytes / (8 * planes.shape[2])) ** 0.5))
+
+
+def tile_job(job):
+    g, i, j, size = job
+    rows = _groups[g]
+    a = _planes[:, rows[i:i + size]]
+    b = a if i == j else _planes[:, rows[j:j + size]]
+    if _model is None:
+        return g, i, j, np.stack(tile_counts(a, b, True, True))
+    return g, i, j, tile_distances(a, b, _model, _gaps, _freqs)
+
+
+def run_tiles(planes, groups, workers, model=None, gaps="ignore", freqs=None):
+    """
+    Yields (group, i, j, tile) for the tiles on or above the diagonal of the square matrix of each
+    group (arrays of row indexes of the packed alignment): distances, or with no model the stacked
+    tile_counts. The tiles of all groups are spread over the workers together, so many small groups
+    balance as well as one large one.
+    """
+    global _planes, _groups, _model, _gaps, _freqs
+    _planes, _model, _gaps, _freqs = planes, model, gaps, freqs
+    _groups = [np.asarray(rows, dtype=np.int64) for rows in groups]
+    size = tile_size(planes)
+    jobs = [(g, i, j, size) for g, rows in enumerate(_groups)
+            for i in range(0, len(rows), size) for j in range(i, len(rows), size)]
+    if workers > 1 and len(jobs) > 1:
+        ctx = multiprocessing.get_context("fork")
+        with ctx.Pool(workers) as pool:
+            yield from pool.imap_unordered(tile_job, jobs, chunksize=max(1, len(jobs) // (workers * 16)))
+    else:
+        yield from map(tile_job, jobs)
+
+
+def fill_symmetric(matrix, i, j, tile):
+    """
+    Writes a tile at (i, j) and its transpose at (j, i) of the last two axes of matrix.
+    """
+    matrix[..., i:i + tile.shape[-2], j:j + tile.shape[-1]] = tile
+    matrix[..., j:j + tile.shape[-1], i:i + tile.shape[-2]] = np.swapaxes(tile, -1, -2)
+
+
+def check_model(model, gaps):
+    if model not in models or gaps not in gap_modes:
+        raise ValueError("model should be one of {} and gaps one of {}".format(models, gap_modes))
+    if model == "tn93" and gaps == "count":
+        raise ValueError("TN93 has no gap state; use gaps='ignore'")
+
+
+def distance_matrices(planes, groups, model="p", gaps="ignore", workers=1, freqs=None):
+    """
+    Square float64 distance matrix among the rows of each group, computed in cache-sized tiles.
+    """
+    check_model(model, gaps)
+    if model == "tn93" and freqs is None:
+        freqs = base_frequencies(planes)
+    matrices = [np.zeros((len(rows), len(rows))) for rows in groups]
+    for g, i, j, tile in run_tiles(planes, groups, workers, model, gaps, freqs):
+        fill_symmetric(matrices[g], i, j, tile)
+    for matrix in matrices:
+        np.fill_diagonal(matrix, 0)
+    return matrices
+
+
+def count_matrices(planes, out, workers=1):
+    """
+    Fills out, a (5, rows, rows) integer array (e.g. a memory map), with the tile_counts of every
+    pair of rows of the packed alignment.
+    """
+    for _, i, j, tile in run_tiles(planes, [np.arange(planes.shape[1])], workers):
+        fill_symmetric(out, i, j, tile.astype(out.dtype))
+    return out
+
+
+def pairwise_distances(seqs, model="p", gaps="ignore", workers=1):
+    """
+    Distance matrix among all rows of a uint8 alignment matrix.
+    """
+    planes = pack_planes(seqs)
+    return distance_matrices(planes, [np.arange(len(seqs))], model, gaps, workers)[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pairwise p-distance or TN93 distance matrix of an alignment")
+    parser.add_argument("alignment", help="path to alignment (plain, compressed or in a tarball)")
+    parser.add_argument("-o", "--output", required=True, help="output .npz with ids and the float32 distance matrix")
+    parser.add_argument("--model", choices=models, default="p", help="distance (default: p)")
+    parser.add_argument("--gaps", choices=gap_modes, default="ignore",
+                        help="leave out sites with a gap in either sequence, or count a gap against a base as "
+                             "a difference (p-distance only) (default: ignore)")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="number of worker processes (default: 1)")
+    args = parser.parse_args()
+
+    matrix = AlignmentMatrix.from_fasta(args.alignment)
+    print("Computing {} distances between {} sequences...".format(args.model, len(matrix)))
+    distances = pairwise_distances(matrix.seqs, args.model, args.gaps, args.workers)
+    np.savez(args.output, ids=np.array(matrix.ids), distances=distances.astype(np.float32))
+    print("Done.")
+
+
+if __name__ == "__main__":
+    main()
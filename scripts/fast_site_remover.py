@@ -1,18 +1,24 @@
 #!/usr/bin/env python
+import hashlib
 import os
 import random
+import re
+import shutil
 import string
 import subprocess
 import sys
 import textwrap
 
-import pandas as pd
+import numpy as np
 from Bio import SeqIO
 from Bio.Seq import Seq
 from Bio.SeqRecord import SeqRecord
 
 from phylofisher import help_formatter
 
+from alignment_matrix import AlignmentMatrix
+from instrument import stage
+
 # Modified from https://github.com/TheBrownLab/PhyloFisher/blob/master/phylofisher/utilities/fast_site_remover.py
 
 def id_generator(size=10, chars=string.digits):
@@ -21,39 +27,46 @@ def id_generator(size=10, chars=string.digits):
 
 def unique_name(keys):
     id_ = id_generator()
-    if id_ not in keys:
-        return id_
-    else:
-        unique_name(keys)
+    while id_ in keys:
+        id_ = id_generator()
+    return id_
 
 
 def fake_phylip(matrix):
-    length = None
+    """
+    Writes the already loaded matrix to TEMP.phy under pseudonames, in the same pass that assigns them.
+    """
     pseudonames = {}
     pseudonames_rev = {}
-    records = []
 
-    for record in SeqIO.parse(matrix, args.in_format):
-        uname = unique_name(pseudonames)
-        pseudonames[record.name] = uname
-        pseudonames_rev[uname] = record.name
-        seq = str(record.seq)
-        records.append(SeqRecord(Seq(seq),
-                                 id=uname,
-                                 name='',
-                                 description=''))
+    def records():
+        for title, row in zip(matrix.titles, matrix.seqs):
+            name = title.decode()
+            uname = unique_name(pseudonames_rev)
+            pseudonames[name] = uname
+            pseudonames_rev[uname] = name
+            yield SeqRecord(Seq(row.tobytes()),
+                            id=uname,
+                            name='',
+                            description='')
 
-    SeqIO.write(records, 'TEMP.phy', 'phylip')
+    SeqIO.write(records(), 'TEMP.phy', 'phylip')
 
     return pseudonames, pseudonames_rev
 
 
+# a taxon name is whatever follows "(" or "," up to the next delimiter
+taxon_re = re.compile(r"([(,]\s*)([^\s(),:;\[\]]+)")
+
+
 def fake_tree(treefile, pseudonames):
+    """
+    Renames taxa in one pass over the newick; only whole taxon tokens are replaced,
+    so a name that is a prefix of another name is left alone.
+    """
     with open('TEMP.tre', 'w') as res:
         original = open(treefile).readline()
-        for key, value in pseudonames.items():
-            original = original.replace(key, value)
-        res.write(original)
+        res.write(taxon_re.sub(lambda m: m.group(1) + pseudonames.get(m.group(2), m.group(2)), original))
 
 def control_file_nuc():
     ctl = """treefile = TEMP.tre * treefile
@@ -65,6 +78,7 @@ def control_file_nuc():
     ub = 10             * upper bound for rates"""
     with open('dist_est.ctl', 'w') as res:
         res.write(ctl)
+    return ctl
 
 def control_file_amino():
     ctl = """treefile = TEMP.tre * treefile
@@ -78,17 +92,54 @@ nrate = 101            * number of rates
 ub = 10.0              * upper bound for rates"""
     with open('dist_est.ctl', 'w') as res:
         res.write(ctl)
+    return ctl
 
 
 def run_dist():
     cmd = 'dist_est dist_est.ctl'
-    subprocess.run(cmd, shell=True)
-
-
-def parse_rates():
+    subprocess.run(cmd, shell=True, check=True)
+
+
+def rate_cache_key(matrix_file, tree_file, model, ctl):
+    """
+    Rates depend only on the alignment, the tree and the dist_est settings, not on
+    the pseudonames, so those are what the cache is keyed on.
+    """
+    digest = hashlib.sha256()
+    for file_path in (matrix_file, tree_file):
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        digest.update(b'\0')
+    digest.update(model.encode() + b'\0' + ctl.encode())
+    return digest.hexdigest()
+
+
+def cached_rates(cache_dir, key):
+    """
+    Returns the path of the rate estimates for key, running dist_est only if they are not cached.
+    """
+    cached = os.path.join(cache_dir, f'{key}.dat')
+    if not os.path.isfile(cached):
+        # a rate_est.dat left by an earlier run must never be cached under this key
+        if os.path.exists('rate_est.dat'):
+            os.remove('rate_est.dat')
+        with stage('run_dist_est'):
+            run_dist()
+        if not os.path.isfile('rate_est.dat'):
+            raise RuntimeError('dist_est did not write rate_est.dat')
+        os.makedirs(cache_dir, exist_ok=True)
+        # copy then rename so concurrent runs never read a partial file
+        tmp = f'{cached}.{os.getpid()}.tmp'
+        shutil.copyfile('rate_est.dat', tmp)
+        os.replace(tmp, cached)
+    return cached
+
+
+def parse_rates(rate_file='rate_est.dat'):
     positions = []
     site = 0
-    for line in open('rate_est.dat'):
+    for line in open(rate_file):
         _, rate, _, _ = line.split()
         positions.append((site, float(rate)))
         site += 1
@@ -97,24 +148,54 @@ def parse_rates():
     return result
 
 
+def write_fasta_step(res, titles, seqs, wrap=60, block_rows=1024):
+    """
+    Writes rows as fasta wrapped at 60 like SeqIO's fasta writer, a block of rows at a time.
+    """
+    n_cols = seqs.shape[1]
+    n_lines = n_cols // wrap
+    full = n_lines * wrap
+    for block_start in range(0, seqs.shape[0], block_rows):
+        block = seqs[block_start:block_start + block_rows]
+        lines = np.empty((block.shape[0], n_lines, wrap + 1), dtype=np.uint8)
+        lines[:, :, :wrap] = block[:, :full].reshape(block.shape[0], n_lines, wrap)
+        lines[:, :, wrap] = ord("\n")
+        tail = block[:, full:]
+        chunks = []
+        for i in range(block.shape[0]):
+            chunks.append(b">" + titles[block_start + i] + b"\n")
+            chunks.append(lines[i].tobytes())
+            if n_cols > full:
+                chunks.append(tail[i].tobytes() + b"\n")
+        res.write(b"".join(chunks))
+
+
+def write_step(res, matrix, seqs, out_format):
+    if out_format == 'fasta':
+        write_fasta_step(res, matrix.titles, seqs)
+    else:
+        records = (SeqRecord(Seq(row.tobytes()),
+                             id=title.decode(),
+                             name='',
+                             description='') for title, row in zip(matrix.titles, seqs))
+        SeqIO.write(records, res, out_format)
+
+
 def main():
-    pseudo_, pseudo_rev_ = fake_phylip(args.matrix)
+    with stage('parse_alignment') as record:
+        matrix = AlignmentMatrix.from_records(SeqIO.parse(args.matrix, args.in_format))
+        record['items'] = len(matrix)
+    pseudo_, pseudo_rev_ = fake_phylip(matrix)
     fake_tree(args.tree, pseudo_)
     if args.type == "amino":
-        control_file_amino()
+        ctl = control_file_amino()
     elif args.type == "nuc":
-        control_file_nuc()
+        ctl = control_file_nuc()
     else:
-        ValueError("Type should be amino or nuc")
-    # Checks to see if dist_est has been run. If not do so
-    if not os.path.isfile('./rate_est.dat'):
-        run_dist()
-
-    matrix_dict = {}
-    for record in SeqIO.parse(args.matrix, args.in_format):
-        matrix_dict[record.name] = pd.Series(list(record.seq))
-
-    sorted_rates = parse_rates()
+        raise ValueError("Type should be amino or nuc")
+    # Reuses dist_est rates from an earlier run on the same matrix, tree and model
+    key = rate_cache_key(args.matrix, args.tree, args.type, ctl)
+    sorted_rates = parse_rates(cached_rates(args.rate_cache, key))
     iter = 0
     os.mkdir(f'{args.output}/steps_{args.step_size}')
     os.chdir(f'{args.output}/steps_{args.step_size}')
@@ -128,21 +209,17 @@ def main():
                 'phylip-relaxed': 'phy',
                 'nexus'         : 'nex'}
 
+    out_format = args.out_format.lower()
+    if out_format not in out_dict:
+        sys.exit('Invalid Output Format')
+
+    # gather columns into fastest-to-slowest order once; every step keeps a suffix of it,
+    # so each step is a slice of the previous one rather than a new gather
+    ranked = matrix.seqs[:, sorted_rates]
     for step in range(args.step_size, len(sorted_rates), args.step_size):
-        with open(f'step{iter}.{out_dict[args.out_format.lower()]}', 'w') as res:
-            records = []
-            for name, seq in matrix_dict.items():
-                seq = "".join(seq[sorted_rates[step:]].values)
-                records.append(SeqRecord(Seq(seq),
-                                         id=name,
-                                         name='',
-                                         description=''))
-
-            # Writes to output matrix in user specified output
-            if args.out_format.lower() in out_dict:
-                SeqIO.write(records, res, args.out_format.lower())
-            else:
-                sys.exit('Invalid Output Format')
+        with stage('write_step', items=len(matrix), step=iter), \
+                open(f'step{iter}.{out_dict[out_format]}', 'wb' if out_format == 'fasta' else 'w') as res:
+            write_step(res, matrix, ranked[:, step:], out_format)
 
         iter += 1
     os.remove('../../TEMP.phy')
@@ -198,6 +275,14 @@ if __name__ == "__main__":
                                 Default: False
                                                """))
 
+    optional.add_argument('-rc', '--rate_cache', type=str, metavar='<dir>',
+                          default=os.path.join(os.path.expanduser('~'), '.cache', 'hiv_wide', 'rate_est'),
+                          help=textwrap.dedent("""\
+                                Directory of cached dist_est rate estimates, keyed by a hash of
+                                the matrix, tree, type and control file.
+                                Default: ~/.cache/hiv_wide/rate_est
+                                """))
+
     args = help_formatter.get_args(parser, optional, required, pre_suf=False, inp_dir=False)
 
     os.mkdir(args.output)
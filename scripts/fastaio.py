@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import argparse
+import bisect
+import bz2
+import contextlib
+import gzip
+import lzma
+import struct
+import tarfile
+from os import path
+
+from Bio import bgzf
+
+# python fastaio.py ../LANL_alignment.tar.xz ../results/alignments/HIV1_FLT_2018_genome_DNA.fa.gz
+
+fasta_extensions = (".fasta", ".fas", ".fa", ".fna")
+tar_extensions = (".tar", ".tar.xz", ".txz", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2")
+compressed_openers = {".xz": lzma.open, ".gz": gzip.open, ".bz2": bz2.open}
+
+
+def fasta_name(out_prefix, compressed=False):
+    return out_prefix + (".fa.gz" if compressed else ".fa")
+
+
+def is_tar(file_path):
+    return file_path.endswith(tar_extensions)
+
+
+def base_name(file_path, member=None):
+    """
+    Name of an alignment without directory, archive, compression or fasta extensions; for an archive
+    the name of the member read from it.
+    """
+    if member is None and is_tar(file_path):
+        # member headers precede their data, so this stops as soon as the member is found
+        with tarfile.open(file_path, "r|*") as archive:
+            member = find_member(archive).name
+    name = path.basename(member if member is not None else file_path)
+    for extension in tar_extensions + tuple(compressed_openers):
+        if name.endswith(extension):
+            name = name[:-len(extension)]
+            break
+    return path.splitext(name)[0]
+
+
+def find_member(archive, member=None):
+    """
+    The archive member named member (full name or basename), or its only fasta file.
+    Members are visited in stream order, so a compressed tarball is never seeked.
+    """
+    for info in archive:
+        if not info.isfile():
+            continue
+        if member is None and info.name.endswith(fasta_extensions):
+            return info
+        if member is not None and member in (info.name, path.basename(info.name)):
+            return info
+    raise KeyError("{} not found in {}".format(member or "A fasta file", archive.name))
+
+
+@contextlib.contextmanager
+def open_input(file_path, member=None):
+    """
+    Opens an alignment for binary reading as a stream, whether plain, gzip/BGZF, xz or bz2 compressed,
+    or a member of a (compressed) tarball such as LANL_alignment.tar.xz, without extracting it.
+    """
+    if is_tar(file_path):
+        with tarfile.open(file_path, "r|*") as archive:
+            yield archive.extractfile(find_member(archive, member))
+        return
+    opener = compressed_openers.get(path.splitext(file_path)[1], open)
+    with opener(file_path, "rb") as f:
+        yield f
+
+
+def read_input(file_path, member=None):
+    with open_input(file_path, member) as f:
+        return f.read()
+
+
+def iter_fasta(handle):
+    """
+    Yields (title, sequence) bytes of every record of a binary fasta stream, one record in memory at a time.
+    Sequences are cleaned up as Bio.SeqIO's fasta parser does.
+    """
+    title = None
+    lines = []
+    for line in handle:
+        if line.startswith(b">"):
+            if title is not None:
+                yield title, b"".join(lines)
+            title = line[1:].rstrip(b"\r\n")
+            lines = []
+        elif title is not None:
+            lines.append(line.rstrip(b"\r\n").replace(b" ", b""))
+    if title is not None:
+        yield title, b"".join(lines)
+
+
+class FastaWriter:
+    """
+    Writes fasta-2line records, BGZF compressed when the file name ends in .gz, and indexes them as
+    it goes: a samtools faidx <file>.fai with each record's offset, plus a <file>.gzi mapping
+    compressed blocks to uncompressed offsets for BGZF output, which RandomReader seeks through.
+    """
+
+    def __init__(self, file_path, index=None):
+        self.path = file_path
+        self.compressed = file_path.endswith(".gz")
+        # plain output is only indexed when asked for, so it stays a single file by default
+        self.index = self.compressed if index is None else index
+        self.handle = bgzf.BgzfWriter(file_path, "wb") if self.compressed else open(file_path, "wb")
+        self.offset = 0
+        self.fai = []
+
+    def write(self, title, seq):
+        header = b">" + title + b"\n"
+        self.handle.write(header)
+        self.handle.write(seq)
+        self.handle.write(b"\n")
+        name = title.split(None, 1)[0].decode()
+        self.fai.append("{}\t{}\t{}\t{}\t{}\n".format(name, len(seq), self.offset + len(header), len(seq), len(seq) + 1))
+        self.offset += len(header) + len(seq) + 1
+
+    def write_records(self, records):
+        for title, seq in records:
+            self.write(title, seq)
+
+    def close(self):
+        self.handle.close()
+        if not self.index:
+            return
+        with open(self.path + ".fai", "w") as f:
+            f.writelines(self.fai)
+        if self.compressed:
+            write_gzi(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_gzi(bgzf_file):
+    """
+    Writes the samtools/htslib .gzi index of a BGZF file: the (compressed, uncompressed) offset of every block
+    after the first.
+    """
+    with open(bgzf_file, "rb") as f:
+        offsets = [(start, data_start) for start, _, data_start, data_length in bgzf.BgzfBlocks(f)
+                   if start > 0 and data_length > 0]
+    with open(bgzf_file + ".gzi", "wb") as f:
+        f.write(struct.pack("<Q", len(offsets)))
+        for pair in offsets:
+            f.write(struct.pack("<QQ", *pair))
+
+
+def read_gzi(gzi_file):
+    with open(gzi_file, "rb") as f:
+        (n_blocks,) = struct.unpack("<Q", f.read(8))
+        pairs = struct.unpack("<{}Q".format(2 * n_blocks), f.read(16 * n_blocks))
+    return [0] + list(pairs[0::2]), [0] + list(pairs[1::2])
+
+
+class RandomReader:
+    """
+    Seeks by uncompressed offset in a plain file, or in a BGZF file through its .gzi index
+    (written on first use if missing).
+    """
+
+    def __init__(self, file_path):
+        self.compressed = file_path.endswith(".gz")
+        if self.compressed:
+            if not path.exists(file_path + ".gzi"):
+                write_gzi(file_path)
+            self.block_starts, self.block_offsets = read_gzi(file_path + ".gzi")
+            self.handle = bgzf.BgzfReader(file_path, "rb")
+        else:
+            self.handle = open(file_path, "rb")
+
+    def seek(self, offset):
+        if not self.compressed:
+            self.handle.seek(offset)
+            return
+        block = bisect.bisect_right(self.block_offsets, offset) - 1
+        self.handle.seek(bgzf.make_virtual_offset(self.block_starts[block], offset - self.block_offsets[block]))
+
+    def read_range(self, offset, length):
+        self.seek(offset)
+        return self.handle.read(length)
+
+    def close(self):
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Rewrites an alignment (plain, compressed or in a tarball) as indexed fasta-2line, "
+                    "BGZF compressed if the output ends in .gz"
+    )
+    parser.add_argument("matrix_in", help="alignment, e.g. LANL_alignment.tar.xz")
+    parser.add_argument("output", help="output fasta (.fa.gz for BGZF); indexes are written next to it")
+    parser.add_argument("--member", help="tarball member to read (default: its only fasta file)")
+    args = parser.parse_args()
+
+    with open_input(args.matrix_in, args.member) as f, FastaWriter(args.output, index=True) as writer:
+        writer.write_records(iter_fasta(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,2 @@
 cd ..
-./scripts/bootstrap_support.py
-./scripts/bootstrap_support.py --mask-as-ref
-./scripts/bootstrap_support.py --all
\ No newline at end of file
+./scripts/bootstrap_support.py --comparisons whole_v_masked masked_v_whole whole_v_allmasks --workers 6
\ No newline at end of file
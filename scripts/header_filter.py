@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import argparse
+import gzip
+import re
+from os import path
+
+import numpy as np
+import pandas as pd
+from Bio import bgzf
+
+from fastaio import RandomReader
+from tables import read_table, write_table
+
+# python header_filter.py ../results/alignments/HIV1_FLT_2018_genome_DNA.fa.gz -o ../results/alignments/BC_2010.fa --subtype B C --min-year 2010
+# python header_filter.py ../LANL_alignment/HIV1_FLT_2018_genome_DNA.fasta -o US_FR.fa --country US FR --query "accession.str.startswith('K')"
+
+# LANL names are subtype.country.year.name.accession, where the name may itself contain dots
+fields = ["subtype", "country", "year", "name", "accession"]
+columns = ["id"] + fields + ["start", "length"]
+record_re = re.compile(rb"^>", re.M)
+# LANL years are two digits; anything above the pivot is 19xx
+year_pivot = 50
+
+
+def parse_header(seqid):
+    """
+    Header fields of a LANL sequence name, e.g. B.FR.83.HXB2_LAI_IIIB_BRU.K03455. Unknown years
+    ("x") are None; names that do not follow the convention only fill what they have.
+    """
+    parts = seqid.split(".", 3)
+    if len(parts) == 4 and "." in parts[3]:
+        parts[3:] = parts[3].rsplit(".", 1)
+    parsed = dict(zip(fields, parts))
+    year = parsed.get("year")
+    if year is not None and year.isdigit():
+        year = int(year)
+        parsed["year"] = year if len(parts[2]) == 4 else year + (1900 if year > year_pivot else 2000)
+    else:
+        parsed["year"] = None
+    return parsed
+
+
+def read_plain(alignment):
+    """
+    The uncompressed bytes of a plain or BGZF alignment, whose offsets RandomReader seeks to.
+    """
+    opener = gzip.open if alignment.endswith(".gz") else open
+    with opener(alignment, "rb") as f:
+        return f.read()
+
+
+def build_index(alignment):
+    """
+    One row per record with its parsed header fields and the byte range [start, start + length)
+    of the whole record (header and sequence lines) in the uncompressed alignment.
+    """
+    data = read_plain(alignment)
+    starts = [match.start() for match in record_re.finditer(data)]
+    ends = starts[1:] + [len(data)]
+    rows = []
+    for start, end in zip(starts, ends):
+        line_end = data.find(b"\n", start, end)
+        title = data[start + 1:line_end if line_end >= 0 else end]
+        row = {"id": title.split(None, 1)[0].decode(), "start": start, "length": end - start}
+        row.update(parse_header(row["id"]))
+        rows.append(row)
+    df = pd.DataFrame(rows, columns=columns)
+    df["year"] = df["year"].astype("Int64")
+    return df
+
+
+def index_file(alignment):
+    return alignment + ".headers.csv"
+
+
+def load_index(alignment, index_path=None):
+    """
+    The header index of an alignment, built and saved next to it the first time, and again
+    whenever the alignment is newer than its index.
+    """
+    index_path = index_path or index_file(alignment)
+    if path.exists(index_path) and path.getmtime(index_path) >= path.getmtime(alignment):
+        # only empty CSV fields are missing, so country codes like NA stay strings; Parquet keeps types
+        csv_options = {} if index_path.endswith(".parquet") else {"keep_default_na": False, "na_values": [""]}
+        df = read_table(index_path, **csv_options)
+        df["year"] = df["year"].astype("Int64")
+        return df
+    df = build_index(alignment)
+    write_table(df, index_path)
+    return df
+
+
+def select(df, subtypes=None, countries=None, min_year=None, max_year=None, query=None):
+    """
+    Rows of a header index matching every given predicate; records with an unknown year never
+    pass a year bound.
+    """
+    keep = np.ones(len(df), dtype=bool)
+    if subtypes:
+        keep &= df["subtype"].isin(subtypes).to_numpy()
+    if countries:
+        keep &= df["country"].isin(countries).to_numpy()
+    if min_year is not None:
+        keep &= (df["year"] >= min_year).fillna(False).to_numpy(dtype=bool)
+    if max_year is not None:
+        keep &= (df["year"] <= max_year).fillna(False).to_numpy(dtype=bool)
+    selected = df[keep]
+    if query:
+        selected = selected.query(query, engine="python")
+    return selected
+
+
+def copy_records(alignment, selected, handle):
+    """
+    Copies the byte ranges of the selected records straight from the alignment, without parsing
+    sequences; adjacent records are copied as one range.
+    """
+    ranges = []
+    for start, length in zip(selected["start"], selected["length"]):
+        if ranges and ranges[-1][0] + ranges[-1][1] == start:
+            ranges[-1][1] += length
+        else:
+            ranges.append([start, length])
+    with RandomReader(alignment) as reader:
+        for start, length in ranges:
+            handle.write(reader.read_range(start, length))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Writes the records of an alignment whose LANL header fields match every given predicate"
+    )
+    parser.add_argument("alignment", help="plain or BGZF (.gz) alignment; convert other inputs with fastaio.py")
+    parser.add_argument("-o", "--output", required=True, help="output fasta, BGZF compressed if it ends in .gz")
+    parser.add_argument("--subtype", nargs="+", metavar="SUBTYPE", help="subtypes to keep, e.g. B C 01_AE")
+    parser.add_argument("--country", nargs="+", metavar="CODE", help="country codes to keep, e.g. US FR")
+    parser.add_argument("--min-year", type=int, help="earliest sampling year to keep")
+    parser.add_argument("--max-year", type=int, help="latest sampling year to keep")
+    parser.add_argument("--query", help="any further pandas query on the index columns: {}".format(", ".join(columns)))
+    parser.add_argument("--index", help="header index (default: <alignment>.headers.csv, built on first use)")
+    parser.add_argument("--table", help="also write the selected index rows to this .csv/.parquet")
+    args = parser.parse_args()
+
+    df = load_index(args.alignment, args.index)
+    selected = select(df, args.subtype, args.country, args.min_year, args.max_year, args.query)
+    print("{} of {} records selected".format(len(selected), len(df)))
+    opener = bgzf.BgzfWriter if args.output.endswith(".gz") else open
+    with opener(args.output, "wb") as f:
+        copy_records(args.alignment, selected, f)
+    if args.table:
+        write_table(selected, args.table)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import numpy as np
+
+from alignment_matrix import GAP
+
+# HXB2 (K03455) coordinates, 1-based and inclusive, from the LANL HXB2 numbering.
+# Genes split over exons are given as several intervals.
+REGIONS = {
+    "5LTR": [(1, 634)],
+    "gag": [(790, 2292)],
+    "pol": [(2085, 5096)],
+    "PR": [(2253, 2549)],
+    "RT": [(2550, 4229)],
+    "IN": [(4230, 5096)],
+    # the ~1300nt protease + start of reverse transcriptase region sequenced for clinical care
+    "PRRT": [(2253, 3554)],
+    "vif": [(5041, 5619)],
+    "vpr": [(5559, 5850)],
+    "tat": [(5831, 6045), (8379, 8469)],
+    "rev": [(5970, 6045), (8379, 8653)],
+    "vpu": [(6062, 6310)],
+    "env": [(6225, 8795)],
+    "gp120": [(6225, 7757)],
+    "V1V2": [(6615, 6812)],
+    "V3": [(7110, 7217)],
+    "gp41": [(7758, 8795)],
+    "nef": [(8797, 9417)],
+    "3LTR": [(9086, 9719)],
+}
+
+
+class HXB2Index:
+    """
+    Maps between ungapped HXB2 positions (0-based) and alignment columns in both directions.
+    """
+
+    def __init__(self, hxb2_row):
+        self.row = np.asarray(hxb2_row, dtype=np.uint8)
+        nongap = self.row != GAP
+        # ungapped position -> column holding it
+        self.columns = np.flatnonzero(nongap)
+        # column -> number of HXB2 nucleotides before it (the position of the nucleotide in that column)
+        self.positions = np.cumsum(nongap) - nongap
+
+    @classmethod
+    def from_matrix(cls, orig_matrix):
+        for i, seqid in enumerate(orig_matrix.ids):
+            if "HXB2" in seqid:
+                return cls(orig_matrix.seqs[i])
+        raise ValueError("No HXB2 sequence in alignment")
+
+    def __len__(self):
+        return len(self.columns)
+
+    def column(self, position):
+        return int(self.columns[position])
+
+    def position(self, column):
+        return int(self.positions[column])
+
+    def column_range(self, start, stop):
+        """
+        Alignment columns [start_col, stop_col) spanning ungapped HXB2 positions [start, stop).
+        """
+        if not 0 <= start < stop <= len(self.columns):
+            raise ValueError(f"HXB2 positions {start}-{stop} are outside HXB2 (length {len(self.columns)})")
+        return (int(self.columns[start]), int(self.columns[stop - 1]) + 1)
+
+    def region_ranges(self, name):
+        if name not in REGIONS:
+            raise KeyError(f"Unknown region {name}, choose from {', '.join(REGIONS)}")
+        return [self.column_range(start - 1, stop) for start, stop in REGIONS[name]]
+
+    def region_mask(self, names):
+        """
+        Boolean column mask covering every interval of every named region.
+        """
+        cols = np.zeros(len(self.row), dtype=bool)
+        for name in names:
+            for start, stop in self.region_ranges(name):
+                cols[start:stop] = True
+        return cols
+
+    def ungapped(self, start_col, stop_col):
+        row = self.row[start_col:stop_col]
+        return row[row != GAP].tobytes().decode()
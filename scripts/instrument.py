@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import argparse
+import contextlib
+import cProfile
+import datetime
+import functools
+import json
+import os
+import re
+import resource
+import socket
+import sys
+import time
+
+# HIV_WIDE_METRICS=../logs/metrics-{job}-{task}.jsonl sbatch 02_iqtree.sh
+# HIV_WIDE_PROFILE=write_mask python shuffle_and_mask.py ...
+# python instrument.py ../logs/metrics-*.jsonl -o ../results/stage_costs.csv
+
+# JSON-lines file records are appended to, with {job}, {task}, {pid} and {host} filled in; unset disables records
+metrics_env = "HIV_WIDE_METRICS"
+# stage name to run under cProfile, dumped to <script>.<stage>.<pid>.prof next to the metrics (or here)
+profile_env = "HIV_WIDE_PROFILE"
+summary_columns = ["script", "stage", "records", "wall_seconds", "mean_wall_seconds", "max_wall_seconds",
+                   "cpu_seconds", "child_cpu_seconds", "max_peak_rss_mb", "read_bytes", "written_bytes", "items"]
+
+# profilers of this process by stage name; a stage run many times accumulates into one profile
+_profilers = {}
+
+
+def peak_rss_kb():
+    """
+    Peak RSS of this process. VmHWM restarts at exec, whereas ru_maxrss keeps the peak of the
+    process that forked this one.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            return int(re.search(r"^VmHWM:\s+(\d+) kB", f.read(), re.M)[1])
+    except (OSError, TypeError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def io_bytes():
+    """
+    Bytes read and written by this process so far (including page cache hits), None where /proc has no io.
+    """
+    try:
+        with open("/proc/self/io") as f:
+            counters = dict(line.split(": ") for line in f.read().splitlines())
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def child_cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def metrics_file():
+    path = os.environ.get(metrics_env)
+    if not path:
+        return None
+    return path.format(job=os.environ.get("SLURM_ARRAY_JOB_ID", os.environ.get("SLURM_JOB_ID", "")),
+                       task=os.environ.get("SLURM_ARRAY_TASK_ID", ""), pid=os.getpid(), host=socket.gethostname())
+
+
+def write_record(record, out_file):
+    # one write per line on an append-mode file, so processes sharing a file do not interleave lines
+    with open(out_file, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+@contextlib.contextmanager
+def stage(name, items=None, **fields):
+    """
+    Measures a stage of a script: wall and CPU time, CPU time of child processes, peak RSS, bytes read
+    and written, and items processed. The yielded dict can be updated inside the block (e.g. its
+    "items"); it is appended as one JSON line to $HIV_WIDE_METRICS. If $HIV_WIDE_PROFILE names this
+    stage it also runs under cProfile.
+    """
+    record = {"stage": name, "items": items, **fields}
+    out_file = metrics_file()
+    profiling = os.environ.get(profile_env) == name
+    if out_file is None and not profiling:
+        yield record
+        return
+    profiler = None
+    if profiling:
+        # keyed by pid too, so a forked worker does not add to the profile it inherited
+        profiler = _profilers.setdefault((os.getpid(), name), cProfile.Profile())
+    read_start, written_start = io_bytes()
+    child_start = child_cpu_seconds()
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield record
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        read_end, written_end = io_bytes()
+        script = os.path.splitext(os.path.basename(sys.argv[0]))[0] or "python"
+        if profiler is not None:
+            profile_dir = os.path.dirname(out_file) if out_file else "."
+            profiler.dump_stats(os.path.join(profile_dir, "{}.{}.{}.prof".format(script, name, os.getpid())))
+        if out_file is not None:
+            record.update({
+                "script": script,
+                "time": datetime.datetime.now().isoformat(timespec="seconds"),
+                "host": socket.gethostname(),
+                "pid": os.getpid(),
+                "job": os.environ.get("SLURM_ARRAY_JOB_ID", os.environ.get("SLURM_JOB_ID")),
+                "task": os.environ.get("SLURM_ARRAY_TASK_ID"),
+                "wall_seconds": round(wall, 6),
+                "cpu_seconds": round(cpu, 6),
+                "child_cpu_seconds": round(child_cpu_seconds() - child_start, 6),
+                "peak_rss_mb": round(peak_rss_kb() / 1024, 1),
+                "read_bytes": read_end - read_start if read_end is not None else None,
+                "written_bytes": written_end - written_start if written_end is not None else None,
+            })
+            write_record(record, out_file)
+
+
+def timed(name=None):
+    """
+    Decorator running every call of a function as a stage (named after the function by default).
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name or fn.__name__):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def read_records(files):
+    records = []
+    for file_path in files:
+        with open(file_path) as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    return records
+
+
+def summarize(records):
+    """
+    Cost of every (script, stage) over all records: totals, mean and max wall time, and max peak RSS.
+    """
+    import pandas as pd
+
+    df = pd.DataFrame(records)
+    if df.empty:
+        return pd.DataFrame(columns=summary_columns)
+    for column in ("items", "read_bytes", "written_bytes", "child_cpu_seconds"):
+        if column not in df:
+            df[column] = None
+        df[column] = pd.to_numeric(df[column])
+    summary = df.groupby(["script", "stage"]).agg(
+        records=("wall_seconds", "size"),
+        wall_seconds=("wall_seconds", "sum"),
+        mean_wall_seconds=("wall_seconds", "mean"),
+        max_wall_seconds=("wall_seconds", "max"),
+        cpu_seconds=("cpu_seconds", "sum"),
+        child_cpu_seconds=("child_cpu_seconds", "sum"),
+        max_peak_rss_mb=("peak_rss_mb", "max"),
+        read_bytes=("read_bytes", "sum"),
+        written_bytes=("written_bytes", "sum"),
+        items=("items", "sum"),
+    ).reset_index()
+    for column in ("read_bytes", "written_bytes", "items"):
+        summary[column] = summary[column].astype("Int64")
+    return summary.sort_values("wall_seconds", ascending=False, ignore_index=True)[summary_columns]
+
+
+def main():
+    from tables import write_table
+
+    parser = argparse.ArgumentParser(description="Sums the stage records of instrumented runs per script and stage")
+    parser.add_argument("files", nargs="+", help="JSON-lines files written through $HIV_WIDE_METRICS")
+    parser.add_argument("-o", "--output", help="summary table, .csv or .parquet (default: print it)")
+    args = parser.parse_args()
+
+    summary = summarize(read_records(args.files))
+    if args.output:
+        write_table(summary, args.output)
+    else:
+        print(summary.to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
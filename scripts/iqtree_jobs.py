@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+from glob import glob
+
+from fastaio import base_name
+from mask_manifest import load_alignment, materialize, read_manifest
+
+# python iqtree_jobs.py ../results/alignments ../results/trees --models free fixed --cores 64 --threads 8
+# python iqtree_jobs.py ../results/alignments ../results/trees --manifest ../results/alignments/HIV1_FLT_2018_genome_DNA_subtypeB_masks.json --dry-run
+# python iqtree_jobs.py ../results/alignments ../results/trees --iqtree "singularity exec ../metadata/rkantor_hiv.simg iqtree"
+
+alignment_regex = re.compile(r"^(?P<base>.+)_(?P<seed>\d+)_mask(?P<mask>\d+)\.fa(?:\.gz)?$")
+# shared by every model, as in 02_iqtree.sh and 03_iqtree_fixedparams.sh
+support_args = ["-alrt", "1000", "-bb", "1000", "-wbt", "-wbtl"]
+# output subdirectory of the tree directory and model arguments of each parameter set
+models = {
+    "free": ("", ["-m", "GTR+F+I+G4"]),
+    "fixed": ("fixedparams", ["-m", "GTR{2.09420,4.76260,0.89580,0.98320,5.5322}+F{0.363,0.17600,0.23900,0.22200}+I+G4",
+                              "-a", "0.51560", "-i", "0.10650"]),
+}
+
+# set in the parent before the pool forks so workers share them copy-on-write
+_iqtree = None
+_threads = None
+_mem = None
+_manifest = None
+_orig_matrix = None
+
+
+def find_alignments(alignment_dir):
+    """
+    (seed, mask, alignment file) of every <seed>/<base>_<seed>_mask<mask>.fa(.gz) under alignment_dir,
+    as written by shuffle_and_mask.py.
+    """
+    alignments = []
+    for file_path in sorted(glob(os.path.join(alignment_dir, "*", "*.fa*"))):
+        match = alignment_regex.match(os.path.basename(file_path))
+        if match and os.path.basename(os.path.dirname(file_path)) == match["seed"]:
+            alignments.append((int(match["seed"]), match["mask"], file_path))
+    return alignments
+
+
+def manifest_alignments(manifest, alignment_dir):
+    """
+    (seed, mask, alignment file) of every entry of a shuffle_and_mask.py manifest; the files are
+    materialized when their job runs.
+    """
+    base = base_name(manifest["alignment"], manifest.get("member"))
+    return [(entry["seed"], "{:0>3}".format(entry["mask"]),
+             os.path.join(alignment_dir, str(entry["seed"]), "{}_{}_mask{:0>3}.fa".format(base, entry["seed"], entry["mask"])))
+            for entry in manifest["entries"]]
+
+
+def build_jobs(alignments, tree_dir, model_names):
+    """
+    One job per distinct (seed, mask, model), in seed, mask, model order. An alignment found twice
+    (e.g. as .fa and .fa.gz) is run once.
+    """
+    jobs = {}
+    for seed, mask, alignment in alignments:
+        for model in model_names:
+            key = (seed, mask, model)
+            if key in jobs:
+                continue
+            subdir, _ = models[model]
+            name = os.path.basename(alignment)
+            name = name[:-len(".gz")] if name.endswith(".gz") else name
+            jobs[key] = {
+                "seed": seed,
+                "mask": mask,
+                "model": model,
+                "alignment": alignment,
+                "prefix": os.path.join(tree_dir, subdir, str(seed), name),
+            }
+    return [jobs[key] for key in sorted(jobs)]
+
+
+def is_done(job):
+    """
+    A job is done once IQ-TREE has written its tree and closed its report; an interrupted run is
+    resumed by IQ-TREE from its own checkpoint.
+    """
+    report = job["prefix"] + ".iqtree"
+    if not os.path.exists(job["prefix"] + ".treefile") or not os.path.exists(report):
+        return False
+    with open(report, "rb") as f:
+        f.seek(max(0, os.path.getsize(report) - (1 << 13)))
+        return b"TIME STAMP" in f.read()
+
+
+def iqtree_command(job, alignment):
+    command = _iqtree + ["-nt", str(_threads)]
+    if _mem:
+        command += ["-mem", _mem]
+    return command + ["-s", alignment] + models[job["model"]][1] + support_args + ["-pre", job["prefix"]]
+
+
+def run_job(job):
+    """
+    Runs one job, returning it with its exit code and run time; output goes to <prefix>.stdout.
+    """
+    os.makedirs(os.path.dirname(job["prefix"]), exist_ok=True)
+    start = time.time()
+    with tempfile.TemporaryDirectory() as scratch:
+        alignment = job["alignment"]
+        if _manifest is not None:
+            alignment = os.path.join(scratch, os.path.basename(alignment))
+            with open(alignment, "wb") as f:
+                materialize(_manifest, _orig_matrix, job["seed"], int(job["mask"]), f)
+        with open(job["prefix"] + ".stdout", "wb") as out:
+            returncode = subprocess.run(iqtree_command(job, alignment), stdout=out, stderr=subprocess.STDOUT).returncode
+    return job, returncode, time.time() - start
+
+
+def main():
+    global _iqtree, _threads, _mem, _manifest, _orig_matrix
+    parser = argparse.ArgumentParser(
+        description="Runs IQ-TREE on every (seed, mask, model) of the masked alignments once, skipping finished "
+                    "trees and packing jobs onto the cores of one node"
+    )
+    parser.add_argument("alignment_dir", help="directory with the <seed>/ alignment directories of shuffle_and_mask.py")
+    parser.add_argument("tree_dir", help="output directory; trees go to <seed>/ and fixedparams/<seed>/ as in 02/03_iqtree*.sh")
+    parser.add_argument("--models", nargs="+", choices=list(models), default=["free"],
+                        help="parameter sets to run (default: free)")
+    parser.add_argument("--fixed-args",
+                        help="model arguments of the fixed parameter set, e.g. the output of iqtree_params.py --fixed-args")
+    parser.add_argument("--manifest", help="shuffle_and_mask.py manifest; alignments are materialized in a temporary directory per job")
+    parser.add_argument("--cores", type=int, default=os.cpu_count(), help="cores to pack jobs onto (default: all)")
+    parser.add_argument("--threads", type=int, default=8, help="iqtree -nt per job (default: 8)")
+    parser.add_argument("--mem", help="iqtree -mem per job, e.g. 16G")
+    parser.add_argument("--iqtree", default="iqtree", help="iqtree command, split like a shell would (default: iqtree)")
+    parser.add_argument("--jobs", help="write the job list to this .json")
+    parser.add_argument("--dry-run", action="store_true", help="list the jobs that would run and exit")
+    args = parser.parse_args()
+
+    if args.fixed_args:
+        models["fixed"] = (models["fixed"][0], shlex.split(args.fixed_args))
+    if args.manifest:
+        _manifest = read_manifest(args.manifest)
+        alignments = manifest_alignments(_manifest, args.alignment_dir)
+    else:
+        alignments = find_alignments(args.alignment_dir)
+    jobs = build_jobs(alignments, args.tree_dir, args.models)
+    if args.jobs:
+        with open(args.jobs, "w") as f:
+            json.dump(jobs, f, indent=1)
+    todo = [job for job in jobs if not is_done(job)]
+    print("{} jobs ({} alignments x {} models), {} already done".format(
+        len(jobs), len(alignments), len(args.models), len(jobs) - len(todo)))
+
+    _iqtree = shlex.split(args.iqtree)
+    _threads = args.threads
+    _mem = args.mem
+    if args.dry_run:
+        for job in todo:
+            print(shlex.join(iqtree_command(job, job["alignment"])))
+        return
+    if _manifest is not None and todo:
+        _orig_matrix = load_alignment(_manifest)
+
+    failed = 0
+    workers = max(1, min(len(todo), args.cores // args.threads))
+    ctx = multiprocessing.get_context("fork")
+    with ctx.Pool(workers) as pool:
+        for job, returncode, seconds in pool.imap_unordered(run_job, todo):
+            status = "done" if returncode == 0 else "FAILED ({})".format(returncode)
+            print("seed {} mask {} {}: {} in {:.0f}s".format(job["seed"], job["mask"], job["model"], status, seconds))
+            failed += returncode != 0
+    if failed:
+        sys.exit("{} of {} jobs failed".format(failed, len(todo)))
+    print("Done.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import argparse
+import multiprocessing
+import os
+import re
+import sys
+from glob import glob
+
+import pandas as pd
+
+from tables import write_table
+
+# python iqtree_params.py ../results/trees -o ../results/iqtree_params.parquet --workers 8
+
+report_regex = re.compile(r"(?:_(\d+))?_mask(\d+)\.fa\.iqtree$")
+dashes_re = re.compile(r"^-+$")
+# one-line values, found wherever they are in the report
+scalars = [
+    ("n_seqs", "n_sites", re.compile(r"^Input data: (\d+) sequences with (\d+) ")),
+    ("model", re.compile(r"^Model of substitution: (\S+)")),
+    ("best_fit_model", re.compile(r"^Best-fit model according to \w+: (\S+)")),
+    ("rate_heterogeneity", re.compile(r"^Model of rate heterogeneity: (.+)")),
+    ("pinv", re.compile(r"^Proportion of invariable sites: (\S+)")),
+    ("alpha", re.compile(r"^Gamma shape alpha: (\S+)")),
+    ("logl", "logl_se", re.compile(r"^Log-likelihood of the tree: (\S+) \(s\.e\. ([^)]+)\)")),
+    ("unconstrained_logl", re.compile(r"^Unconstrained log-likelihood \(without tree\): (\S+)")),
+    ("n_free_params", re.compile(r"^Number of free parameters .*: (\d+)")),
+    ("aic", re.compile(r"^Akaike information criterion \(AIC\) score: (\S+)")),
+    ("aicc", re.compile(r"^Corrected Akaike information criterion \(AICc\) score: (\S+)")),
+    ("bic", re.compile(r"^Bayesian information criterion \(BIC\) score: (\S+)")),
+    ("tree_length", re.compile(r"^Total tree length \(sum of branch lengths\): (\S+)")),
+    ("cpu_time", re.compile(r"^Total CPU time used: (\S+) seconds")),
+    ("wall_time", re.compile(r"^Total wall-clock time used: (\S+) seconds")),
+]
+# indented rows of a block, keyed by the line that opens the block
+blocks = [
+    ("Rate parameter R:", re.compile(r"^\s+([ACGT])-([ACGT]): (\S+)"), lambda m: ("rate_" + m[1] + m[2], m[3])),
+    ("State frequencies:", re.compile(r"^\s+pi\(([A-Z])\) = (\S+)"), lambda m: ("pi_" + m[1], m[2])),
+    (" Category  Relative_rate  Proportion", re.compile(r"^\s+(\d+)\s+(\S+)\s+(\S+)$"),
+     lambda m: (("category{}_rate".format(m[1]), m[2]), ("category{}_proportion".format(m[1]), m[3]))),
+]
+text_fields = {"model", "best_fit_model", "rate_heterogeneity"}
+int_fields = {"n_seqs", "n_sites", "n_free_params"}
+
+
+def parse_lines(lines, params):
+    """
+    Fills params from report lines. Stops at the text drawing of the tree, which is most of a
+    report, and returns the section it stopped in (None if it read every line).
+    """
+    section = None
+    previous = ""
+    block = None
+    for line in lines:
+        line = line.rstrip("\n")
+        if dashes_re.match(line) and len(line) == len(previous):
+            section = previous
+        if section == "MAXIMUM LIKELIHOOD TREE" and "+--" in line:
+            return section
+        if block is not None:
+            match = block[1].match(line)
+            if match:
+                values = block[2](match)
+                for field, value in values if isinstance(values[0], tuple) else (values,):
+                    params[field] = float(value)
+                previous = line
+                continue
+            if line.strip() and not line.startswith(block[0]):
+                block = None
+        for opener in blocks:
+            if line.startswith(opener[0]):
+                block = opener
+                break
+        else:
+            for *fields, regex in scalars:
+                match = regex.match(line)
+                if match:
+                    for field, value in zip(fields, match.groups()):
+                        if field in text_fields:
+                            params[field] = value
+                        elif field in int_fields:
+                            params[field] = int(value)
+                        else:
+                            params[field] = float(value)
+                    break
+        previous = line
+    return None
+
+
+def parse_report(report_file, tail_bytes=1 << 13):
+    """
+    Parameters of one .iqtree report by section, whatever line they are on: GTR rates, state
+    frequencies, invariant proportion, gamma shape, rate categories, log-likelihood and run time.
+    Only the head and the TIME STAMP section at the end are read.
+    """
+    params = {}
+    with open(report_file) as f:
+        if parse_lines(f, params) is not None:
+            # the run time follows the (long) tree sections at the end of the report
+            size = os.fstat(f.fileno()).st_size
+            while True:
+                start = max(0, size - tail_bytes)
+                f.seek(start)
+                tail = f.read()
+                if "TIME STAMP" in tail or start == 0:
+                    break
+                tail_bytes *= 4
+            parse_lines(tail[tail.find("TIME STAMP"):].splitlines(), params)
+    return params
+
+
+def find_reports(paths):
+    """
+    Every .iqtree report among paths (files, or directories searched recursively).
+    """
+    reports = []
+    for path in paths:
+        if os.path.isdir(path):
+            reports.extend(sorted(glob(os.path.join(path, "**", "*.iqtree"), recursive=True)))
+        else:
+            reports.append(path)
+    return reports
+
+
+def report_row(report_file):
+    match = report_regex.search(report_file)
+    seed, mask = match.groups() if match else (None, None)
+    row = {
+        "file": report_file,
+        # 03_iqtree_fixedparams.sh writes to <tree dir>/fixedparams/<seed>/
+        "param_set": "fixed" if "fixedparams" in report_file.split(os.sep) else "free",
+        "seed": int(seed) if seed is not None else None,
+        "mask": int(mask) if mask is not None else None,
+    }
+    row.update(parse_report(report_file))
+    return row
+
+
+def fixed_args(df):
+    """
+    iqtree model arguments fixing the median parameters of df, as used in 03_iqtree_fixedparams.sh.
+    """
+    median = df.median(numeric_only=True)
+    rates = ",".join("{:.5f}".format(median["rate_" + pair]) for pair in ("AC", "AG", "AT", "CG", "CT"))
+    freqs = ",".join("{:.5f}".format(median["pi_" + base]) for base in "ACGT")
+    return '-m "GTR{{{}}}+F{{{}}}+I+G4" -a {:.5f} -i {:.5f}'.format(rates, freqs, median["alpha"], median["pinv"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Collects model parameters from IQ-TREE .iqtree reports into one table")
+    parser.add_argument("paths", nargs="+", help=".iqtree reports or directories to search for them")
+    parser.add_argument("-o", "--output", default="iqtree_params.csv",
+                        help="parameter table, .csv or .parquet (default: iqtree_params.csv)")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="number of worker processes (default: 1)")
+    parser.add_argument("--fixed-args", action="store_true",
+                        help="print iqtree arguments fixing the median GTR+F+I+G4 parameters of the reports")
+    args = parser.parse_args()
+
+    # with --fixed-args stdout is only the arguments, so it can be passed on as $(iqtree_params.py ...)
+    log = sys.stderr if args.fixed_args else sys.stdout
+    reports = find_reports(args.paths)
+    print("Parsing {} reports...".format(len(reports)), file=log)
+    if args.workers > 1:
+        ctx = multiprocessing.get_context("fork")
+        with ctx.Pool(args.workers) as pool:
+            rows = pool.map(report_row, reports, chunksize=16)
+    else:
+        rows = [report_row(report) for report in reports]
+
+    df = pd.DataFrame(rows)
+    if not df.empty:
+        df["seed"] = df["seed"].astype("Int64")
+        df["mask"] = df["mask"].astype("Int64")
+    write_table(df, args.output)
+    if args.fixed_args:
+        print(fixed_args(df))
+    print("Done.", file=log)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,67 +1,63 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import sys
+import argparse
 from os import path
-import random
 
-from Bio import SeqIO
-from Bio.Seq import Seq
+import numpy as np
 
-random.seed(42)
+from alignment_matrix import AlignmentMatrix
+from fastaio import base_name, fasta_name
+from hxb2 import REGIONS, HXB2Index
+from instrument import stage
 
 # masks gp120 from alignment
 # gp120 coordinates on hxb2: 6615, 6812
 # to run: python mask_gp120.py ../results/alignments/HIV1_FLT_2018_genome_DNA_subtypeB.fa ../results/alignments
+# any regions from hxb2.REGIONS can be masked together instead:
+# python mask_gp120.py ../results/alignments/HIV1_FLT_2018_genome_DNA_subtypeB.fa ../results/alignments -r V3 nef
 
-def get_hxb2_coords(orig_matrix, start, stop):
+
+def get_hxb2_coords(hxb2, start, stop):
     """
     Get hxb2 coordinates for any given start and stop position
     """
-    ungapped_hxb2_start = start  # 0-based
-    ungapped_hxb2_stop = stop
-    for seqid in orig_matrix:
-        if "HXB2" in seqid:
-            HXB2 = seqid
-            break
-    nogap = 0
-    hxb2_start = 0
-    hxb2_stop = 0
-    for i, nt in enumerate(orig_matrix[HXB2]):
-        if nogap == ungapped_hxb2_start:
-            hxb2_start = i
-        elif nogap == ungapped_hxb2_stop:
-            hxb2_stop = i
-        if hxb2_start > 0 and hxb2_stop > 0:
-            break
-        if nt != "-":
-            nogap += 1
-    hxb2_nt = Seq(
-        "".join([x for x in orig_matrix[HXB2][hxb2_start:hxb2_stop] if x != "-"])
-    )
-    return (hxb2_start, hxb2_stop)
-
-def mask_region(seqs_dict, mask_char, start, stop):
-    for i in seqs_dict:
-        seq = seqs_dict[i]
-        yield seq[:start] + len(seq[start:stop]) * mask_char + seq[stop:]
-
-matrix_in = path.abspath(sys.argv[1])
-out_dir = path.abspath(sys.argv[2])
-out_prefix = path.join(out_dir, path.splitext(path.basename(matrix_in))[0])
-mask_character = "-"
-
-orig_matrix = SeqIO.index(matrix_in, "fasta")
-gp120_start, gp120_stop = get_hxb2_coords(orig_matrix, 6615, 6812)
-shuff_ids_list = [x for x in orig_matrix]
-
-with open(f"{out_prefix}_maskgp120.fa", "w") as masked_matrix:
-    SeqIO.write(
-        mask_region(
-            orig_matrix,
-            mask_character,
-            gp120_start,
-            gp120_stop,
-            ),
-            masked_matrix,
-            "fasta-2line",
-        )
+    return hxb2.column_range(start, stop)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Masks HXB2 regions from every sequence of an alignment")
+    parser.add_argument("matrix_in", help="path to alignment (plain, compressed or in a tarball)")
+    parser.add_argument("out_dir", help="output directory")
+    parser.add_argument("-r", "--regions", nargs="+", choices=list(REGIONS), metavar="REGION",
+                        help="regions to mask in a single pass, from: {} (default: gp120 as 6615-6812)".format(
+                            ", ".join(REGIONS)))
+    parser.add_argument("--member", help="tarball member to read (default: its only fasta file)")
+    parser.add_argument("-z", "--bgzf", action="store_true",
+                        help="write BGZF-compressed .fa.gz with .fai/.gzi record indexes")
+    args = parser.parse_args()
+
+    matrix_in = path.abspath(args.matrix_in)
+    out_dir = path.abspath(args.out_dir)
+    out_prefix = path.join(out_dir, base_name(matrix_in, args.member))
+    mask_character = "-"
+
+    with stage("parse_alignment") as record:
+        orig_matrix = AlignmentMatrix.from_fasta(matrix_in, args.member)
+        record["items"] = len(orig_matrix)
+    with stage("compute_coords"):
+        hxb2 = HXB2Index.from_matrix(orig_matrix)
+        if args.regions:
+            region_cols = hxb2.region_mask(args.regions)
+            suffix = "_".join(args.regions)
+        else:
+            gp120_start, gp120_stop = get_hxb2_coords(hxb2, 6615, 6812)
+            region_cols = np.zeros(orig_matrix.shape[1], dtype=bool)
+            region_cols[gp120_start:gp120_stop] = True
+            suffix = "gp120"
+
+    with stage("write_mask", items=len(orig_matrix), mask=suffix):
+        masked = orig_matrix.masked(np.ones(len(orig_matrix), dtype=bool), ~region_cols, mask_character)
+        orig_matrix.save_fasta(fasta_name(f"{out_prefix}_mask{suffix}", args.bgzf), masked)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import argparse
+import base64
+import hashlib
+import json
+import random
+import sys
+from os import path
+
+import numpy as np
+
+from alignment_matrix import AlignmentMatrix, column_mask
+
+# python mask_manifest.py ../results/alignments/HIV1_FLT_2018_genome_DNA_subtypeB_masks.json 14942603 10 -o masked.fa
+# python mask_manifest.py ../results/alignments/HIV1_FLT_2018_genome_DNA_subtypeB_masks.json --seeds
+
+
+def shuffled_rows(seed, n_rows):
+    """
+    Row order for a seed; this is the order masked alignments are written in.
+    """
+    order = list(range(n_rows))
+    random.Random(seed).shuffle(order)
+    return order
+
+
+def masked_rows(order, pct_to_mask):
+    """
+    Rows are masked in shuffled order; the first n_to_mask + 1 rows of order are masked
+    (so 100% masks every row).
+    """
+    n_to_mask = round(len(order) * pct_to_mask / 100)
+    rows = np.zeros(len(order), dtype=bool)
+    rows[order[: n_to_mask + 1]] = True
+    return rows
+
+
+def file_sha256(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def encode_rows(rows):
+    return base64.b64encode(np.packbits(rows).tobytes()).decode()
+
+
+def decode_rows(encoded, n_rows):
+    packed = np.frombuffer(base64.b64decode(encoded), dtype=np.uint8)
+    return np.unpackbits(packed, count=n_rows).astype(bool)
+
+
+def build_manifest(matrix_in, orig_matrix, seeds, pct_masks, keep_start, keep_stop, mask_char="-", member=None):
+    """
+    A manifest describes every (seed, mask) alignment by the bitset of its masked rows,
+    so alignments can be materialized on demand instead of stored.
+    """
+    n_rows, n_cols = orig_matrix.shape
+    entries = []
+    for seed in seeds:
+        order = shuffled_rows(seed, n_rows)
+        for pct_to_mask in pct_masks:
+            entries.append(
+                {
+                    "seed": seed,
+                    "mask": pct_to_mask,
+                    "rows": encode_rows(masked_rows(order, pct_to_mask)),
+                }
+            )
+    return {
+        "alignment": path.abspath(matrix_in),
+        "sha256": file_sha256(matrix_in),
+        "member": member,
+        "n_rows": n_rows,
+        "n_cols": n_cols,
+        "mask_char": mask_char,
+        "keep": [keep_start, keep_stop],
+        "entries": entries,
+    }
+
+
+def write_manifest(manifest, out_file):
+    with open(out_file, "w") as f:
+        json.dump(manifest, f)
+
+
+def read_manifest(manifest_file):
+    with open(manifest_file) as f:
+        return json.load(f)
+
+
+def find_entry(manifest, seed, pct_to_mask):
+    for entry in manifest["entries"]:
+        if entry["seed"] == seed and entry["mask"] == pct_to_mask:
+            return entry
+    raise KeyError(f"No alignment for seed {seed} mask {pct_to_mask} in manifest")
+
+
+def load_alignment(manifest, matrix_in=None):
+    """
+    Loads the manifest's source alignment, refusing one that has changed since the manifest was written.
+    """
+    if matrix_in is None:
+        matrix_in = manifest["alignment"]
+    if file_sha256(matrix_in) != manifest["sha256"]:
+        raise ValueError(f"{matrix_in} does not match the alignment this manifest was built from")
+    return AlignmentMatrix.from_fasta(matrix_in, manifest.get("member"))
+
+
+def materialize(manifest, orig_matrix, seed, pct_to_mask, handle):
+    entry = find_entry(manifest, seed, pct_to_mask)
+    n_rows, n_cols = orig_matrix.shape
+    keep_start, keep_stop = manifest["keep"]
+    masked = orig_matrix.masked(
+        decode_rows(entry["rows"], n_rows),
+        column_mask(n_cols, keep_start, keep_stop),
+        manifest["mask_char"],
+    )
+    orig_matrix.write_fasta(handle, masked, shuffled_rows(seed, n_rows))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Writes a masked alignment described by a shuffle_and_mask.py manifest"
+    )
+    parser.add_argument("manifest", help="manifest written by shuffle_and_mask.py --manifest")
+    parser.add_argument("seed", type=int, nargs="?")
+    parser.add_argument("mask", type=int, nargs="?", help="percentage of rows masked")
+    parser.add_argument("-o", "--output", default="-",
+                        help="output file or named pipe, - for stdout (default: -)")
+    parser.add_argument("-a", "--alignment",
+                        help="source alignment, if it has moved since the manifest was written")
+    parser.add_argument("--seeds", action="store_true", help="list the manifest's seeds and exit")
+    args = parser.parse_args()
+
+    manifest = read_manifest(args.manifest)
+    if args.seeds:
+        seeds = dict.fromkeys(entry["seed"] for entry in manifest["entries"])
+        print("\n".join(str(seed) for seed in seeds))
+        return
+    if args.seed is None or args.mask is None:
+        parser.error("seed and mask are required")
+
+    orig_matrix = load_alignment(manifest, args.alignment)
+    if args.output == "-":
+        materialize(manifest, orig_matrix, args.seed, args.mask, sys.stdout.buffer)
+    else:
+        with open(args.output, "wb") as f:
+            materialize(manifest, orig_matrix, args.seed, args.mask, f)
+
+
+if __name__ == "__main__":
+    main()
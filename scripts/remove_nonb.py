@@ -1,23 +1,41 @@
 #!/usr/bin/env python3
-import sys
+import argparse
 from os import path
 
-from Bio import SeqIO
-from Bio.Seq import Seq
+from fastaio import FastaWriter, base_name, fasta_name, iter_fasta, open_input
+from instrument import stage
 
 # python remove_nonb.py ../LANL_alignment/HIV1_FLT_2018_genome_DNA.fasta ../results/alignments
+# or straight from the tarball, writing an indexed BGZF alignment:
+# python remove_nonb.py ../LANL_alignment.tar.xz ../results/alignments --bgzf
 
 # removes non subtype B sequences
-def remove_nonb(orig_matrix):
-    for seqid in orig_matrix:
-        if seqid.startswith("B."):
-            yield orig_matrix[seqid]
+def remove_nonb(records):
+    for title, seq in records:
+        if title.startswith(b"B."):
+            yield title, seq
 
-matrix_in = path.abspath(sys.argv[1])
-out_dir = path.abspath(sys.argv[2])
-out_prefix = path.join(out_dir, path.splitext(path.basename(matrix_in))[0]+"_subtypeB")
 
-orig_matrix = SeqIO.index(matrix_in, "fasta")
+def main():
+    parser = argparse.ArgumentParser(description="Filters an alignment down to subtype B sequences")
+    parser.add_argument("matrix_in", help="path to full alignment (plain, compressed or in a tarball)")
+    parser.add_argument("out_dir", help="output directory")
+    parser.add_argument("--member", help="tarball member to read (default: its only fasta file)")
+    parser.add_argument("-z", "--bgzf", action="store_true",
+                        help="write a BGZF-compressed .fa.gz with .fai/.gzi record indexes")
+    args = parser.parse_args()
 
-with open(f"{out_prefix}.fa", "w") as f:
-    SeqIO.write(remove_nonb(orig_matrix),f,"fasta-2line")
\ No newline at end of file
+    matrix_in = path.abspath(args.matrix_in)
+    out_dir = path.abspath(args.out_dir)
+    out_prefix = path.join(out_dir, base_name(matrix_in, args.member) + "_subtypeB")
+
+    # records stream from the input to the output, so the input never has to be extracted or seekable
+    with stage("filter_subtype", items=0) as record, open_input(matrix_in, args.member) as f, \
+            FastaWriter(fasta_name(out_prefix, args.bgzf)) as writer:
+        for title, seq in remove_nonb(iter_fasta(f)):
+            writer.write(title, seq)
+            record["items"] += 1
+
+
+if __name__ == "__main__":
+    main()
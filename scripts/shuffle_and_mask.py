@@ -1,41 +1,33 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import argparse
+import multiprocessing
 import sys
 from os import path, mkdir
 import random
 
-from Bio import SeqIO
 from Bio.Seq import Seq
 
-random.seed(42)
-seeds = random.sample(range(0,100000000), 100)
+from alignment_matrix import AlignmentMatrix, column_mask
+from fastaio import base_name, fasta_name
+from hxb2 import HXB2Index
+from instrument import stage
+from mask_manifest import build_manifest, masked_rows, shuffled_rows, write_manifest
 
-def get_HXB2_pol_coords(orig_matrix):
+
+def get_seeds(n_seeds):
+    """
+    Seeds come from a generator seeded with 42, so the first k seeds are the same whatever n_seeds is.
+    """
+    return random.Random(42).sample(range(0,100000000), n_seeds)
+
+def get_HXB2_pol_coords(hxb2):
     """
     This is the ~1300nt region of pol that is commonly sequenced for clinical care (usually called "PRRT" for Protease + the beginning of Reverse Transcriptase):
     HXB2 positions 2253-3554
     """
-    ungapped_pol_start = 2252  # 0-based
-    ungapped_pol_stop = 3554
-    for seqid in orig_matrix:
-        if "HXB2" in seqid:
-            HXB2 = seqid
-            break
-    nogap = 0
-    pol_start = 0
-    pol_stop = 0
-    for i, nt in enumerate(orig_matrix[HXB2]):
-        if nogap == ungapped_pol_start:
-            pol_start = i
-        elif nogap == ungapped_pol_stop:
-            pol_stop = i
-        if pol_start > 0 and pol_stop > 0:
-            break
-        if nt != "-":
-            nogap += 1
-    pol_nt = Seq(
-        "".join([x for x in orig_matrix[HXB2][pol_start:pol_stop] if x != "-"])
-    )
+    [(pol_start, pol_stop)] = hxb2.region_ranges("PRRT")
+    pol_nt = Seq(hxb2.ungapped(pol_start, pol_stop))
     pol = pol_nt.translate()
     if not pol.startswith("PQVTL") or not pol.endswith("QGQG"):
         print("Couldn't find HXB2's pol, check expected pol positions")
@@ -44,49 +36,78 @@ def get_HXB2_pol_coords(orig_matrix):
     return (pol_start, pol_stop)
 
 
-def mask_around(seq, mask_char, start, stop):
-    left_pad = len(seq[:start]) * mask_char
-    right_pad = len(seq[stop:]) * mask_char
-    return left_pad + seq[start:stop] + right_pad
-
-
-def generate_sequences(seqs_dict, id_list, n_to_mask, mask_char, start, stop):
-    for i, seq_id in enumerate(id_list):
-        if i <= n_to_mask:
-            yield mask_around(seqs_dict[seq_id], mask_char, start, stop)
-        else:
-            yield seqs_dict[seq_id]
-
-def mask_write(seed, orig_matrix, out_prefix):
+def mask_write(seed, orig_matrix, pol_cols, out_prefix, pct_masks=range(10, 101, 10), compressed=False):
     mask_character = "-"
-    pol_start, pol_stop = get_HXB2_pol_coords(orig_matrix)
-
-    shuff_ids_list = [x for x in orig_matrix]
-    random.Random(seed).shuffle(shuff_ids_list)
-    for pct_to_mask in range(1, 11):
-        n_to_mask = round(len(shuff_ids_list) * pct_to_mask / 10)
-        with open(f"{out_prefix}_mask{pct_to_mask*10:0>3}.fa", "w") as masked_matrix:
-            SeqIO.write(
-                generate_sequences(
-                    orig_matrix,
-                    shuff_ids_list,
-                    n_to_mask,
-                    mask_character,
-                    pol_start,
-                    pol_stop,
-                ),
-                masked_matrix,
-                "fasta-2line",
+
+    shuff_ids_list = shuffled_rows(seed, len(orig_matrix))
+    for pct_to_mask in pct_masks:
+        with stage("write_mask", items=len(orig_matrix), seed=seed, mask=pct_to_mask):
+            masked = orig_matrix.masked(
+                masked_rows(shuff_ids_list, pct_to_mask), pol_cols, mask_character
             )
+            orig_matrix.save_fasta(fasta_name(f"{out_prefix}_mask{pct_to_mask:0>3}", compressed), masked, shuff_ids_list)
 
-matrix_in = path.abspath(sys.argv[1])
-out_dir = path.abspath(sys.argv[2])
-out_prefix = path.join(out_dir, path.splitext(path.basename(matrix_in))[0])
-orig_matrix = SeqIO.index(matrix_in, "fasta")
+# set in the parent before the pool forks so workers share it copy-on-write
+_orig_matrix = None
 
-for seed in seeds:
+
+def seed_write(seed, out_dir, name, pol_cols, pct_masks, compressed=False):
     seed_dir = path.join(out_dir, str(seed))
     if not path.exists(seed_dir):
         mkdir(seed_dir)
-    out_prefix = path.join(seed_dir, path.splitext(path.basename(matrix_in))[0]+ f"_{seed}")
-    mask_write(seed, orig_matrix, out_prefix)
+    out_prefix = path.join(seed_dir, name + f"_{seed}")
+    mask_write(seed, _orig_matrix, pol_cols, out_prefix, pct_masks, compressed)
+    return seed
+
+
+def main():
+    global _orig_matrix
+    parser = argparse.ArgumentParser(
+        description="Shuffles rows of an alignment and writes alignments masked down to PRRT"
+    )
+    parser.add_argument("matrix_in", help="path to alignment (plain, compressed or in a tarball)")
+    parser.add_argument("out_dir", help="output directory")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="number of worker processes (default: 1)")
+    parser.add_argument("-n", "--n-seeds", type=int, default=100,
+                        help="number of shuffling seeds (default: 100)")
+    parser.add_argument("-m", "--masks", type=int, nargs="+", default=list(range(10, 101, 10)),
+                        metavar="PCT", help="percentages of rows to mask (default: 10 20 ... 100)")
+    parser.add_argument("--manifest", action="store_true",
+                        help="write a manifest of the masked alignments instead of the alignments "
+                             "(materialize them with mask_manifest.py)")
+    parser.add_argument("--member", help="tarball member to read (default: its only fasta file)")
+    parser.add_argument("-z", "--bgzf", action="store_true",
+                        help="write BGZF-compressed .fa.gz alignments with .fai/.gzi record indexes")
+    args = parser.parse_args()
+
+    matrix_in = path.abspath(args.matrix_in)
+    out_dir = path.abspath(args.out_dir)
+    name = base_name(matrix_in, args.member)
+    with stage("parse_alignment") as record:
+        _orig_matrix = AlignmentMatrix.from_fasta(matrix_in, args.member)
+        record["items"] = len(_orig_matrix)
+    seeds = get_seeds(args.n_seeds)
+    with stage("compute_coords"):
+        pol_start, pol_stop = get_HXB2_pol_coords(HXB2Index.from_matrix(_orig_matrix))
+        pol_cols = column_mask(_orig_matrix.shape[1], pol_start, pol_stop)
+
+    if args.manifest:
+        with stage("write_manifest", items=len(seeds) * len(args.masks)):
+            manifest = build_manifest(matrix_in, _orig_matrix, seeds, args.masks, pol_start, pol_stop, member=args.member)
+            write_manifest(manifest, path.join(out_dir, name + "_masks.json"))
+        return
+
+    if args.workers > 1:
+        ctx = multiprocessing.get_context("fork")
+        with ctx.Pool(args.workers) as pool:
+            jobs = [pool.apply_async(seed_write, (seed, out_dir, name, pol_cols, args.masks, args.bgzf)) for seed in seeds]
+            for job in jobs:
+                job.get()
+    else:
+        for seed in seeds:
+            seed_write(seed, out_dir, name, pol_cols, args.masks, args.bgzf)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import argparse
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+from alignment_matrix import AlignmentMatrix, column_mask
+from hxb2 import HXB2Index
+from mask_manifest import decode_rows, load_alignment, masked_rows, read_manifest, shuffled_rows
+from shuffle_and_mask import get_HXB2_pol_coords, get_seeds
+from tables import write_table
+
+# python site_stats.py ../results/alignments/HIV1_FLT_2018_genome_DNA_subtypeB.fa -o ../results/site_stats.csv --counts ../results/site_counts.npz --workers 8
+# python site_stats.py ../results/alignments/HIV1_FLT_2018_genome_DNA_subtypeB_masks.json -o ../results/site_stats.csv
+
+states = ["A", "C", "G", "T", "-", "other"]
+GAP_STATE = states.index("-")
+columns = ["seed", "mask", "n_masked", "gap_fraction", "entropy", "informative_sites", "variable_sites"]
+
+# set in the parent before the pool forks so workers share them copy-on-write
+_classes = None
+_masked_cols = None
+# state counts of the unmasked alignment, which level_counts copies for every seed
+_base_counts = None
+
+
+def state_classes(seqs):
+    """
+    The state index (see states) of every cell of a uint8 alignment matrix; ambiguity codes and N are "other".
+    """
+    lookup = np.full(256, states.index("other"), dtype=np.uint8)
+    for i, base in enumerate("ACGT"):
+        lookup[ord(base)] = lookup[ord(base.lower())] = i
+    lookup[ord("-")] = lookup[ord(".")] = GAP_STATE
+    return lookup[seqs]
+
+
+def count_states(classes):
+    """
+    (states x columns) counts of the rows of a state class matrix, in one bincount.
+    """
+    n_cols = classes.shape[1]
+    keys = classes.astype(np.int64) * n_cols + np.arange(n_cols)
+    return np.bincount(keys.ravel(), minlength=len(states) * n_cols).reshape(len(states), n_cols)
+
+
+def column_stats(counts):
+    """
+    Per-column gap fraction, Shannon entropy (bits) of the unambiguous bases, and whether a column is
+    variable and parsimony informative (at least two bases each in at least two sequences).
+    """
+    n_rows = counts.sum(axis=0)
+    bases = counts[:4]
+    n_bases = bases.sum(axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        freqs = bases / n_bases
+        entropy = -np.where(freqs > 0, freqs * np.log2(freqs), 0).sum(axis=0)
+    return {
+        "gap_fraction": counts[GAP_STATE] / n_rows,
+        "entropy": entropy,
+        "informative": (bases >= 2).sum(axis=0) >= 2,
+        "variable": (bases > 0).sum(axis=0) >= 2,
+    }
+
+
+def level_counts(base_counts, classes, masked_cols, levels):
+    """
+    Counts of every masked alignment of one seed. levels are (mask, masked row bitset) in increasing
+    mask order; masking a row replaces its masked_cols with gaps, so when the row sets are nested each
+    level is the previous one updated by only its newly masked rows.
+    """
+    counts = base_counts.copy()
+    masked = np.zeros(classes.shape[0], dtype=bool)
+    for mask, rows in levels:
+        if (masked & ~rows).any():
+            # not nested: start again from the unmasked alignment
+            counts = base_counts.copy()
+            masked = np.zeros_like(masked)
+        new_rows = np.flatnonzero(rows & ~masked)
+        if len(new_rows):
+            counts[:, masked_cols] -= count_states(classes[np.ix_(new_rows, masked_cols)])
+            counts[GAP_STATE, masked_cols] += len(new_rows)
+        masked = rows
+        yield mask, len(new_rows), counts
+
+
+def seed_stats(job):
+    """
+    Summary rows and per-column counts of every mask level of a seed.
+    """
+    seed, levels = job
+    rows = []
+    level_arrays = []
+    n_masked = 0
+    for mask, n_new, counts in level_counts(_base_counts, _classes, _masked_cols, levels):
+        n_masked += n_new
+        stats = column_stats(counts)
+        rows.append({
+            "seed": seed,
+            "mask": mask,
+            "n_masked": n_masked,
+            "gap_fraction": stats["gap_fraction"].mean(),
+            "entropy": stats["entropy"].mean(),
+            "informative_sites": int(stats["informative"].sum()),
+            "variable_sites": int(stats["variable"].sum()),
+        })
+        level_arrays.append(counts.astype(np.uint16 if _classes.shape[0] < 1 << 16 else np.uint32))
+    return rows, np.stack(level_arrays)
+
+
+def seed_levels(orig_matrix, seeds, pct_masks):
+    """
+    (seed, levels) jobs for the row sets shuffle_and_mask.py masks.
+    """
+    n_rows = len(orig_matrix)
+    jobs = []
+    for seed in seeds:
+        order = shuffled_rows(seed, n_rows)
+        jobs.append((seed, [(pct, masked_rows(order, pct)) for pct in sorted(pct_masks)]))
+    return jobs
+
+
+def manifest_levels(manifest):
+    """
+    (seed, levels) jobs for the row sets of a shuffle_and_mask.py manifest.
+    """
+    by_seed = {}
+    for entry in manifest["entries"]:
+        by_seed.setdefault(entry["seed"], []).append((entry["mask"], decode_rows(entry["rows"], manifest["n_rows"])))
+    return [(seed, sorted(levels, key=lambda level: level[0])) for seed, levels in by_seed.items()]
+
+
+def main():
+    global _classes, _masked_cols, _base_counts
+    parser = argparse.ArgumentParser(
+        description="Per-site statistics (gap fraction, base counts, entropy, informative sites) of every "
+                    "masked alignment of shuffle_and_mask.py, without writing or reading the alignments"
+    )
+    parser.add_argument("source", help="alignment given to shuffle_and_mask.py, or a manifest it wrote (.json)")
+    parser.add_argument("-o", "--output", default="site_stats.csv",
+                        help="one summary row per seed and mask, .csv or .parquet (default: site_stats.csv)")
+    parser.add_argument("--counts",
+                        help="also save per-column state counts as .npz (seeds x masks x states x columns)")
+    parser.add_argument("-n", "--n-seeds", type=int, default=100,
+                        help="number of shuffling seeds, for an alignment (default: 100)")
+    parser.add_argument("-m", "--masks", type=int, nargs="+", default=list(range(10, 101, 10)),
+                        metavar="PCT", help="percentages of rows masked, for an alignment (default: 10 20 ... 100)")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="number of worker processes (default: 1)")
+    args = parser.parse_args()
+
+    if args.source.endswith(".json"):
+        manifest = read_manifest(args.source)
+        orig_matrix = load_alignment(manifest)
+        keep_start, keep_stop = manifest["keep"]
+        jobs = manifest_levels(manifest)
+    else:
+        orig_matrix = AlignmentMatrix.from_fasta(args.source)
+        keep_start, keep_stop = get_HXB2_pol_coords(HXB2Index.from_matrix(orig_matrix))
+        jobs = seed_levels(orig_matrix, get_seeds(args.n_seeds), args.masks)
+    _classes = state_classes(orig_matrix.seqs)
+    _base_counts = count_states(_classes)
+    _masked_cols = np.flatnonzero(~column_mask(orig_matrix.shape[1], keep_start, keep_stop))
+    print("Computing site statistics of {} seeds x {} masks...".format(len(jobs), len(jobs[0][1]) if jobs else 0))
+
+    if args.workers > 1:
+        ctx = multiprocessing.get_context("fork")
+        with ctx.Pool(args.workers) as pool:
+            results = pool.map(seed_stats, jobs)
+    else:
+        results = [seed_stats(job) for job in jobs]
+
+    df = pd.DataFrame([row for rows, _ in results for row in rows], columns=columns)
+    write_table(df, args.output)
+    if args.counts:
+        np.savez(args.counts,
+                 counts=np.stack([counts for _, counts in results]),
+                 seeds=np.array([seed for seed, _ in jobs]),
+                 masks=np.array([mask for mask, _ in jobs[0][1]]),
+                 states=np.array(states))
+    print("Done.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+def taxon_order(leaf_names):
+    """
+    Bit position for every leaf name; trees compared together must share one order.
+    """
+    return {name: i for i, name in enumerate(sorted(leaf_names))}
+
+
+class SplitIndex:
+    """
+    Every clade of a rooted tree keyed by the bitset of its leaves, built in one postorder pass.
+    Leaves and the root are not clades. Clade lookups are hash lookups, so comparing two
+    indexes is linear in the number of edges instead of a tree walk per edge.
+    """
+
+    def __init__(self, taxa, leaves, clades):
+        self.taxa = taxa
+        self.leaves = leaves
+        self.clades = clades
+
+    @classmethod
+    def from_tree(cls, tree, taxa):
+        clades = {}
+        bits = {}
+        for node in tree.traverse("postorder"):
+            if node.is_leaf():
+                node_bits = 1 << taxa[node.name] if node.name in taxa else 0
+            else:
+                node_bits = 0
+                for child in node.children:
+                    node_bits |= bits.pop(child)
+                # with unary nodes the lowest node of a clade is kept, as get_common_ancestor would return
+                clades.setdefault(node_bits, node)
+            bits[node] = node_bits
+        leaves = bits.pop(tree)
+        return cls(taxa, leaves, cls._valid(clades, leaves))
+
+    @classmethod
+    def from_flat(cls, tree, taxa, outgroup=None):
+        """
+        Index of a treecache.FlatTree; clades map to node indexes. With an outgroup the clades are
+        those of the tree rooted on the outgroup's edge, so supports stay on the edges IQ-TREE put them on.
+        """
+        parent = tree.parent.tolist()
+        tip = tree.tip.tolist()
+        tip_bits = [1 << taxa[name] if name in taxa else 0 for name in tree.tip_names]
+        bits = [0] * len(parent)
+        clades = {}
+        # nodes are in preorder, so walking indexes backwards visits children before parents
+        for i in range(len(parent) - 1, -1, -1):
+            if tip[i] >= 0:
+                bits[i] = tip_bits[tip[i]]
+            else:
+                clades.setdefault(bits[i], i)
+            if parent[i] >= 0:
+                bits[parent[i]] |= bits[i]
+        leaves = bits[0]
+        if outgroup is not None and outgroup in taxa:
+            outgroup_bit = 1 << taxa[outgroup]
+            rooted = {}
+            for b, node in clades.items():
+                rooted.setdefault(leaves ^ b if b & outgroup_bit else b, node)
+            # everything but the outgroup is the clade on the other side of the outgroup's edge
+            rooted.setdefault(leaves ^ outgroup_bit, tip.index(list(tree.tip_names).index(outgroup)))
+            clades = rooted
+        return cls(taxa, leaves, cls._valid(clades, leaves))
+
+    @staticmethod
+    def _valid(clades, leaves):
+        return {b: node for b, node in clades.items() if b != leaves and b.bit_count() > 1}
+
+    def restricted(self, leaves):
+        """
+        The index restricted to a subset of its leaves, for comparing trees with different taxa.
+        """
+        clades = {}
+        for b, node in self.clades.items():
+            clades.setdefault(b & leaves, node)
+        return SplitIndex(self.taxa, leaves, self._valid(clades, leaves))
+
+    def __len__(self):
+        return len(self.clades)
+
+    def __contains__(self, clade):
+        return clade in self.clades
+
+    def __getitem__(self, clade):
+        return self.clades[clade]
+
+
+def compare_splits(ref, comp):
+    """
+    Robinson-Foulds comparison of two SplitIndexes over their common leaves.
+    Returns the (ref node, comp node) pair of every shared clade and the nodes unique to each tree.
+    """
+    if ref.leaves != comp.leaves:
+        common_leaves = ref.leaves & comp.leaves
+        ref = ref.restricted(common_leaves)
+        comp = comp.restricted(common_leaves)
+    common = ref.clades.keys() & comp.clades.keys()
+    ref_only = ref.clades.keys() - common
+    comp_only = comp.clades.keys() - common
+    rf = len(ref_only) + len(comp_only)
+    max_rf = len(ref) + len(comp)
+    return {
+        "common": [(ref[b], comp[b]) for b in common],
+        "ref_only": [ref[b] for b in ref_only],
+        "comp_only": [comp[b] for b in comp_only],
+        "ref_edges": len(ref),
+        "comp_edges": len(comp),
+        "rf": rf,
+        "max_rf": max_rf,
+        "norm_rf": rf / max_rf if max_rf else 0.0,
+    }
@@ -0,0 +1,22 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import pandas as pd
+
+
+def write_table(df, out_file):
+    """
+    Writes a result table as Parquet when out_file ends in .parquet, as CSV otherwise.
+    """
+    if out_file.endswith(".parquet"):
+        df.to_parquet(out_file, index=False)
+    else:
+        df.to_csv(out_file, index=False)
+
+
+def read_table(in_file, **kwargs):
+    """
+    Reads a table written by write_table.
+    """
+    if in_file.endswith(".parquet"):
+        return pd.read_parquet(in_file, **kwargs)
+    return pd.read_csv(in_file, **kwargs)
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from tables import write_table
+from treecache import load_tree
+from ufboot_splits import read_newicks, split_token_re
+
+# python tbe.py ../results/trees/HIV1_FLT_2018_genome_DNA_subtypeB.fa.treefile -o ../results/tbe.csv
+
+
+def newick_ranges(newick):
+    """
+    Tip names of a newick tree in depth-first order, and the [lo, hi) range of tips below
+    every internal node except the root, which a depth-first order makes contiguous.
+    """
+    names = []
+    starts = []
+    lo = []
+    hi = []
+    after_close = False
+    for token in split_token_re.findall(newick):
+        if token == "(":
+            starts.append(len(names))
+            after_close = False
+        elif token == ")":
+            lo.append(starts.pop())
+            hi.append(len(names))
+            after_close = True
+        elif token == ",":
+            after_close = False
+        elif token == ";":
+            break
+        elif token[0] != ":" and not after_close:
+            names.append(token.strip())
+    # the root closes last
+    return names, np.array(lo[:-1], dtype=np.int32), np.array(hi[:-1], dtype=np.int32)
+
+
+def tree_ranges(tree):
+    """
+    newick_ranges for a treecache.FlatTree, whose tips are already in depth-first (preorder) order.
+    Returns the internal nodes with their ranges.
+    """
+    n_nodes = len(tree)
+    is_leaf = tree.is_leaf
+    parent = tree.parent
+    # nodes in preorder, so a node's subtree is the nodes up to its last descendant
+    subtree = np.ones(n_nodes, dtype=np.int64)
+    for i in range(n_nodes - 1, 0, -1):
+        subtree[parent[i]] += subtree[i]
+    tips_before = np.concatenate([[0], np.cumsum(is_leaf)])
+    nodes = np.flatnonzero(~is_leaf & (parent >= 0))
+    return nodes, tips_before[nodes], tips_before[nodes + subtree[nodes]]
+
+
+class TransferIndex:
+    """
+    Transfer distances (Lemoine et al. 2018) from the branches of a reference tree to replicate trees.
+
+    The transfer index of a reference branch with light side A (p tips) in a replicate is the
+    fewest tips to move to make A a split of the replicate, at most p - 1. With the replicate's
+    tips in depth-first order every replicate clade is a range of tips, so |A & clade| for all
+    clades is a difference of prefix sums of A's tip indicator. Each replicate costs one pass of
+    vectorized row operations over a tips x branches table, instead of a bitset comparison of
+    every reference branch against every replicate branch.
+    """
+
+    def __init__(self, ref_tree, block_cells=1 << 24):
+        self.nodes, self.lo, self.hi = tree_ranges(ref_tree)
+        self.tip_index = {name: i for i, name in enumerate(ref_tree.tip_names)}
+        self.n_tips = len(self.tip_index)
+        self.size = self.hi - self.lo
+        self.light = np.minimum(self.size, self.n_tips - self.size)
+        # counts and differences stay within +-2n
+        self.dtype = np.int16 if 2 * self.n_tips < np.iinfo(np.int16).max else np.int32
+        # reference branches per block, bounding a block's prefix sums to block_cells entries
+        self.block_cols = max(1, block_cells // (self.n_tips + 1))
+        # which branches' clades hold each reference tip, one row per tip
+        tips = np.arange(self.n_tips)[:, None]
+        self.membership = ((tips >= self.lo) & (tips < self.hi)).astype(self.dtype)
+
+    def transfer(self, newick):
+        """
+        Transfer index of every reference branch (ordered as self.nodes) in one replicate.
+        """
+        names, rep_lo, rep_hi = newick_ranges(newick)
+        if len(names) != self.n_tips:
+            raise ValueError("replicate has {} tips, the reference {}".format(len(names), self.n_tips))
+        n = self.n_tips
+        ref_position = np.array([self.tip_index[name] for name in names], dtype=np.int64)
+        rep_size = (rep_hi - rep_lo).astype(self.dtype)[:, None]
+        result = np.empty(len(self.nodes), dtype=np.int32)
+        for start in range(0, len(self.nodes), self.block_cols):
+            block = slice(start, start + self.block_cols)
+            rows = self.membership[ref_position, block]
+            # prefix[j] counts each reference clade's tips among the replicate's first j tips
+            prefix = np.empty((n + 1, rows.shape[1]), dtype=self.dtype)
+            prefix[0] = 0
+            for j in range(n):
+                np.add(prefix[j], rows[j], out=prefix[j + 1])
+            common = prefix[rep_hi]
+            common -= prefix[rep_lo]
+            # symmetric difference between each reference clade and each replicate clade
+            diff = rep_size - 2 * common
+            diff += self.size[block].astype(self.dtype)
+            np.minimum(diff, n - diff, out=diff)
+            result[block] = np.minimum(diff.min(axis=0), self.light[block] - 1)
+        return result
+
+    def tbe(self, newicks):
+        """
+        Transfer bootstrap expectation of every reference branch over replicate newicks, in [0, 1].
+        NaN for branches whose light side is a single tip (trivial splits, e.g. above a unary node),
+        where the transfer index is always 0 and has no p - 1 to normalize by.
+        """
+        total = np.zeros(len(self.nodes), dtype=np.int64)
+        n_replicates = 0
+        for newick in newicks:
+            total += self.transfer(newick)
+            n_replicates += 1
+        if n_replicates == 0:
+            return np.full(len(self.nodes), np.nan)
+        tbe = np.full(len(self.nodes), np.nan)
+        defined = self.light > 1
+        tbe[defined] = 1 - total[defined] / n_replicates / (self.light[defined] - 1)
+        return tbe
+
+
+def ufboot_file(tree_file):
+    """
+    The bootstrap trees IQ-TREE writes next to <prefix>.treefile with -wbt.
+    """
+    return tree_file[:-len(".treefile")] + ".ufboot" if tree_file.endswith(".treefile") else tree_file + ".ufboot"
+
+
+def node_tbe(ref_tree, replicate_file):
+    """
+    TBE of every node of a treecache.FlatTree from a .ufboot file, NaN for tips and the root.
+    """
+    index = TransferIndex(ref_tree)
+    values = np.full(len(ref_tree), np.nan)
+    values[index.nodes] = index.tbe(read_newicks(replicate_file))
+    return values
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Transfer bootstrap expectation (TBE) of every branch of a treefile from its bootstrap trees"
+    )
+    parser.add_argument("tree_file", help="treefile whose branches are supported")
+    parser.add_argument("-u", "--ufboot", help="bootstrap trees (default: <prefix>.ufboot next to the treefile)")
+    parser.add_argument("-o", "--output", default="tbe.csv",
+                        help="per-branch table, .csv or .parquet (default: tbe.csv)")
+    args = parser.parse_args()
+
+    tree = load_tree(args.tree_file)
+    values = node_tbe(tree, args.ufboot or ufboot_file(args.tree_file))
+    internal = np.flatnonzero(~np.isnan(values))
+    df = pd.DataFrame({
+        "node": internal,
+        "SHaLRT": tree.shalrt[internal],
+        "bootstrap": tree.ufboot[internal],
+        "TBE": values[internal],
+    })
+    write_table(df, args.output)
+    print("Done.")
+
+
+if __name__ == "__main__":
+    main()
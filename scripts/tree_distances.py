@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import argparse
+import multiprocessing
+import os
+import re
+from glob import glob
+
+import numpy as np
+import pandas as pd
+
+from instrument import stage
+from splits import taxon_order
+from tables import write_table
+from treecache import load_tree
+from ufboot_splits import split_key
+
+# python tree_distances.py ../results/trees -o ../results/tree_distances.npz --summary ../results/tree_distances_summary.csv --workers 8
+
+tree_regex = re.compile(r"(?:_(\d+))?_mask(\d+)\.fa\.treefile$")
+summary_columns = ["comparison", "mask", "trees", "pairs", "mean_rf", "mean_norm_rf", "median_norm_rf",
+                   "max_norm_rf", "mean_branch_score"]
+# bytes of one (splits x trees) float64 block of the incidence matrix, which bounds memory per worker
+block_bytes = 1 << 26
+# splits in at least this many trees go through incidence matrix products, rarer ones pair by pair
+dense_min_trees = 64
+
+# set in the parent before the pool forks so workers share them copy-on-write
+_taxa = None
+_n_trees = None
+_dense_rows = None
+_dense_trees = None
+_dense_lengths = None
+_n_dense = None
+_sparse_splits = None
+_sparse_trees = None
+_sparse_lengths = None
+
+
+def find_treefiles(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob(os.path.join(path, "**", "*.treefile"), recursive=True)))
+        else:
+            files.append(path)
+    return files
+
+
+def tree_info(tree_file):
+    """
+    Parameter set, seed and mask of a treefile written by 02_iqtree.sh or 03_iqtree_fixedparams.sh
+    (under fixedparams/); seed and mask are -1 where the name has none.
+    """
+    match = tree_regex.search(tree_file)
+    seed, mask = match.groups() if match else (None, None)
+    return {
+        "tree_file": tree_file,
+        "param_set": "fixed" if "fixedparams" in tree_file.split(os.sep) else "free",
+        "seed": int(seed) if seed is not None else -1,
+        "mask": int(mask) if mask is not None else -1,
+    }
+
+
+def tree_splits(tree, taxa):
+    """
+    {split bitset: branch length} of the nontrivial splits of a treecache.FlatTree, each taken on the
+    side without the bit 0 taxon so every rooting gives the same bitsets. The two edges below a
+    bifurcating root are one split, with their lengths summed.
+    """
+    parent = tree.parent.tolist()
+    tip = tree.tip.tolist()
+    length = np.nan_to_num(tree.length).tolist()
+    tip_bits = [1 << taxa[name] for name in tree.tip_names]
+    leaves = (1 << len(taxa)) - 1
+    bits = [0] * len(parent)
+    splits = {}
+    # nodes are in preorder, so walking indexes backwards completes a node before its parent
+    for i in range(len(parent) - 1, 0, -1):
+        if tip[i] >= 0:
+            bits[i] = tip_bits[tip[i]]
+        bits[parent[i]] |= bits[i]
+        split = leaves ^ bits[i] if bits[i] & 1 else bits[i]
+        if 1 < split.bit_count() < len(taxa) - 1:
+            splits[split] = splits.get(split, 0.0) + length[i]
+    return splits
+
+
+def split_job(tree_file):
+    tree = load_tree(tree_file)
+    if len(tree.tip_names) != len(_taxa) or not all(name in _taxa for name in tree.tip_names):
+        raise ValueError("{} does not have the taxa of the first tree".format(tree_file))
+    splits = tree_splits(tree, _taxa)
+    keys = np.frombuffer(b"".join(split_key(bits) for bits in splits), dtype=np.uint64)
+    return keys, np.array(list(splits.values()), dtype=np.float64)
+
+
+def split_table(tree_files, taxa, workers=1):
+    """
+    Every split of every tree hashed once into one table: (split, tree, branch length) entries sorted
+    by split, where splits are numbered by their 64-bit digest, and the number of distinct splits.
+    """
+    global _taxa
+    _taxa = taxa
+    if workers > 1 and len(tree_files) > 1:
+        ctx = multiprocessing.get_context("fork")
+        with ctx.Pool(workers) as pool:
+            results = pool.map(split_job, tree_files, chunksize=max(1, len(tree_files) // (workers * 4)))
+    else:
+        results = [split_job(tree_file) for tree_file in tree_files]
+    keys = np.concatenate([keys for keys, _ in results])
+    lengths = np.concatenate([lengths for _, lengths in results])
+    trees = np.repeat(np.arange(len(results)), [len(keys) for keys, _ in results])
+    distinct, splits = np.unique(keys, return_inverse=True)
+    order = np.argsort(splits, kind="stable")
+    return splits[order], trees[order], lengths[order], len(distinct)
+
+
+def dense_job(slab):
+    """
+    Rows [start, stop) of the shared split counts and branch length dot products of every pair of
+    trees over the common splits, one block of the incidence matrix at a time.
+    """
+    start, stop = slab
+    shared = np.zeros((stop - start, _n_trees))
+    dots = np.zeros((stop - start, _n_trees))
+    block = max(1, block_bytes // (8 * _n_trees))
+    bounds = np.searchsorted(_dense_rows, np.arange(0, _n_dense + block, block))
+    for first, lo, hi in zip(range(0, _n_dense, block), bounds[:-1], bounds[1:]):
+        rows, trees = _dense_rows[lo:hi] - first, _dense_trees[lo:hi]
+        incidence = np.zeros((block, _n_trees))
+        incidence[rows, trees] = 1
+        shared += incidence[:, start:stop].T @ incidence
+        weights = np.zeros((block, _n_trees))
+        weights[rows, trees] = _dense_lengths[lo:hi]
+        dots += weights[:, start:stop].T @ weights
+    return start, shared, dots
+
+
+def sparse_job(chunk):
+    """
+    Shared split counts and branch length dot products over the rare splits in entries [lo, hi) of
+    their table, for the pairs (earlier tree, later tree) only.
+    """
+    lo, hi = chunk
+    splits, trees, lengths = _sparse_splits[lo:hi], _sparse_trees[lo:hi], _sparse_lengths[lo:hi]
+    shared = np.zeros(_n_trees * _n_trees)
+    dots = np.zeros(_n_trees * _n_trees)
+    # the entries of a split are consecutive and in tree order, so each pair of trees sharing it is an
+    # entry and one of the next dense_min_trees - 1 entries with the same split
+    for offset in range(1, dense_min_trees):
+        same = splits[:-offset] == splits[offset:]
+        if not same.any():
+            break
+        pairs = trees[:-offset][same] * _n_trees + trees[offset:][same]
+        shared += np.bincount(pairs, minlength=len(shared))
+        dots += np.bincount(pairs, weights=lengths[:-offset][same] * lengths[offset:][same], minlength=len(dots))
+    return None, shared.reshape(_n_trees, _n_trees), dots.reshape(_n_trees, _n_trees)
+
+
+def product_job(job):
+    kind, bounds = job
+    return dense_job(bounds) if kind == "dense" else sparse_job(bounds)
+
+
+def add_products(shared, dots, start, job_shared, job_dots):
+    if start is None:
+        shared += job_shared + job_shared.T
+        dots += job_dots + job_dots.T
+    else:
+        shared[start:start + len(job_shared)] += job_shared
+        dots[start:start + len(job_dots)] += job_dots
+
+
+def pair_products(splits, trees, lengths, n_trees, workers=1):
+    """
+    Shared split counts and branch length dot products of every pair of trees, from a split table
+    (see split_table). As in HashRF, a split adds to the pairs of trees that have it: splits in at
+    least dense_min_trees trees through products of their incidence matrix, rarer ones pair by pair,
+    so the cost follows the number of pairs sharing a split rather than splits x trees^2.
+    """
+    global _dense_rows, _dense_trees, _dense_lengths, _n_dense, _sparse_splits, _sparse_trees, _sparse_lengths
+    global _n_trees
+    _n_trees = n_trees
+    dense = np.bincount(splits)[splits] >= dense_min_trees
+    _dense_rows = np.unique(splits[dense], return_inverse=True)[1]
+    _dense_trees, _dense_lengths, _n_dense = trees[dense], lengths[dense], _dense_rows.max(initial=-1) + 1
+    _sparse_splits, _sparse_trees, _sparse_lengths = splits[~dense], trees[~dense], lengths[~dense]
+
+    workers = max(1, workers)
+    jobs = []
+    if _n_dense:
+        step = -(-n_trees // workers)
+        jobs.extend(("dense", (start, min(start + step, n_trees))) for start in range(0, n_trees, step))
+    if len(_sparse_splits):
+        # chunks end on split boundaries, so every pair of a split is in one chunk
+        targets = _sparse_splits[np.linspace(0, len(_sparse_splits) - 1, workers + 1).astype(int)[1:-1]]
+        bounds = np.unique(np.concatenate([[0], np.searchsorted(_sparse_splits, targets), [len(_sparse_splits)]]))
+        jobs.extend(("sparse", (lo, hi)) for lo, hi in zip(bounds[:-1], bounds[1:]) if lo < hi)
+
+    shared = np.zeros((n_trees, n_trees))
+    dots = np.zeros((n_trees, n_trees))
+    if workers > 1 and len(jobs) > 1:
+        ctx = multiprocessing.get_context("fork")
+        with ctx.Pool(workers) as pool:
+            for result in pool.imap_unordered(product_job, jobs):
+                add_products(shared, dots, *result)
+    else:
+        for job in jobs:
+            add_products(shared, dots, *product_job(job))
+    # each tree against itself: its split count and its squared branch lengths
+    np.fill_diagonal(shared, np.bincount(trees, minlength=n_trees))
+    np.fill_diagonal(dots, np.bincount(trees, weights=lengths * lengths, minlength=n_trees))
+    return shared, dots
+
+
+def tree_distances(tree_files, workers=1):
+    """
+    HashRF-style distances among all trees: Robinson-Foulds, RF normalized by the trees' split
+    counts, and Kuhner-Felsenstein branch score (the branch length weighted RF). The trees'
+    splits are hashed once into one table, from which every pair's shared splits and branch
+    length products come in one pass.
+    """
+    taxa = taxon_order(load_tree(tree_files[0]).leaf_names())
+    with stage("split_table", items=len(tree_files)) as record:
+        splits, trees, lengths, n_splits = split_table(tree_files, taxa, workers)
+        record["splits"] = n_splits
+    with stage("pair_products", items=len(tree_files) ** 2):
+        shared, dots = pair_products(splits, trees, lengths, len(tree_files), workers)
+
+    n_splits = np.diag(shared).copy()
+    squares = np.diag(dots).copy()
+    total = n_splits[:, None] + n_splits[None]
+    rf = np.rint(total - 2 * shared).astype(np.int32)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        norm_rf = np.where(total > 0, rf / total, 0.0)
+    branch_score = np.sqrt(np.maximum(squares[:, None] + squares[None] - 2 * dots, 0))
+    np.fill_diagonal(branch_score, 0)
+    return {"n_splits": n_splits.astype(np.int32), "rf": rf, "norm_rf": norm_rf, "branch_score": branch_score}
+
+
+def summarize(info, matrices):
+    """
+    Distances between the trees of different seeds at each mask level per parameter set, and between
+    the free and fixed parameter trees of the same seed and mask.
+    """
+    param_set, seed, mask = (info[column].to_numpy() for column in ("param_set", "seed", "mask"))
+    i, j = np.triu_indices(len(info), 1)
+    same_mask = mask[i] == mask[j]
+    between_seeds = same_mask & (param_set[i] == param_set[j]) & (seed[i] != seed[j])
+    free_vs_fixed = same_mask & (param_set[i] != param_set[j]) & (seed[i] == seed[j])
+    i, j = i[between_seeds | free_vs_fixed], j[between_seeds | free_vs_fixed]
+    if len(i) == 0:
+        return pd.DataFrame(columns=summary_columns)
+    pairs = pd.DataFrame({
+        "comparison": np.where(param_set[i] == param_set[j], param_set[i], "free_vs_fixed"),
+        "mask": mask[i],
+        "rf": matrices["rf"][i, j],
+        "norm_rf": matrices["norm_rf"][i, j],
+        "branch_score": matrices["branch_score"][i, j],
+    })
+    members = pd.concat([pairs[["comparison", "mask"]].assign(tree=i), pairs[["comparison", "mask"]].assign(tree=j)])
+    trees = members.drop_duplicates().groupby(["comparison", "mask"]).size().rename("trees")
+    summary = pairs.groupby(["comparison", "mask"]).agg(
+        pairs=("rf", "size"),
+        mean_rf=("rf", "mean"),
+        mean_norm_rf=("norm_rf", "mean"),
+        median_norm_rf=("norm_rf", "median"),
+        max_norm_rf=("norm_rf", "max"),
+        mean_branch_score=("branch_score", "mean"),
+    ).join(trees).reset_index()
+    return summary.sort_values(["comparison", "mask"], ignore_index=True)[summary_columns]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="All-pairs Robinson-Foulds, normalized RF and branch score distances among IQ-TREE trees"
+    )
+    parser.add_argument("paths", nargs="+", help="treefiles or directories to search for them")
+    parser.add_argument("-o", "--output", default="tree_distances.npz",
+                        help="output .npz with the trees (tree_file, param_set, seed, mask) and their distance "
+                             "matrices (default: tree_distances.npz)")
+    parser.add_argument("--summary", help="per mask level summary table, .csv or .parquet (default: print it)")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="number of worker processes (default: 1)")
+    args = parser.parse_args()
+
+    tree_files = find_treefiles(args.paths)
+    if not tree_files:
+        parser.error("no treefiles in {}".format(" ".join(args.paths)))
+    print("Comparing all pairs of {} trees...".format(len(tree_files)))
+    info = pd.DataFrame([tree_info(tree_file) for tree_file in tree_files])
+    matrices = tree_distances(tree_files, args.workers)
+    np.savez(args.output, **{column: np.array(info[column].tolist()) for column in info}, **matrices)
+
+    summary = summarize(info, matrices)
+    if args.summary:
+        write_table(summary, args.summary)
+    else:
+        print(summary.to_string(index=False))
+    print("Done.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import argparse
+import hashlib
+import mmap
+import os
+import re
+import struct
+import zipfile
+
+import numpy as np
+
+# python treecache.py ../results/trees/*/*.treefile
+
+token_re = re.compile(r"\s*(?:([(),;])|:([^(),:;\s]*)|([^(),:;\s][^(),:;]*))")
+
+
+class FlatTree:
+    """
+    A parsed IQ-TREE treefile as flat arrays, one entry per node in preorder (so every parent
+    comes before its children and reversed index order is a postorder).
+    Internal "SH-aLRT/UFBoot" labels are split into shalrt and ufboot (nan where absent).
+    """
+
+    node_fields = ("parent", "length", "shalrt", "ufboot", "tip")
+
+    def __init__(self, parent, length, shalrt, ufboot, tip, tip_names, subtype, subtypes):
+        self.parent = parent
+        self.length = length
+        self.shalrt = shalrt
+        self.ufboot = ufboot
+        # index into tip_names, -1 for internal nodes
+        self.tip = tip
+        self.tip_names = tip_names
+        # per tip, index into subtypes
+        self.subtype = subtype
+        self.subtypes = subtypes
+
+    @classmethod
+    def from_newick(cls, newick):
+        parent = []
+        length = []
+        labels = []
+        stack = []
+        node = -1
+        after_close = False
+        for match in token_re.finditer(newick):
+            punct, dist, label = match.groups()
+            if punct == "(":
+                parent.append(stack[-1] if stack else -1)
+                length.append(np.nan)
+                labels.append(None)
+                stack.append(len(parent) - 1)
+                after_close = False
+            elif punct == ")":
+                node = stack.pop()
+                after_close = True
+            elif punct == ",":
+                after_close = False
+            elif punct == ";":
+                break
+            elif dist is not None:
+                length[node] = float(dist)
+            elif after_close:
+                labels[node] = label.strip()
+            else:
+                parent.append(stack[-1] if stack else -1)
+                length.append(np.nan)
+                labels.append(label.strip())
+                node = len(parent) - 1
+        parent = np.array(parent, dtype=np.int32)
+        is_leaf = np.ones(len(parent), dtype=bool)
+        is_leaf[parent[parent >= 0]] = False
+
+        shalrt = np.full(len(parent), np.nan, dtype=np.float32)
+        ufboot = np.full(len(parent), np.nan, dtype=np.float32)
+        tip = np.full(len(parent), -1, dtype=np.int32)
+        tip_names = []
+        for i, label in enumerate(labels):
+            if is_leaf[i]:
+                tip[i] = len(tip_names)
+                tip_names.append(label)
+            elif label is not None and "/" in label:
+                shalrt[i], ufboot[i] = [float(x) for x in label.split("/")]
+        subtypes, subtype = np.unique([name.split(".", 1)[0] for name in tip_names], return_inverse=True)
+        return cls(parent, np.array(length), shalrt, ufboot, tip, np.array(tip_names),
+                   subtype.astype(np.int16), subtypes)
+
+    def __len__(self):
+        return len(self.parent)
+
+    @property
+    def is_leaf(self):
+        return self.tip >= 0
+
+    def leaf_names(self):
+        return list(self.tip_names)
+
+    def node_subtypes(self):
+        return self.subtypes[self.subtype]
+
+
+def cache_file(tree_file):
+    return tree_file + ".npz"
+
+
+def file_sha256(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def write_cache(tree_file, tree, sha256=None):
+    """
+    Packs per-node and per-tip arrays into one structured array each, so a load parses few headers.
+    sha256 is the treefile's digest when the caller has already computed it.
+    """
+    stat = os.stat(tree_file)
+    nodes = np.empty(len(tree), dtype=[(field, getattr(tree, field).dtype) for field in FlatTree.node_fields])
+    for field in FlatTree.node_fields:
+        nodes[field] = getattr(tree, field)
+    tips = np.empty(len(tree.tip_names), dtype=[("name", tree.tip_names.dtype), ("subtype", tree.subtype.dtype)])
+    tips["name"] = tree.tip_names
+    tips["subtype"] = tree.subtype
+    # uncompressed, so read_cache can memory-map the arrays
+    tmp = "{}.{}.tmp.npz".format(cache_file(tree_file), os.getpid())
+    try:
+        np.savez(
+            tmp,
+            source=np.array([stat.st_mtime_ns, stat.st_size], dtype=np.int64),
+            source_sha256=np.array(sha256 or file_sha256(tree_file)),
+            nodes=nodes,
+            tips=tips,
+            subtypes=tree.subtypes,
+        )
+        os.replace(tmp, cache_file(tree_file))
+    except OSError:
+        # e.g. a read-only tree directory: the tree is parsed again on every load instead
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def mmap_npz(npz_file):
+    """
+    Memory-maps every member of an uncompressed .npz (as written by np.savez) without copying.
+    """
+    with zipfile.ZipFile(npz_file) as zf:
+        members = zf.infolist()
+    with open(npz_file, "rb") as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        arrays = {}
+        for member in members:
+            if member.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f"{npz_file} is compressed and cannot be memory-mapped")
+            # the local file header is 30 bytes followed by the member name and an extra field
+            name_len, extra_len = struct.unpack("<HH", buf[member.header_offset + 26:member.header_offset + 30])
+            f.seek(member.header_offset + 30 + name_len + extra_len)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            arrays[member.filename[:-len(".npy")]] = np.ndarray(
+                shape, dtype, buffer=buf, offset=f.tell(), order="F" if fortran_order else "C"
+            )
+    return arrays
+
+
+def read_cache(tree_file):
+    """
+    Returns the cached tree, or None when there is no cache or the treefile has changed since.
+    A treefile with a new mtime but the same contents (e.g. copied) still uses its cache, which is
+    rewritten with the new mtime so later loads skip the hash.
+    Arrays are read-only views of the memory-mapped cache.
+    """
+    try:
+        cache = mmap_npz(cache_file(tree_file))
+    except (FileNotFoundError, ValueError, OSError, zipfile.BadZipFile):
+        return None
+    stat = os.stat(tree_file)
+    sha256 = None
+    if cache["source"].tolist() != [stat.st_mtime_ns, stat.st_size]:
+        sha256 = file_sha256(tree_file)
+        if str(cache["source_sha256"]) != sha256:
+            return None
+    nodes = cache["nodes"]
+    tips = cache["tips"]
+    tree = FlatTree(*(nodes[field] for field in FlatTree.node_fields),
+                    tips["name"], tips["subtype"], cache["subtypes"])
+    if sha256 is not None:
+        write_cache(tree_file, tree, sha256)
+    return tree
+
+
+def load_tree(tree_file, use_cache=True):
+    tree = read_cache(tree_file) if use_cache else None
+    if tree is None:
+        with open(tree_file) as f:
+            tree = FlatTree.from_newick(f.read())
+        if use_cache:
+            write_cache(tree_file, tree)
+    return tree
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Converts IQ-TREE treefiles to cached flat arrays (<treefile>.npz)")
+    parser.add_argument("tree_files", nargs="+")
+    args = parser.parse_args()
+    for tree_file in args.tree_files:
+        if read_cache(tree_file) is None:
+            load_tree(tree_file)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import argparse
+import gzip
+import hashlib
+import multiprocessing
+import os
+import re
+from glob import glob
+
+import numpy as np
+import pandas as pd
+
+from splits import SplitIndex, taxon_order
+from tables import write_table
+from treecache import load_tree
+
+# python ufboot_splits.py ../results/trees/HIV1_FLT_2018_genome_DNA_subtypeB.fa.treefile ../results/trees -o ../results/replicate_support.parquet --workers 8
+
+ufboot_regex = re.compile(r"(?:_(\d+))?_mask(\d+)\.fa\.ufboot$")
+# punctuation, a branch length, or a name/support label
+split_token_re = re.compile(r"[(),;]|:[^(),;]*|[^(),:;]+")
+columns = ["file", "param_set", "seed", "mask", "split", "ref_bootstrap", "n_replicates", "replicate_support"]
+
+# set in the parent before the pool forks so workers share them copy-on-write
+_taxa = None
+_ref_tree = None
+_ref_splits = None
+
+
+def read_newicks(ufboot_file):
+    """
+    Yields the trees of a .ufboot file (optionally gzipped) one newick string at a time.
+    """
+    opener = gzip.open if ufboot_file.endswith(".gz") else open
+    with opener(ufboot_file, "rt") as f:
+        pending = []
+        for line in f:
+            pending.append(line.strip())
+            if line.rstrip().endswith(";"):
+                yield "".join(pending)
+                pending = []
+
+
+def newick_splits(newick, tip_bits, anchor_bit):
+    """
+    The nontrivial splits of an unrooted newick tree as taxon bitsets, each taken on the side
+    without the anchor taxon so that every rooting of a tree gives the same bitsets.
+    """
+    splits = set()
+    stack = [0]
+    after_close = False
+    for token in split_token_re.findall(newick):
+        if token == "(":
+            stack.append(0)
+            after_close = False
+        elif token == ")":
+            bits = stack.pop()
+            stack[-1] |= bits
+            splits.add(bits)
+            after_close = True
+        elif token == ",":
+            after_close = False
+        elif token == ";":
+            break
+        elif token[0] != ":" and not after_close:
+            stack[-1] |= tip_bits.get(token.strip(), 0)
+    leaves = stack[0]
+    normalized = set()
+    for bits in splits:
+        if bits & anchor_bit:
+            bits = leaves ^ bits
+        if 1 < bits.bit_count() < leaves.bit_count() - 1:
+            normalized.add(bits)
+    return normalized
+
+
+def split_key(bits):
+    """
+    64-bit digest of a split bitset, a compact fixed-width key: a bitset over ~3800 taxa is ~500
+    bytes, and the digests pack into uint64 arrays (see tree_distances.py). Unlike the exact bitsets
+    SplitIndex keys on, two distinct splits can share a digest; at 2**-64 per pair that is accepted.
+    """
+    return hashlib.blake2b(bits.to_bytes((bits.bit_length() + 7) // 8, "little"), digest_size=8).digest()
+
+
+class SplitCounter:
+    """
+    Counts splits over a stream of trees by a digest of their taxon bitsets, so memory grows with
+    the number of distinct splits rather than the number of trees.
+
+    With tracked, only those splits are counted (exact, memory bounded by len(tracked)).
+    With max_splits, at most that many splits are kept: when the table is full every count is
+    decreased by the median count and counts at or below it are dropped (Misra-Gries style), so
+    a count is low by at most max_error and any split in more than max_error trees is still kept.
+    """
+
+    def __init__(self, taxa, tracked=None, max_splits=None):
+        self.tip_bits = {name: 1 << bit for name, bit in taxa.items()}
+        # the taxon on bit 0 is never on the counted side of a split
+        self.anchor_bit = 1
+        self.leaves = sum(self.tip_bits.values())
+        self.tracked = None if tracked is None else set(split_key(bits) for bits in tracked)
+        self.max_splits = max_splits
+        self.counts = {}
+        self.n_trees = 0
+        self.max_error = 0
+
+    def add_newick(self, newick):
+        counts = self.counts
+        for bits in newick_splits(newick, self.tip_bits, self.anchor_bit):
+            key = split_key(bits)
+            if self.tracked is None or key in self.tracked:
+                counts[key] = counts.get(key, 0) + 1
+        self.n_trees += 1
+        if self.max_splits is not None and len(counts) > self.max_splits:
+            self.prune()
+
+    def add_file(self, ufboot_file):
+        for newick in read_newicks(ufboot_file):
+            self.add_newick(newick)
+
+    def prune(self):
+        # drop at least half of the table so pruning stays amortized constant per split
+        floor = int(np.median(list(self.counts.values())))
+        self.counts = {key: count - floor for key, count in self.counts.items() if count > floor}
+        self.max_error += floor
+
+    def count(self, bits):
+        bits = bits if not bits & self.anchor_bit else self.leaves ^ bits
+        return self.counts.get(split_key(bits), 0)
+
+    def support(self, bits):
+        """
+        Percent of trees with the split (bits from a SplitIndex with the same taxa, either side).
+        """
+        return 100 * self.count(bits) / self.n_trees if self.n_trees else np.nan
+
+
+def reference_splits(tree, taxa):
+    """
+    {split bitset (side without the bit 0 taxon): node index} of the nontrivial splits of a
+    treecache.FlatTree.
+    """
+    anchor = min(taxa, key=taxa.get)
+    clades = SplitIndex.from_flat(tree, taxa, anchor).clades
+    # the clade of everything but the anchor is the anchor's own (trivial) split
+    return {bits: node for bits, node in clades.items() if bits.bit_count() < len(taxa) - 1}
+
+
+def find_ufboots(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob(os.path.join(path, "**", "*.ufboot*"), recursive=True)))
+        else:
+            files.append(path)
+    return files
+
+
+def support_rows(ufboot_file):
+    counter = SplitCounter(_taxa, tracked=_ref_splits)
+    counter.add_file(ufboot_file)
+    match = ufboot_regex.search(ufboot_file.replace(".gz", ""))
+    seed, mask = match.groups() if match else (None, None)
+    ref_nodes = np.array(list(_ref_splits.values()), dtype=np.int64)
+    rows = {
+        "file": ufboot_file,
+        "param_set": "fixed" if "fixedparams" in ufboot_file.split(os.sep) else "free",
+        "seed": int(seed) if seed is not None else None,
+        "mask": int(mask) if mask is not None else None,
+        "split": ref_nodes,
+        "ref_bootstrap": _ref_tree.ufboot[ref_nodes],
+        "n_replicates": counter.n_trees,
+        "replicate_support": [counter.support(bits) for bits in _ref_splits],
+    }
+    summary = "{}: {} replicates".format(ufboot_file, counter.n_trees)
+    return rows, summary
+
+
+def main():
+    global _taxa, _ref_splits, _ref_tree
+    parser = argparse.ArgumentParser(
+        description="Support of a reference tree's splits in IQ-TREE bootstrap tree sets (-wbt .ufboot files)"
+    )
+    parser.add_argument("ref_tree", help="reference treefile whose splits are counted")
+    parser.add_argument("paths", nargs="+", help=".ufboot files or directories to search for them")
+    parser.add_argument("-o", "--output", default="replicate_support.csv",
+                        help="per-split support table, .csv or .parquet (default: replicate_support.csv)")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="number of worker processes (default: 1)")
+    args = parser.parse_args()
+
+    ufboot_files = find_ufboots(args.paths)
+    print("Counting reference splits of {} in {} bootstrap tree sets...".format(args.ref_tree, len(ufboot_files)))
+    _ref_tree = load_tree(args.ref_tree)
+    _taxa = taxon_order(_ref_tree.leaf_names())
+    _ref_splits = reference_splits(_ref_tree, _taxa)
+
+    tables = []
+    if args.workers > 1:
+        ctx = multiprocessing.get_context("fork")
+        with ctx.Pool(args.workers) as pool:
+            for rows, summary in pool.imap_unordered(support_rows, ufboot_files):
+                print(summary)
+                tables.append(pd.DataFrame(rows, columns=columns))
+    else:
+        for ufboot_file in ufboot_files:
+            rows, summary = support_rows(ufboot_file)
+            print(summary)
+            tables.append(pd.DataFrame(rows, columns=columns))
+
+    df = pd.concat(tables, ignore_index=True) if tables else pd.DataFrame(columns=columns)
+    df = df.sort_values(["param_set", "seed", "mask", "split"], ignore_index=True)
+    write_table(df, args.output)
+    print("Done.")
+
+
+if __name__ == "__main__":
+    main()